@@ -10,11 +10,23 @@ import pysam
 import math
 import argparse
 import os
-import hyperloglog
 import subprocess
+import zlib
+import collections
+import itertools
+import bisect
+import hashlib
+import array
+import concurrent.futures
+import tempfile
+import zipfile
+import mmap
+import numpy as np
 
 try:  # optional library only needed for plotting
     import matplotlib.pyplot as plt
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_pdf import PdfPages
 
     matplotlib_imported = True
 except:
@@ -26,6 +38,45 @@ try:  # optional library for progress bars
 except ImportError:
     tqdm_imported = False
 
+base_codes = {"A": 0, "C": 1, "G": 2, "T": 3}  # 2-bit encoding for k-mers
+# substitutions are counted per node in a tensor indexed by [from base, to base, position] (see subs_index).
+# bases are A C G T and then anything else; positions are signed (the end of the read is -1, -2...) and only go out to
+# max_position from either end. further in, only the reference base composition is counted.
+# this end window is also exactly what the subs file writes, and can't be set apart from it: a smaller window would leave zeros in the subs file,
+# and a bigger one would count positions that are never written.
+# max_position is compute/run --subs_positions, and this is its default (the positions plotdamage plots)
+subs_max_position = 15
+subs_base_codes = np.full(256, 4, dtype=np.int64)  # ascii code -> subs tensor base
+subs_base_codes[list(b"ACGT")] = np.arange(4)
+# compressed bam bytes per chunk in compute. fixed so the output is the same for any number of threads (see plan_compute_chunks)
+compute_chunk_bytes = 16 << 20
+pmd_batch_size = 2000  # reads scored at once when annotating pmds in shrink
+dust_batch_size = 2000  # reads scored at once for dust in compute
+reference_batch_size = 1 << 16  # alignments counted at once per reference in extract
+# reads sorted in memory at once when extract looks up reads by name (see ReadNameSet)
+read_name_set_run = 1 << 20
+# lca lines extract reads ahead for a bam read before looking it up by name (see select_tax_alignments)
+lca_lookahead_lines = 100000
+# the number columns of a bamdam tsv that combine and krona use, and where they are
+tsv_number_columns = {"reads": 2, "duplicity": 3, "dust": 4, "damage": 5, "length": 7}
+tsv_cache_version = 1  # change this if the layout of the tsv sidecar caches changes (see read_tsv_columns)
+# bytes copied at once when glueing bam shards together (see concatenate_bams)
+bam_copy_chunk_size = 1 << 20
+# every bgzf block starts with these bytes, and a bgzf file ends with an empty block (see the SAM/BAM format specification)
+bgzf_magic = b"\x1f\x8b\x08\x04"
+bgzf_eof = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+# set pmd score parameters. these are the original PMDtools parameters, and i need to do some testing, but i think they are sensible enough in general.
+pmd_P = 0.3
+pmd_C = 0.01
+pmd_pi = 0.001
+# important note! in the PMDtools manuscript, they say "DZ=0" in the null model.
+# however, in the PMDtools code, Dz=0.001 in the null model.
+# here i am making the latter choice because i think it makes more biological sense.
+pmd_Dn = 0.001
+# the damage rate is exactly C this far from the end of a read, so distances are capped here in the lookup tables
+pmd_max_position = 128
+
 level_order = [
     "superkingdom",
     "kingdom",
@@ -108,65 +159,22 @@ def write_shortened_lca(
 ):
     print("\nWriting a filtered lca file...")
 
-    lcaheaderlines = 0
-    with open(original_lca_path, "r") as lcafile:
-        for lcaline in lcafile:
-            if "root" in lcaline and "#" not in lcaline:
-                break
-            lcaheaderlines += 1
+    # goes through the input lca file only once: it counts the reads per tax id, and spools the lines which might pass the filter
+    # (already in the output format) to a temp file next to the output, each prefixed with its upto node(s).
+    # once all the counts are in, the spooled lines whose upto node has enough reads are copied to the output.
+    exclude_keywords = set(exclude_keywords)
     total_short_lca_lines = 0
-
-    # pass 1: make a dictionary with all the tax ids and their counts
     number_counts = {}
-    with open(original_lca_path, "r") as file:
-        for _ in range(lcaheaderlines):
-            next(file)
-        for line in file:
-            if upto in line:
-                entry = line.strip().split("\t")
-                if len(entry) > 1:
-                    if lca_file_type == "ngslca":
-                        fields = entry[1:]  # can ditch the read id
-                    elif lca_file_type == "metadmg":
-                        fields = entry[6].split(";")
-                    if exclude_keywords:
-                        # go check if you need to skip this line
-                        taxidd = fields[0].split(":")[0].strip("'").strip('"')
-                        matching_keywords = [
-                            keyword for keyword in exclude_keywords if taxidd == keyword
-                        ]
-                        if len(matching_keywords) > 0:
-                            continue  # this only checks the node the read is actually assigned to
-                    # note! we are skipping keywords BEFORE aggregation, which happens later. so you might still end up with a family-level line if you
-                    # specified that family in the "exclude keywords" list, for example if there was a species in the sample which was not itself in your "exclude keywords" list
-                    # moving on
-                    # now explicitly check if upto is in the line on its own (e.g. we see "family", not just "subfamily" - yes this can happen rarely and weirdly and we will not include them)
-                    if any(
-                        item.split(":")[2].strip("'").strip('"') == upto
-                        for item in fields
-                    ):
-                        keepgoing = True
-                        field = 0
-                        while keepgoing:
-                            taxid = fields[field].split(":")[0].strip("'").strip('"')
-                            taxlevel = fields[field].split(":")[2].strip("'").strip('"')
-                            if taxid in number_counts:
-                                number_counts[taxid] += 1
-                            else:
-                                number_counts[taxid] = 1
-                            if taxlevel == upto:
-                                keepgoing = False
-                            field += 1
-
-    goodnodes = [key for key, count in number_counts.items() if count >= mincount]
-    # these are the nodes that have at least the min count of reads assigned to them (or below them), and which are at most upto
-
-    # pass 2: rewrite lines into a new lca file that pass the filter
+    spool_path = f"{short_lca_path}.tmp"
+    inheader = True
     oldreadname = ""
-    with open(original_lca_path, "r") as infile, open(short_lca_path, "w") as outfile:
-        for _ in range(lcaheaderlines):
-            next(infile)
+    with open(original_lca_path, "r") as infile, open(spool_path, "w") as spool:
         for line in infile:
+            if inheader:
+                if "root" in line and "#" not in line:
+                    inheader = False
+                else:
+                    continue
             tab_split = line.find("\t")
             if lca_file_type == "ngslca":
                 newreadname = line[:tab_split].rsplit(":", 3)[0]
@@ -178,47 +186,72 @@ def write_shortened_lca(
                     + newreadname
                     + ". You should fix this and re-run bamdam. Here is a suggested fix: awk '!seen[$0]++' input_lca > deduplicated_lca"
                 )
+                spool.close()
+                os.remove(spool_path)
                 exit(-1)
-            if upto in line:
-                entry = line.strip().split("\t")
-                if len(entry) > 1:
-                    if lca_file_type == "ngslca":
-                        fields = entry[1:]
-                    elif lca_file_type == "metadmg":
-                        fields = entry[6].split(";")
-                    if exclude_keywords:
-                        # go check if you need to skip this line
-                        matching_keywords = [
-                            keyword
-                            for keyword in exclude_keywords
-                            if fields[0].split(":")[0].strip("'").strip('"') == keyword
-                        ]
-                        if len(matching_keywords) > 0:
-                            continue  # this only checks the node the read is actually assigned to
-                    for field in fields:
-                        number = (
-                            field.split(":")[0].strip("'").strip('"')
-                        )  # metadmg lca files can have quotation marks everywhere
-                        level = field.split(":")[2].strip("'").strip('"')
-                        if level == upto:
-                            if (
-                                number in goodnodes
-                            ):  # you only need to check the upto counts, as they will be higher than anything underneath them
-                                if lca_file_type == "ngslca":
-                                    outfile.write(line)
-                                elif lca_file_type == "metadmg":
-                                    # reformat the output lca as an ngslca file format no matter how it came in
-                                    firstentry = ":".join(entry[0:4])
-                                    restentry = "\t".join(fields)
-                                    fullentry = (
-                                        "\t".join([firstentry, restentry]).replace(
-                                            '"', ""
-                                        )
-                                        + "\n"
-                                    )
-                                    outfile.write(fullentry)
-                                total_short_lca_lines += 1
-                                break
+            if upto not in line:
+                continue
+            entry = line.strip().split("\t")
+            if len(entry) <= 1:
+                continue
+            if lca_file_type == "ngslca":
+                fields = entry[1:]  # can ditch the read id
+            elif lca_file_type == "metadmg":
+                fields = entry[6].split(";")
+            if exclude_keywords:
+                # go check if you need to skip this line
+                if fields[0].split(":")[0].strip("'").strip('"') in exclude_keywords:
+                    continue  # this only checks the node the read is actually assigned to
+            # note! we are skipping keywords BEFORE aggregation, which happens later. so you might still end up with a family-level line if you
+            # specified that family in the "exclude keywords" list, for example if there was a species in the sample which was not itself in your "exclude keywords" list
+
+            # walk up the tax path to the first upto node, splitting each field only once. metadmg lca files can have quotation marks everywhere
+            pathnodes = []
+            uptonodes = []
+            for i, field in enumerate(fields):
+                splitfield = field.split(":")
+                taxid = splitfield[0].strip("'").strip('"')
+                if splitfield[2].strip("'").strip('"') == upto:
+                    uptonodes.append(taxid)
+                    break
+                pathnodes.append(taxid)
+            # now explicitly check if upto is in the line on its own (e.g. we see "family", not just "subfamily" - yes this can happen rarely and weirdly and we will not include them)
+            if not uptonodes:
+                continue
+            for field in fields[i + 1 :]:
+                # in case upto shows up again further up (it shouldn't)
+                if upto in field:
+                    splitfield = field.split(":")
+                    if splitfield[2].strip("'").strip('"') == upto:
+                        uptonodes.append(splitfield[0].strip("'").strip('"'))
+            pathnodes.append(uptonodes[0])
+            for taxid in pathnodes:
+                if taxid in number_counts:
+                    number_counts[taxid] += 1
+                else:
+                    number_counts[taxid] = 1
+
+            if lca_file_type == "ngslca":
+                outline = line
+            elif lca_file_type == "metadmg":
+                # reformat the output lca as an ngslca file format no matter how it came in
+                firstentry = ":".join(entry[0:4])
+                restentry = "\t".join(fields)
+                outline = "\t".join([firstentry, restentry]).replace('"', "") + "\n"
+            spool.write(":".join(uptonodes) + "\t" + outline)
+
+    goodnodes = {key for key, count in number_counts.items() if count >= mincount}
+    # these are the nodes that have at least the min count of reads assigned to them (or below them), and which are at most upto
+
+    # now keep the spooled lines that pass the filter
+    with open(spool_path, "r") as spool, open(short_lca_path, "w") as outfile:
+        for spooledline in spool:
+            tab_split = spooledline.find("\t")
+            # you only need to check the upto counts, as they will be higher than anything underneath them
+            if any(node in goodnodes for node in spooledline[:tab_split].split(":")):
+                outfile.write(spooledline[tab_split + 1 :])
+                total_short_lca_lines += 1
+    os.remove(spool_path)
 
     print("Wrote a filtered lca file. \n")
 
@@ -233,11 +266,15 @@ def write_shortened_bam(
     minsimilarity,
     annotate_pmd,
     totallcalines,
+    threads=1,
+    compression_level=None,
+    workers=1,
 ):
     # runs through the existing bam and the new short lca file at once, and writes only lines to the new bam which are represented in the short lca file
-    # does two passes, the first of which makes a shortened header as well and adds the command str to the end of the bam header
+    # (the filtering itself is done by filter_bam_reads, see write_shortened_bam_shard)
     # also annotates with pmd scores as it goes
     # now takes in minsimilarity as a percentage, and will keep reads w/ equal to or greater than NM flag to this percentage
+    # with workers > 1, the bam and lca are split into shards at the same reads, which are filtered in separate processes and then glued back together
 
     if tqdm_imported:
         print(
@@ -247,258 +284,520 @@ def write_shortened_bam(
         print(f"Writing a filtered bam file...")
 
     # go and get get header lines in the OUTPUT lca, not the input (it will be 0, but just in case I modify code in the future)
-    lcaheaderlines = 0
-    with open(short_lca_path, "r") as lcafile:
-        for lcaline in lcafile:
-            if "root" in lcaline and "#" not in lcaline:
-                break
-            lcaheaderlines += 1
-    currentlcaline = lcaheaderlines
+    lcaheaderlines, lca_offset = find_lca_header(short_lca_path)
+
+    if workers > 1:
+        shards = plan_shrink_shards(
+            original_bam_path, short_lca_path, lca_offset, workers
+        )
+        shard_paths = [f"{short_bam_path}.shard{i}.tmp" for i in range(len(shards))]
+        progress_bar = tqdm(total=len(shards), unit="shards") if tqdm_imported else None
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [
+                pool.submit(
+                    write_shortened_bam_shard,
+                    original_bam_path,
+                    short_lca_path,
+                    shard_path,
+                    stranded,
+                    minsimilarity,
+                    annotate_pmd,
+                    threads,
+                    compression_level,
+                    *shard,
+                )
+                for shard, shard_path in zip(shards, shard_paths)
+            ]
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+                if progress_bar:
+                    progress_bar.update(1)
+        if progress_bar:
+            progress_bar.close()
+        concatenate_bams(shard_paths, short_bam_path)
+        for shard_path in shard_paths:
+            try:
+                os.remove(shard_path)
+            except OSError as e:
+                print(f"Error removing temp file: {shard_path} : {e.strerror}")
+    else:
+        write_shortened_bam_shard(
+            original_bam_path,
+            short_lca_path,
+            short_bam_path,
+            stranded,
+            minsimilarity,
+            annotate_pmd,
+            threads,
+            compression_level,
+            None,
+            lca_offset,
+            None,
+            progress_total=totallcalines - lcaheaderlines,
+        )
 
+    print("Wrote a filtered bam file. Done! \n")
+
+
+def write_shortened_bam_shard(
+    original_bam_path,
+    short_lca_path,
+    short_bam_path,
+    stranded,
+    minsimilarity,
+    annotate_pmd,
+    threads,
+    compression_level,
+    bam_offset,
+    lca_start,
+    lca_end,
+    progress_total=None,
+):
+    # writes a short bam with the kept alignments of the reads in the short lca file between byte offsets lca_start and lca_end (None for the end of the file),
+    # starting in the original bam at bgzf virtual offset bam_offset (None for the first alignment), which should be where the first of those reads starts.
+    # it stops as soon as it runs out of lca lines, so the shard doesn't need to know where it ends in the bam
+    shortlcalines = read_lca_lines(short_lca_path, lca_start, lca_end)
     with pysam.AlignmentFile(
-        original_bam_path, "rb", check_sq=False, require_index=False
-    ) as infile, pysam.AlignmentFile(
-        short_bam_path, "wb", header=infile.header
-    ) as outfile, open(short_lca_path, "r") as shortlcafile:
-        for _ in range(lcaheaderlines):
-            lcaline = next(shortlcafile)
+        original_bam_path, "rb", check_sq=False, require_index=False, threads=threads
+    ) as infile:
+        with pysam.AlignmentFile(
+            short_bam_path,
+            "wb",
+            header=infile.header,
+            threads=threads,
+            format_options=bam_format_options(compression_level),
+        ) as outfile:
+            if bam_offset is not None:
+                infile.seek(bam_offset)
+            for bamread in filter_bam_reads(
+                infile,
+                shortlcalines,
+                stranded,
+                minsimilarity,
+                annotate_pmd,
+                progress_total,
+            ):
+                outfile.write(bamread)  # write the read!
+
+
+def bam_format_options(compression_level):
+    # htslib options for writing a bam at the given compression level (None for the htslib default)
+    if compression_level is None:
+        return None
+    return [f"level={compression_level}"]
+
+
+def read_lca_lines(lcafile_path, start, end=None):
+    # yields the lines of an lca file from byte offset start up to byte offset end (or the end of the file)
+    with open(lcafile_path, "rb") as lcafile:
+        lcafile.seek(start)
+        offset = start
+        for rawline in lcafile:
+            if end is not None and offset >= end:
+                return
+            offset += len(rawline)
+            yield rawline.decode()
+
+
+def read_lca_line_spans(lcafile_path, start):
+    # like read_lca_lines, but yields (start offset, end offset, line) for each line
+    with open(lcafile_path, "rb") as lcafile:
+        lcafile.seek(start)
+        offset = start
+        for rawline in lcafile:
+            yield offset, offset + len(rawline), rawline.decode()
+            offset += len(rawline)
+
+
+def plan_shrink_shards(original_bam_path, short_lca_path, lca_offset, workers):
+    # splits shrink into (up to) workers shards of about the same size, as (bam virtual offset, lca start, lca end) triples.
+    # the short lca file is split at line starts, and then each read the lca is split at has to be found in the bam: the bam is split into
+    # bgzf block ranges and searched for those read names in parallel (see locate_reads_in_bam). a split is dropped if its read can't be found.
+    lcasize = os.path.getsize(short_lca_path)
+    lcastarts = [lca_offset]
+    splitreads = []
+    with open(short_lca_path, "rb") as lcafile:
+        for i in range(1, workers):
+            lcafile.seek(max(lca_offset, i * lcasize // workers))
+            lcafile.readline()  # move on to the next line start
+            start = lcafile.tell()
+            rawline = lcafile.readline()
+            if not rawline or start <= lcastarts[-1]:
+                continue
+            lcastarts.append(start)
+            splitreads.append(rawline[: rawline.find(b"\t")].rsplit(b":", 3)[0])
 
-        lcaline = next(shortlcafile)
-        tab_split = lcaline.find("\t")
-        colon_split = lcaline[:tab_split].rsplit(":", 3)[0]
-        lcareadname = colon_split
+    if not splitreads:
+        return [(None, lca_offset, None)]  # too few reads to split
+
+    bamsize = os.path.getsize(original_bam_path)
+    with pysam.AlignmentFile(
+        original_bam_path, "rb", check_sq=False, require_index=False
+    ) as bamfile:
+        n_ref = bamfile.nreferences
+    with open(original_bam_path, "rb") as bamfile:
+        blockstarts = sorted(
+            {
+                find_bgzf_block(bamfile, bamsize, i * bamsize // workers)
+                for i in range(workers)
+            }
+        )
+    blockranges = list(zip(blockstarts, blockstarts[1:] + [bamsize]))
+    found = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        for located in pool.map(
+            locate_reads_in_bam,
+            [original_bam_path] * len(blockranges),
+            [start for start, end in blockranges],
+            [end for start, end in blockranges],
+            [splitreads] * len(blockranges),
+            [n_ref] * len(blockranges),
+        ):
+            for readname, bam_offset in located.items():
+                # the first alignment of a read is the first place it turns up
+                found.setdefault(readname, bam_offset)
+
+    shards = [[None, lca_offset]]
+    for readname, lcastart in zip(splitreads, lcastarts[1:]):
+        bam_offset = found.get(readname)
+        if bam_offset is None or (
+            shards[-1][0] is not None and bam_offset <= shards[-1][0]
+        ):
+            continue  # can't split here, so the previous shard just gets bigger
+        shards.append([bam_offset, lcastart])
+    return [
+        (bam_offset, lcastart, nextshard[1] if nextshard else None)
+        for (bam_offset, lcastart), nextshard in itertools.zip_longest(
+            shards, shards[1:]
+        )
+    ]
+
+
+def find_bgzf_block(bamfile, bamsize, offset):
+    # returns the file offset of the first bgzf block starting at or after offset in an open bam file (or bamsize if there isn't one).
+    # a bgzf block starts with a gzip header with a BC extra field holding the block size; a candidate only counts if another block
+    # (or the end of the file) starts right after it
+    while offset < bamsize:
+        bamfile.seek(offset)
+        data = bamfile.read(1 << 16)
+        candidate = data.find(bgzf_magic)
+        while candidate != -1:
+            bamfile.seek(offset + candidate)
+            header = bamfile.read(18)
+            if len(header) == 18 and header[10:16] == b"\x06\x00BC\x02\x00":
+                nextblock = (
+                    offset + candidate + int.from_bytes(header[16:18], "little") + 1
+                )
+                bamfile.seek(nextblock)
+                if nextblock == bamsize or bamfile.read(4) == bgzf_magic:
+                    return offset + candidate
+            candidate = data.find(bgzf_magic, candidate + 1)
+        offset += max(len(data) - 3, 1)
+    return bamsize
+
+
+def locate_reads_in_bam(bam_path, start, end, readnames, n_ref):
+    # finds the bgzf virtual offsets of the first alignments of some reads which start in the bgzf blocks between file offsets start and end.
+    # decompresses the blocks itself and searches them for each read name; a hit only counts if it sits where a read name would in a bam record
+    # (see the SAM/BAM format specification), and if the record after it also looks like one. returns a dict of read name -> virtual offset
+    blockoffsets = []  # (file offset, offset in data) of each block
+    chunks = []
+    datasize = 0
+    with open(bam_path, "rb") as bamfile:
+        bamfile.seek(start)
+        coffset = start
+        extra = 0
+        while extra < 2:  # one more block past the end, for records that spill over
+            if coffset >= end:
+                extra += 1
+            header = bamfile.read(18)
+            if len(header) < 18:
+                break
+            blocksize = int.from_bytes(header[16:18], "little") + 1
+            cdata = bamfile.read(blocksize - 18)
+            blockoffsets.append((coffset, datasize))
+            block = zlib.decompress(cdata[:-8], -15)
+            chunks.append(block)
+            datasize += len(block)
+            coffset += blocksize
+    data = b"".join(chunks)
+    ownsize = (
+        blockoffsets[-1][1] if blockoffsets and blockoffsets[-1][0] >= end else datasize
+    )
 
-        currentlymatching = False
-        notdone = True
-        bamreadnumber = 0
+    located = {}
+    for readname in readnames:
+        pattern = readname + b"\0"
+        hit = data.find(pattern, 36)
+        while hit != -1:
+            recordstart = hit - 36
+            if recordstart >= ownsize:
+                break
+            if looks_like_bam_record(data, recordstart, len(pattern), n_ref):
+                blockindex = (
+                    bisect.bisect_right([o for c, o in blockoffsets], recordstart) - 1
+                )
+                blockcoffset, blockstart = blockoffsets[blockindex]
+                located[readname] = (blockcoffset << 16) | (recordstart - blockstart)
+                break
+            hit = data.find(pattern, hit + 1)
+    return located
+
+
+def looks_like_bam_record(data, start, l_read_name, n_ref):
+    # checks whether a bam record with a read name of length l_read_name (NUL included) could start at start in decompressed bam data
+    if start + 36 + l_read_name > len(data) or data[start + 12] != l_read_name:
+        return False
+    block_size = int.from_bytes(data[start : start + 4], "little", signed=True)
+    refid = int.from_bytes(data[start + 4 : start + 8], "little", signed=True)
+    if block_size < 32 + l_read_name or not -1 <= refid < n_ref:
+        return False
+    nextstart = start + 4 + block_size
+    if nextstart + 36 <= len(data):
+        next_l_read_name = data[nextstart + 12]
+        if next_l_read_name == 0 or (
+            nextstart + 36 + next_l_read_name <= len(data)
+            and data[nextstart + 35 + next_l_read_name] != 0
+        ):
+            return False
+    return True
+
+
+def concatenate_bams(bam_paths, out_path):
+    # concatenates bams with the same header into one by copying their compressed bgzf blocks: all of the first one but its end-of-file marker,
+    # then the records of the rest (everything after their header). this relies on the header being in bgzf blocks of its own, which is how htslib writes it
+    with open(out_path, "wb") as outfile:
+        for i, bam_path in enumerate(bam_paths):
+            with pysam.AlignmentFile(
+                bam_path, "rb", check_sq=False, require_index=False
+            ) as bamfile:
+                records_offset = bamfile.tell()  # right after the header
+            if records_offset & 0xFFFF:
+                print(
+                    f"Error: Cannot concatenate {bam_path} because its header shares a bgzf block with its records."
+                )
+                sys.exit(-1)
+            bamsize = os.path.getsize(bam_path)
+            with open(bam_path, "rb") as bamfile:
+                bamfile.seek(bamsize - len(bgzf_eof))
+                if bamfile.read() != bgzf_eof:
+                    print(f"Error: {bam_path} is missing its bgzf end-of-file marker.")
+                    sys.exit(-1)
+                start = 0 if i == 0 else records_offset >> 16
+                bamfile.seek(start)
+                remaining = bamsize - len(bgzf_eof) - start
+                while remaining > 0:
+                    chunk = bamfile.read(min(remaining, bam_copy_chunk_size))
+                    outfile.write(chunk)
+                    remaining -= len(chunk)
+        outfile.write(bgzf_eof)
+
+
+def filter_bam_reads(
+    infile, shortlcalines, stranded, minsimilarity, annotate_pmd, progress_total=None
+):
+    # runs through an open bam and the lines of the short lca file (after its header) at once, and yields only the alignments which are represented
+    # in the short lca file and meet minsimilarity, in bam order. used both to write the short bam (write_shortened_bam) and to feed bamdam run directly.
+    # shows a progress bar over progress_total lca lines, unless that's None
+    currentlcaline = 0
+
+    lcaline = next(shortlcalines, None)
+    if lcaline is None:
+        return  # nothing was kept
+    tab_split = lcaline.find("\t")
+    colon_split = lcaline[:tab_split].rsplit(":", 3)[0]
+    lcareadname = colon_split
+
+    currentlymatching = False
+    notdone = True
+    bamreadnumber = 0
+    pmdbatch = []
 
-        try:
-            bamread = next(infile)
-        except StopIteration:
-            notdone = False
-
-        progress_bar = (
-            tqdm(
-                total=totallcalines - lcaheaderlines,
-                unit="lines",
-                disable=not tqdm_imported,
-            )
-            if tqdm_imported
-            else None
+    try:
+        bamread = next(infile)
+    except StopIteration:
+        notdone = False
+
+    progress_bar = (
+        tqdm(total=progress_total, unit="lines")
+        if tqdm_imported and progress_total is not None
+        else None
+    )
+    if progress_bar:
+        update_interval = (
+            100  # this is arbitrary. could also be e.g. (progress_total // 1000)
         )
-        if progress_bar:
-            update_interval = (
-                100  # this is arbitrary. could also be e.g. (totallcalines // 1000)
-            )
 
-        while notdone:
-            if bamread.query_name == lcareadname:
-                # copy this line and all the rest until you hit a nonmatching LCA line
-                readlength = (
-                    bamread.query_length
-                )  # same read length for all the alignments
-                similarity = (
-                    1 - bamread.get_tag("NM") / readlength
-                )  # not the same NM for all the alignments
-                if similarity >= minsimilarity:
-                    if annotate_pmd:
-                        pmd = get_pmd(bamread, stranded)
-                        bamread.set_tag("DS", "%.3f" % pmd)
-                    outfile.write(bamread)  # write the read!
-                currentlymatching = True
-                while currentlymatching:
-                    try:
-                        bamread = next(infile)
-                        if bamread.query_name == lcareadname:
-                            similarity = 1 - bamread.get_tag("NM") / readlength
-                            if similarity >= minsimilarity:
-                                if annotate_pmd:
-                                    pmd = get_pmd(bamread, stranded)
-                                    bamread.set_tag(
-                                        "DS", "%.3f" % pmd
-                                    )  # replace a tag if it's already there
-                                outfile.write(bamread)  # write the read!
-                        else:
-                            currentlymatching = False
-                    except StopIteration:
-                        notdone = False
-                        break
-                try:
-                    lcaline = next(shortlcafile)
-                    tab_split = lcaline.find("\t")
-                    lcareadname = lcaline[:tab_split].rsplit(":", 3)[0]
-                    currentlcaline += 1
-                    if progress_bar and currentlcaline % update_interval == 0:
-                        progress_bar.update(update_interval)
-                except StopIteration:
-                    notdone = False
-            else:
+    while notdone:
+        if bamread.query_name == lcareadname:
+            # copy this line and all the rest until you hit a nonmatching LCA line
+            readlength = bamread.query_length  # same read length for all the alignments
+            similarity = (
+                1 - bamread.get_tag("NM") / readlength
+            )  # not the same NM for all the alignments
+            if similarity >= minsimilarity:
+                if annotate_pmd:
+                    pmdbatch.append(bamread)
+                else:
+                    yield bamread
+            currentlymatching = True
+            while currentlymatching:
                 try:
                     bamread = next(infile)
-                    bamreadnumber += 1
+                    if bamread.query_name == lcareadname:
+                        similarity = 1 - bamread.get_tag("NM") / readlength
+                        if similarity >= minsimilarity:
+                            if annotate_pmd:
+                                pmdbatch.append(bamread)
+                            else:
+                                yield bamread
+                    else:
+                        currentlymatching = False
                 except StopIteration:
                     notdone = False
+                    break
+            if len(pmdbatch) >= pmd_batch_size:
+                # reads with pmds wait here to be scored together, then get passed on in the same order
+                yield from annotate_pmd_batch(pmdbatch, stranded)
+            try:
+                lcaline = next(shortlcalines)
+                tab_split = lcaline.find("\t")
+                lcareadname = lcaline[:tab_split].rsplit(":", 3)[0]
+                currentlcaline += 1
+                if progress_bar and currentlcaline % update_interval == 0:
+                    progress_bar.update(update_interval)
+            except StopIteration:
+                notdone = False
+        else:
+            try:
+                bamread = next(infile)
+                bamreadnumber += 1
+            except StopIteration:
+                notdone = False
+    yield from annotate_pmd_batch(pmdbatch, stranded)
     if progress_bar:
         progress_bar.close()
 
-    print("Wrote a filtered bam file. Done! \n")
-
 
-def get_mismatches(seq, cigar, md):
-    # parses a read, cigar and md string to determine mismatches and positions.
+def reconstruct_alignment(seq, cigartuples, md):
+    # parses a read, its cigar tuples (from pysam) and md string to reconstruct the alignment and find the mismatches.
     # does not output info on insertions/deletions, but accounts for them.
-    # thanks jonas oppenheimer who wrote half of this function :)
+    # thanks jonas oppenheimer who wrote half of the original version of this function :)
 
-    # goes in two passes: once w/ cigar and once w/ md
+    # goes in two linear passes: once w/ cigar and once w/ md
 
-    # the strategy is to reconstruct the alignment through the cigar string first, so read_seq and ref_seq are the same length
+    # the strategy is to reconstruct the alignment through the cigar first, so read_seq and ref_seq are the same length
     # but might have "-"s and "N"s floating around, and next to inform the substitutions from the md string
-
-    cig = re.findall(r"\d+\D", cigar)
-    md_list = re.compile(r"\d+|\^[A-Za-z]+|[A-Za-z]").findall(md)
-
-    ref_seq = ""
-    read_seq = ""
-    query_pos = 0  # indexes the ref reconstruction (which might have "-"s or "N"s added if there is soft clipping, indels etc)
-    read_pos = 0  # indexes the read reconstruction (which is the input read but with potential added "-"s if the ref has insertions)
-    for x in cig:
-        cat = x[-1]
-        if cat == "H":  # doesn't consume reference or query
-            print(
-                f"Warning: You have cigar strings have Hs in them (hard clipping). These specific reads may not be parsed correctly"
-            )
-            continue
-            # ! i've never actually seen these in a cigar string so i'm not 100% sure this works
-
-        bases = int(x[:-1])
-
-        if (
-            cat == "S"
-        ):  # soft clip: bases are present in the read, but not the reference. soft clipping is enabled by default in bwa but not bowtie2.
-            # pad the reference with "-"s and keep the whole read (to get the positions right).
-            # add to the md_list to deal with this manually below (md tags do not record soft clipped regions)
-            md_extra = "softclip" + str(bases)
-            if x == cig[len(cig) - 1]:  # the end of the read is soft clipped
-                md_list.append(md_extra)
-            elif x == cig[0]:  # the start of the read is soft clipped
-                md_list.insert(0, md_extra)
-            else:
-                sys.exit(
-                    "Error: It looks like one of your cigar strings "
-                    + cigar
-                    + " encodes a soft clip internally to a read. That shouldn't be happening."
-                )
-
-            # now pad the sequences as needed
-            read_seq += (
-                "s" * bases
-            )  # soft clipped. i don't care what you are. # seq[read_pos:read_pos + bases]
-            # i don't think we should include the original bases in the read, because i don't want to count them downstream,
-            # e.g. in kmer counts, gc count etc, because they didn't actually hit the reference!
-            ref_seq += "s" * bases
-            query_pos += bases
+    read_parts = []
+    ref_parts = []
+    read_pos = 0  # indexes the input read
+    md_start = 0  # where the md string starts in the reconstruction (md tags do not record soft clipped regions)
+    for op, bases in cigartuples:
+        if op in (0, 7, 8):  # M, =, X: match
+            read_parts.append(seq[read_pos : read_pos + bases])
+            ref_parts.append(seq[read_pos : read_pos + bases])
             read_pos += bases
-            continue
-
-        elif cat in ["M", "=", "X"]:  # match
-            ref_seq += seq[query_pos : query_pos + bases]
-            read_seq += seq[read_pos : read_pos + bases]
-            query_pos += bases
+        elif (
+            op == 1
+        ):  # I: the read has something there and the reference doesn't, but pad them both
+            read_parts.append(seq[read_pos : read_pos + bases])
+            ref_parts.append("-" * bases)
             read_pos += bases
-
         elif (
-            cat in ["D", "N"]
-        ):  # 'D' : the reference has something there and the read doesn't, but pad them both
-            ref_seq += (
+            op in (2, 3)
+        ):  # D, N: the reference has something there and the read doesn't, but pad them both
+            read_parts.append("-" * bases)
+            ref_parts.append(
                 "N" * bases
             )  # N means it's an ACTG, we just don't know which one right now
-            read_seq += "-" * bases
-
         elif (
-            cat == "I"
-        ):  # I: the read has something there and the reference doesn't, but pad them both
-            read_seq += seq[read_pos : read_pos + bases]  # 'N' * bases
-            ref_seq += "-" * bases
-            query_pos += bases
+            op == 4
+        ):  # S: soft clip: bases are present in the read, but not the reference. soft clipping is enabled by default in bwa but not bowtie2.
+            # pad both with "s"s and keep the whole read (to get the positions right). i don't care what you are.
+            # i don't think we should include the original bases in the read, because i don't want to count them downstream,
+            # e.g. in kmer counts, gc count etc, because they didn't actually hit the reference!
+            if (op, bases) == cigartuples[-1]:  # the end of the read is soft clipped
+                pass
+            elif (op, bases) == cigartuples[0]:  # the start of the read is soft clipped
+                md_start = bases
+            else:
+                sys.exit(
+                    "Error: It looks like one of your cigar strings "
+                    + "".join(f"{n}{'MIDNSHP=XB'[o]}" for o, n in cigartuples)
+                    + " encodes a soft clip internally to a read. That shouldn't be happening."
+                )
+            read_parts.append("s" * bases)
+            ref_parts.append("s" * bases)
             read_pos += bases
-
+        elif op == 5:  # H: doesn't consume reference or query
+            print(
+                f"Warning: You have cigar strings have Hs in them (hard clipping). These specific reads may not be parsed correctly"
+            )
         else:
             sys.exit("Error: You've got some strange cigar strings here.")
+    read_seq = np.frombuffer("".join(read_parts).encode(), dtype=np.uint8)
+    ref_seq = np.frombuffer("".join(ref_parts).encode(), dtype=np.uint8).copy()
+
+    # now walk the md string. positions here count every column of the reconstruction after a leading soft clip,
+    # including inserted ones, exactly as the original string-based version did.
+    mismatch_cols = []
+    mismatch_refs = []
+    rec_pos = (
+        md_start  # reconstruction position. refers to position in read_seq and ref_seq.
+    )
+    for x in re.findall(r"\d+|\^[A-Za-z]+|[A-Za-z]", md):
+        if x[0] == "^":  # this can be arbitrarily long (a ^ and then characters)
+            rec_pos += len(x) - 1
+        elif x.isdigit():  # can be multiple digits
+            # if you're a number, you're matching. skip ahead.
+            rec_pos += int(x)
+        else:  # it will only be one character at a time ; a mismatch
+            mismatch_cols.append(rec_pos)
+            mismatch_refs.append(ord(x))
+            rec_pos += 1
+    mismatch_cols = np.array(mismatch_cols, dtype=np.int64)
+    if len(mismatch_cols) and mismatch_cols[-1] >= len(read_seq):
+        print(
+            "Warning: There appears to be an inconsistency with seq "
+            + seq
+            + " and md "
+            + md
+        )
+        keep = mismatch_cols < len(read_seq)
+        mismatch_cols = mismatch_cols[keep]
+        mismatch_refs = np.array(mismatch_refs)[keep]
+    ref_seq[mismatch_cols] = mismatch_refs
 
-    rec_pos = 0  # reconstruction position. refers to position in read_seq and ref_seq.
-    mismatch_list = []  # of format [ref, read, pos in alignment]
-    for x in md_list:
-        if x.startswith("softclip"):
-            # skip ahead
-            num = int(x[len("softclip") :])
-            rec_pos += num
-        elif x.startswith(
-            "^"
-        ):  # this can be arbitrarily long (a ^ and then characters)
-            num_chars_after_hat = len(x) - 1
-            rec_pos += num_chars_after_hat
-        else:
-            # you're a number or a letter
-            if x.isdigit():  # can be multiple digits
-                # if you're a number, you're matching. skip ahead. don't need to add to the mismatch list.
-                rec_pos += int(x)
-            else:  # it will only be one character at a time ; a mismatch
-                refhere = x
-                readhere = read_seq[rec_pos]
-                char_list = list(ref_seq)
-                char_list[rec_pos] = x
-                ref_seq = "".join(char_list)
-                # moving on. get the position in the actual read itself, not the reconstructed alignment
-                read_up_to_here = read_seq[0:rec_pos]
-                read_pos = len(read_up_to_here) - read_up_to_here.count(
-                    "-"
-                )  # we padded it with "-"s earlier
-                mismatch_list.append([refhere, readhere, read_pos + 1])
-                # in genetics we are 1-based (a->g at position 1 means the actual first position, whereas python is 0-based)
-                if refhere is None or readhere is None:
-                    print(
-                        "Warning: There appears to be an inconsistency with seq "
-                        + seq
-                        + " and cigar "
-                        + cigar
-                        + " and md "
-                        + md
-                    )
-                    break
-                rec_pos += 1
+    # get the position of each mismatch in the actual read itself, not the reconstructed alignment (we padded it with "-"s earlier)
+    gaps = read_seq == ord("-")
+    mismatch_pos = mismatch_cols - (np.cumsum(gaps) - gaps)[mismatch_cols]
 
-    # returns same-length read and ref, padded as needed with "-" and "s" for indels and soft clips respectively,
-    # and a mismatch list which is on the coordinates of the read sequence alone.
+    # returns same-length read and ref as arrays of ascii codes, padded as needed with "-" and "s" for indels and soft clips respectively,
+    # and the mismatches as their columns in that reconstruction and their 0-based positions on the coordinates of the read sequence alone.
     # for example: read AGTTCTGAG, cigar 1S6M1D2M and md 2A3^G2 should yield (note md tags don't include soft clipped regions):
     # sGTTCTG-AG read_seq
     #  |||||| ||
     # sGTACTGNAG ref_seq
-    # mismatch_list: [A T 4].
+    # one mismatch (ref A, read T) in column 3, which is also position 3 in the read.
 
-    return [mismatch_list, ref_seq, read_seq]
+    return read_seq, ref_seq, mismatch_cols, mismatch_pos
 
 
-def mismatch_table(read, cigar, md, flagsum):
-    # wrapper for get_mismatches that also reverse complements if needed, and mirrors around the middle of the read so you shouldn't have to keep the length
+def mismatch_table(read, cigartuples, md, flagsum, max_position=subs_max_position):
+    # wrapper for reconstruct_alignment that also reverse complements if needed, and mirrors around the middle of the read so you shouldn't have to keep the length.
+    # returns the flat subs index (see subs_index) of every mismatch and match in the alignment, for a subs tensor going out to max_position
 
     # first parse the mismatches
-    mms, refseq, readseq = get_mismatches(read, cigar, md)
+    readseq, refseq, mmcols, mmpos = reconstruct_alignment(read, cigartuples, md)
 
     readlength = len(readseq)
-    # the mismatch list mms is on the coordinates of the read itself, NOT the reconstructed refseq or readseq.
-    # so first, get the reconstructions on the coordinates of the read too:
-    non_dash_indices = [i for i, char in enumerate(readseq) if char != "-"]
-    readseq_no_read_dashes = "".join(readseq[i] for i in non_dash_indices)
-    refseq_no_read_dashes = "".join(refseq[i] for i in non_dash_indices)
-    matchs = []
-    for i, (read_char, ref_char) in enumerate(
-        zip(readseq_no_read_dashes, refseq_no_read_dashes)
-    ):
-        if (
-            read_char == ref_char and read_char in "ACTG"
-        ):  # only count matches if both are an A C T or G
-            pos = non_dash_indices[i] + 1  # 1 based
-            matchs.append([ref_char, read_char, pos])
+    # the mismatch positions are on the coordinates of the read itself, NOT the reconstructed refseq or readseq.
+    # matches are on the coordinates of the reconstruction, and only count if both are an A C T or G
+    readcodes = subs_base_codes[readseq]
+    matchcols = np.flatnonzero((readseq == refseq) & (readcodes < 4))
+    from_base = np.concatenate((subs_base_codes[refseq[mmcols]], readcodes[matchcols]))
+    to_base = np.concatenate((readcodes[mmcols], readcodes[matchcols]))
+    pos = np.concatenate((mmpos, matchcols)) + 1  # 1 based
 
     # some processing: first, figure out if it's forward or backwards
     # second field of a bam is a flagsum and it parses like this (see eg bowtie2 manual)
@@ -507,42 +806,30 @@ def mismatch_table(read, cigar, md, flagsum):
     backwards = len(bin_flagsum) > bit_position and bin_flagsum[bit_position] == "1"
 
     if backwards:  # flip all the positions and reverse complement all the nucleotides. the read in the bam is reverse-complemented if aligned to the reverse strand.
-        complement = {"A": "T", "T": "A", "C": "G", "G": "C"}
-        mmsc = []
-        matchsc = []
-
-        for entry in range(0, len(mms)):  # mismatches
-            new_entry = [
-                complement.get(mms[entry][0], "N"),
-                complement.get(mms[entry][1], "N"),
-                readlength - mms[entry][2] + 1,
-            ]
-            mmsc.append(new_entry)
-
-        for entry in range(0, len(matchs)):  # matches
-            new_entry = [
-                complement.get(matchs[entry][0], "N"),
-                complement.get(matchs[entry][1], "N"),
-                readlength - matchs[entry][2] + 1,
-            ]
-            matchsc.append(new_entry)
-    else:
-        mmsc = mms
-        matchsc = matchs
+        complement = np.array(
+            [3, 2, 1, 0, 4]
+        )  # anything that isn't an A C T or G stays that way
+        from_base = complement[from_base]
+        to_base = complement[to_base]
+        pos = readlength - pos + 1
     # now accounts for everything EXCEPT unmerged but retained reverse mate pairs of paired end reads (which i should still try to catch later; maybe to do), should be 5' -> 3'
 
     # mirroring for accurate cumulative damage counting later (end of read becomes -1, -2...)
-    for entry in range(0, len(mmsc)):  # mismatches
-        pos = mmsc[entry][2]
-        if pos > readlength / 2:
-            mmsc[entry][2] = -(readlength - pos + 1)
+    pos = np.where(pos > readlength / 2, -(readlength - pos + 1), pos)
 
-    for entry in range(0, len(matchsc)):  # matches
-        pos = matchsc[entry][2]
-        if pos > readlength / 2:
-            matchsc[entry][2] = -(readlength - pos + 1)
+    return subs_index(from_base, to_base, pos, max_position)
 
-    return mmsc, matchsc, refseq
+
+def subs_index(from_base, to_base, pos, max_position=subs_max_position):
+    # flat index for subs tensor bases and signed positions: within max_position of the ends, an index into the subs tensor,
+    # and further in, an index into the reference composition counts placed right after it (subs_size + from_base).
+    # works on numbers or numpy arrays
+    npos = 2 * max_position
+    return np.where(
+        np.abs(pos) <= max_position,
+        (from_base * 5 + to_base) * npos + pos + max_position - (pos > 0),
+        25 * npos + from_base,
+    )
 
 
 def rev_complement(seq):
@@ -550,176 +837,159 @@ def rev_complement(seq):
     return "".join(complement[base] for base in reversed(seq))
 
 
-def get_rep_kmer(
-    seq,
-):  # representative canonical kmer representation for counting, gets the lexicographical min of a kmer and its rev complement
-    rep_kmer = min(seq, rev_complement(seq))
-    return rep_kmer
+def make_pmd_tables():
+    # lookup tables for the pmd likelihoods, built once at import rather than for every base of every read:
+    # the error rate per phred score, the damage rate per distance from the end of the read, the complement of each base,
+    # and the log likelihood ratios of a ds match / mismatch for every phred score and distance.
+    # ss needs the distance to both ends so its damage model is computed per base from the first two, but its null model only depends on phred.
+    P, C, pi, Dn = pmd_P, pmd_C, pmd_pi, pmd_Dn
+    # phred score 30 gives an error rate of 0.001 (then * 1/3)
+    eps = np.array([1 / 3 * 10 ** (-q / 10) for q in range(256)])
+    damage = np.array(
+        [((1 - P) ** (z - 1)) * P + C for z in range(1, pmd_max_position + 1)]
+    )
+    complement = np.arange(256, dtype=np.uint8)
+    for base, comp in zip(b"ACGT", b"TGCA"):
+        complement[base] = comp
+
+    e = eps[:, None]
+    Dz = damage[None, :]
+    ds = (1 - pi) * (1 - e) * (1 - Dz) + (1 - pi) * e * Dz + pi * e * (1 - Dz)
+    ds_null = (
+        (1 - pi) * (1 - eps) * (1 - Dn) + (1 - pi) * eps * Dn + pi * eps * (1 - Dn)
+    )[:, None]
+    ss_null = (
+        (1 - pi) * (1 - eps) * (1 - Dn) * (1 - Dn)
+        + (1 - pi) * eps * Dn * (1 - Dn)
+        + (1 - pi) * eps * Dn * (1 - Dn)
+        + pi * eps * (1 - Dn) * (1 - Dn)
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # indexed by [mismatch, phred, distance - 1] and [mismatch, phred]
+        ds_ratio = np.stack(
+            [np.log(ds) - np.log(ds_null), np.log(1 - ds) - np.log(1 - ds_null)]
+        )
+        ss_null = np.stack([np.log(ss_null), np.log(1 - ss_null)])
+
+    return {
+        "eps": eps,
+        "damage": damage,
+        "complement": complement,
+        "ds": ds_ratio,
+        "ss_null": ss_null,
+    }
 
 
-def get_pmd(read, stranded):
+pmd_tables = make_pmd_tables()
+
+
+def get_pmds(reads, stranded):
     ### important!!! the original PMDtools implementation has a bug:
     # in lines 868 and 900 of the main python script, it multiplies the likelihood by the double-stranded models, and then there is an if statement that multiplies by the single-stranded models
     # resulting in totally incorrect pmd scores for single-stranded mode. the reimplementation here should be correct.
 
-    # input is a pysam read object
-    seq = read.query_sequence
-    cigar = read.cigarstring
-    md = read.get_tag("MD")
-    rawphred = read.query_qualities
-    flagsum = read.flag
-
-    # set pmd score parameters . these are their original parameters, and i need to do some testing, but i think they are sensible enough in general.
-    P = 0.3
-    C = 0.01
-    pi = 0.001
+    # input is a list of pysam read objects, output is a numpy array of their pmd scores.
+    # each alignment is reconstructed with reconstruct_alignment, then the bases of the whole batch are concatenated and scored at once with the lookup tables above.
+    # likelihoods are accumulated as sums of log likelihood ratios, so long or very damaged reads can't underflow to 0.
+    nreads = len(reads)
+    if nreads == 0:
+        return np.zeros(0)
+    readseqs = []
+    refseqs = []
+    rawphreds = []
+    for read in reads:
+        readseq, refseq, mmcols, mmpos = reconstruct_alignment(
+            read.query_sequence, read.cigartuples, read.get_tag("MD")
+        )
+        readseqs.append(readseq)
+        refseqs.append(refseq)
+        rawphreds.append(read.query_qualities)
+    lengths = np.array([len(readseq) for readseq in readseqs], dtype=np.int64)
+    starts = np.cumsum(lengths) - lengths
+    readid = np.repeat(np.arange(nreads), lengths)
+    readseq = np.concatenate(readseqs)
+    refseq = np.concatenate(refseqs)
+
+    # adjust phred index if there are things happening in the read: phred scores go to the bases of the reconstruction which aren't "-" or "N", in order
+    hasphred = (readseq != ord("-")) & (readseq != ord("N"))
+    nphred = np.bincount(readid[hasphred], minlength=nreads)
+    phred = np.zeros(len(readseq), dtype=np.int64)
+    phred[hasphred] = np.concatenate(
+        [np.asarray(rawphred)[:n] for rawphred, n in zip(rawphreds, nphred)]
+    )
 
-    # important note! in the PMDtools manuscript, they say "DZ=0" in the null model.
-    # however, in the PMDtools code, Dz=0.001 in the null model.
-    # here i am making the latter choice because i think it makes more biological sense.
-    Dn = 0.001
+    # find out which alignments are backwards, and flip and complement those so positions count from the 5 prime end
+    backwards = np.repeat(np.array([read.is_reverse for read in reads]), lengths)
+    index = np.arange(len(readseq))
+    ends = np.repeat(starts + lengths - 1, lengths)
+    index = np.where(backwards, ends - (index - np.repeat(starts, lengths)), index)
+    complement = pmd_tables["complement"]
+    readseq = np.where(backwards, complement[readseq[index]], readseq[index])
+    refseq = np.where(backwards, complement[refseq[index]], refseq[index])
+    phred = phred[index]
+
+    readlength = np.repeat(lengths, lengths)
+    isT = readseq == ord("T")
+    isA = readseq == ord("A")
+    fiveprime = (refseq == ord("C")) & (isT | (readseq == ord("C")))
 
-    # find out if you're backwards
-    bin_flagsum = bin(flagsum)[::-1]
-    bit_position = 4  #  2^4 = 16 this flag means it's aligned in reverse
-    backwards = (
-        len(bin_flagsum) > bit_position and bin_flagsum[bit_position] == "1"
-    )  # backwards is a boolean
-    # do something if you are:
-    mmsc, refseq, readseq = get_mismatches(seq, cigar, md)
-    # adjust phred index if there are things happening in the read
-    phred = [0 if base in ["-", "N"] else rawphred.pop(0) for base in readseq]
-
-    # run through both sequences to add up pmd likelihoods
-    refseqlist = list(refseq)
-    readseqlist = list(readseq)
-    readlength = len(readseqlist)
-    if backwards:
-        refseqlist = rev_complement(refseqlist)
-        readseqlist = rev_complement(readseqlist)
-        phred = phred[::-1]
-    pmd_lik = 1
-    null_lik = 1
-    pos = 0  # need a separate tracker to cope with indels. if there's a "-" in the read reconstruction because of an insertion in the ref, it should not count as a "position" in the read
+    if stranded == "ss":
+        # looking for c-> anything anywhere. everything is relevant to 5 prime and 3 prime ends.
+        # pos only counts these sites, as it always has in the per-base implementation
+        counted = fiveprime
+    else:
+        # a "-" in the read reconstruction (an insertion in the ref) does not count as a "position" in the read
+        counted = readseq != ord("-")
+    counts = np.cumsum(counted)
+    pos = counts - counted - np.repeat(np.concatenate(([0], counts))[starts], lengths)
+    z = (
+        np.minimum(pos + 1, pmd_max_position) - 1
+    )  # pos 1 has distance 1, from pmd manuscript
+    y = np.minimum(readlength - pos, pmd_max_position) - 1
 
     if stranded == "ss":
-        for b in range(0, readlength):
-            if readseqlist[b] == "-":
-                continue  # no pos +=1
-            # looking for c-> anything anywhere
-            if refseqlist[b] == "C" and (
-                readseqlist[b] == "T" or readseqlist[b] == "C"
-            ):
-                # everything is relevant to 5 prime and 3 prime ends, get both distances
-                epsilon = 1 / 3 * 10 ** (-phred[b] / 10)
-                z = pos + 1  # pos 1 has distance 1, from pmd manuscript
-                y = readlength - pos
-                Dz = ((1 - P) ** (z - 1)) * P + C
-                Dy = ((1 - P) ** (y - 1)) * P + C
-                if readseqlist[b] == "T":  # ss m
-                    pmd_lik *= 1 - (
-                        (1 - pi) * (1 - epsilon) * (1 - Dz) * (1 - Dy)
-                        + (1 - pi) * epsilon * Dz * (1 - Dy)
-                        + (1 - pi) * epsilon * Dy * (1 - Dz)
-                        + pi * epsilon * (1 - Dz) * (1 - Dy)
-                    )
-                    null_lik *= 1 - (
-                        (1 - pi) * (1 - epsilon) * (1 - Dn) * (1 - Dn)
-                        + (1 - pi) * epsilon * Dn * (1 - Dn)
-                        + (1 - pi) * epsilon * Dn * (1 - Dn)
-                        + pi * epsilon * (1 - Dn) * (1 - Dn)
-                    )
-                if readseqlist[b] == "C":  # ss m
-                    pmd_lik *= (
-                        (1 - pi) * (1 - epsilon) * (1 - Dz) * (1 - Dy)
-                        + (1 - pi) * epsilon * Dz * (1 - Dy)
-                        + (1 - pi) * epsilon * Dy * (1 - Dz)
-                        + pi * epsilon * (1 - Dz) * (1 - Dy)
-                    )
-                    null_lik *= (
-                        (1 - pi) * (1 - epsilon) * (1 - Dn) * (1 - Dn)
-                        + (1 - pi) * epsilon * Dn * (1 - Dn)
-                        + (1 - pi) * epsilon * Dn * (1 - Dn)
-                        + pi * epsilon * (1 - Dn) * (1 - Dn)
-                    )
-                pos += 1
-
-    if stranded == "ds":
-        for b in range(0, readlength):
-            if readseqlist[b] == "-":
-                continue  # no pos +=1
-            if refseqlist[b] == "C" and (
-                readseqlist[b] == "T" or readseqlist[b] == "C"
-            ):
-                # get distance and stuff to 5 prime end
-                epsilon = 1 / 3 * 10 ** (-phred[b] / 10)
-                z = pos + 1  # 5 prime
-                Dz = ((1 - P) ** (z - 1)) * P + C
-
-                if readseqlist[b] == "T":  # ds mm
-                    pmd_lik *= 1 - (
-                        (1 - pi) * (1 - epsilon) * (1 - Dz)
-                        + (1 - pi) * epsilon * Dz
-                        + pi * epsilon * (1 - Dz)
-                    )
-                    null_lik *= 1 - (
-                        (1 - pi) * (1 - epsilon) * (1 - Dn)
-                        + (1 - pi) * epsilon * Dn
-                        + pi * epsilon * (1 - Dn)
-                    )
+        sites = fiveprime
+        mismatch = isT[sites]
+        eps = pmd_tables["eps"][phred[sites]]
+        Dz = pmd_tables["damage"][z[sites]]
+        Dy = pmd_tables["damage"][y[sites]]
+        pi = pmd_pi
+        lik = (
+            (1 - pi) * (1 - eps) * (1 - Dz) * (1 - Dy)
+            + (1 - pi) * eps * Dz * (1 - Dy)
+            + (1 - pi) * eps * Dy * (1 - Dz)
+            + pi * eps * (1 - Dz) * (1 - Dy)
+        )
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratios = (
+                np.log(np.where(mismatch, 1 - lik, lik))
+                - pmd_tables["ss_null"][mismatch.astype(np.int64), phred[sites]]
+            )
+    else:
+        # c->t relative to the 5 prime end and g->a relative to the 3 prime end
+        threeprime = (refseq == ord("G")) & (isA | (readseq == ord("G")))
+        sites = fiveprime | threeprime
+        mismatch = np.where(fiveprime, isT, isA)[sites]
+        distance = np.where(fiveprime, z, y)[sites]
+        ratios = pmd_tables["ds"][mismatch.astype(np.int64), phred[sites], distance]
 
-                if readseqlist[b] == "C":  # ds match
-                    pmd_lik *= (
-                        (1 - pi) * (1 - epsilon) * (1 - Dz)
-                        + (1 - pi) * epsilon * Dz
-                        + pi * epsilon * (1 - Dz)
-                    )
-                    null_lik *= (
-                        (1 - pi) * (1 - epsilon) * (1 - Dn)
-                        + (1 - pi) * epsilon * Dn
-                        + pi * epsilon * (1 - Dn)
-                    )
+    with np.errstate(invalid="ignore"):
+        pmd_scores = np.bincount(readid[sites], weights=ratios, minlength=nreads)
+    pmd_scores[~np.isfinite(pmd_scores)] = 0
+    return pmd_scores
 
-            if refseqlist[b] == "G" and (
-                readseqlist[b] == "A" or readseqlist[b] == "G"
-            ):
-                # get distance and stuff to 3 prime end
-                epsilon = (
-                    1 / 3 * 10 ** (-phred[b] / 10)
-                )  # phred score 30 gives an error rate of 0.001 (then * 1/3)
-                z = readlength - pos  # 3 prime
-                Dz = ((1 - P) ** (z - 1)) * P + C
-                if readseqlist[b] == "A":  # ds mm
-                    pmd_lik *= 1 - (
-                        (1 - pi) * (1 - epsilon) * (1 - Dz)
-                        + (1 - pi) * epsilon * Dz
-                        + pi * epsilon * (1 - Dz)
-                    )
-                    null_lik *= 1 - (
-                        (1 - pi) * (1 - epsilon) * (1 - Dn)
-                        + (1 - pi) * epsilon * Dn
-                        + pi * epsilon * (1 - Dn)
-                    )
-                if readseqlist[b] == "G":  # ds m
-                    pmd_lik *= (
-                        (1 - pi) * (1 - epsilon) * (1 - Dz)
-                        + (1 - pi) * epsilon * Dz
-                        + pi * epsilon * (1 - Dz)
-                    )
-                    null_lik *= (
-                        (1 - pi) * (1 - epsilon) * (1 - Dn)
-                        + (1 - pi) * epsilon * Dn
-                        + pi * epsilon * (1 - Dn)
-                    )
 
-            pos += 1
+def get_pmd(read, stranded):
+    # input is a pysam read object. see get_pmds, which is faster per read for many reads at once
+    return float(get_pmds([read], stranded)[0])
 
-    if pmd_lik == 0 or null_lik == 0:
-        pmd_score = 0
-    else:
-        pmd_score = math.log(pmd_lik / null_lik)
 
-    return pmd_score
+def annotate_pmd_batch(reads, stranded):
+    # annotates a batch of reads with their pmd scores, yields them in order and empties the batch
+    for read, pmd in zip(reads, get_pmds(reads, stranded)):
+        read.set_tag("DS", "%.3f" % pmd)  # replace a tag if it's already there
+        yield read
+    reads.clear()
 
 
 def line_count(file_path):  # just a wc -l wrapper
@@ -729,299 +999,566 @@ def line_count(file_path):  # just a wc -l wrapper
 
 
 def calculate_dust(seq):
-    # parameters as given by sga and original publication: Morgulis A. "A fast and symmetric DUST implementation to Mask Low-Complexity DNA Sequences". J Comp Bio.
-    # between 0 and 100 inclusive; throws a -1 if the read has an N in it
+    # dust score of one read; see calculate_dusts, which is faster per read for many reads at once
+    return calculate_dusts([seq])[0]
 
-    readlength = len(seq)
-    if readlength < 3:
-        print(
-            f"Warning: Cannot calculate dust score for a very short sequence (wait, why do you have reads this short?)"
-        )
-        return 0
 
+def calculate_dusts(seqs):
+    # parameters as given by sga and original publication: Morgulis A. "A fast and symmetric DUST implementation to Mask Low-Complexity DNA Sequences". J Comp Bio.
+    # between 0 and 100 inclusive; throws a -1 if the read has an N in it. takes a list of reads and returns a list of scores.
+    # the score of a window is the number of pairs of equal trinucleotides in it. the trinucleotides of all the reads are encoded at once,
+    # then counted per read in a 64-slot array, and the score is updated as they enter and leave the sliding window:
+    # one that arrives adds its current count, one that leaves takes away its remaining count.
     w = 64
-    k = 3
-    firstwindowend = min(readlength, w)
-    l = firstwindowend - 2
-    maxpossibledust = l * (l - 1) / 2
-
-    kmer_counts = {}
-    for i in range(firstwindowend - k + 1):
-        kmer = seq[i : i + k]
-        if not all(base in {"A", "C", "T", "G"} for base in kmer):
+    codes = subs_base_codes[np.frombuffer("".join(seqs).encode(), dtype=np.uint8)]
+    # this runs across the ends of reads too, but only the trinucleotides inside each read are used below
+    allkmers = (codes[:-2] * 16 + codes[1:-1] * 4 + codes[2:]).tolist()
+
+    dusts = []
+    readstart = 0
+    for seq in seqs:
+        readlength = len(seq)
+        kmers = allkmers[readstart : readstart + readlength - 2]
+        readstart += readlength
+        if readlength < 3:
+            print(
+                f"Warning: Cannot calculate dust score for a very short sequence (wait, why do you have reads this short?)"
+            )
+            dusts.append(0)
+            continue
+        if (
+            seq.count("A") + seq.count("C") + seq.count("G") + seq.count("T")
+            != readlength
+        ):
             # print(f"Warning: Skipping DUST calculations for a read with non-ACGT characters.")
-            return -1
-        if kmer in kmer_counts:
+            dusts.append(-1)
+            continue
+
+        firstwindowend = min(readlength, w)
+        l = firstwindowend - 2
+        maxpossibledust = l * (l - 1) / 2
+        if maxpossibledust == 0:
+            dusts.append(0)
+            continue
+
+        kmer_counts = [0] * 64
+        currentdust = 0
+        for kmer in kmers[:l]:
+            currentdust += kmer_counts[kmer]
             kmer_counts[kmer] += 1
-        else:
-            kmer_counts[kmer] = 1
-    currentdust = sum((count * (count - 1)) / 2 for count in kmer_counts.values())
-
-    if firstwindowend == readlength:
-        #  read is less than window size
-        return currentdust * (100 / maxpossibledust)
-
-    # otherwise perform sliding window :
-    maxdust = currentdust
-    for i in range(1, readlength - w + 1):
-        oldkmer = seq[(i - 1) : (i + 2)]
-        newkmer = seq[(i + w - 3) : (i + w)]
-        if not all(base in {"A", "C", "T", "G"} for base in newkmer):
-            # print(f"Warning: Skipping DUST calculations for a read with non-ACGT characters.")
-            return -1
-        kmer_counts[oldkmer] += -1
-        if kmer_counts[oldkmer] == 0:
-            del kmer_counts[oldkmer]
-        if newkmer not in kmer_counts:
-            kmer_counts[newkmer] = 1
-        else:
+
+        if firstwindowend == readlength:
+            #  read is less than window size
+            dusts.append(currentdust * (100 / maxpossibledust))
+            continue
+
+        # otherwise perform sliding window :
+        maxdust = currentdust
+        for oldkmer, newkmer in zip(kmers, kmers[l:]):
+            kmer_counts[oldkmer] -= 1
+            currentdust -= kmer_counts[oldkmer]
+            currentdust += kmer_counts[newkmer]
             kmer_counts[newkmer] += 1
-        currentdust = sum((count * (count - 1)) / 2 for count in kmer_counts.values())
-        if currentdust > maxdust:
-            maxdust = currentdust
+            if currentdust > maxdust:
+                maxdust = currentdust
+
+        dusts.append(maxdust * 100 / (maxpossibledust))  #  standardize so it's max 100
 
-    return maxdust * 100 / (maxpossibledust)  #  standardize so it's max 100
+    return dusts
 
 
 def get_hll_info(seq, k):
-    # output to dump into hll objects
+    # output to dump into hll objects: 64-bit hashes of the canonical k-mers of a read, and how many there were.
+    # k-mers are 2-bit encoded (A=0, C=1, G=2, T=3) and rolled along the read, so each base costs a couple of integer operations
+    # instead of slicing and reverse complementing a string per k-mer. the integer min of a k-mer and its reverse complement is
+    # the same k-mer as the lexicographical min of the strings. non-ACGT characters reset the rolling window, so k-mers containing them are skipped.
+    # needs k <= 32 so that a k-mer fits in 64 bits.
     rep_kmers = []
-    total_kmers = 0
     if len(seq) > k:
-        for i in range(len(seq) - k + 1):
-            kmer = seq[i : i + k]
-            if not all(base in {"A", "C", "T", "G"} for base in kmer):
+        mask = (1 << (2 * k)) - 1
+        shift = 2 * (k - 1)
+        fwd = 0
+        rev = 0
+        run = 0  # number of consecutive ACGT bases up to here
+        for base in seq:
+            code = base_codes.get(base)
+            if code is None:
                 # print(f"Warning: Skipping k-mer calculations for a read with non-ACGT characters.")
+                run = 0
                 continue  # skip this k-mer, non ACTG characters are not allowed
-            else:
-                rep_kmers.append(get_rep_kmer(kmer))
-                total_kmers += 1
+            fwd = ((fwd << 2) | code) & mask
+            rev = (rev >> 2) | ((3 - code) << shift)
+            run += 1
+            if run >= k:
+                rep_kmers.append(fwd if fwd < rev else rev)
     else:
         print(f"Warning: One of your reads is shorter than k.")
-    return rep_kmers, total_kmers
+    return hash64(np.array(rep_kmers, dtype=np.uint64)), len(rep_kmers)
+
+
+def hash64(values):
+    # splitmix64 finalizer, applied to an array of uint64s. spreads k-mer codes over all 64 bits for the hyperloglogs
+    x = values + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+class HyperLogLog:
+    # a mergeable hyperloglog sketch for counting unique k-mers per node, fed with 64-bit hashes (see hash64).
+    # it starts out sparse, as sorted arrays of only the registers that have been set, so nodes with few reads stay tiny,
+    # and promotes itself to a dense uint8 array of all 2^p registers once that gets smaller.
+    # hashes are buffered and added in vectorized batches. the cardinality estimate is from Ertl 2017,
+    # "New cardinality estimation algorithms for HyperLogLog sketches", which needs no empirical bias tables.
+
+    __slots__ = (
+        "p",
+        "m",
+        "sparse_index",
+        "sparse_rank",
+        "registers",
+        "pending",
+        "npending",
+    )
 
+    batch_size = 4096  # buffered hashes before they get added to the registers
+    magic = b"BDHL"  # for serialization
+
+    def __init__(self, p=14):
+        # p=14 gives a standard error of about 1.04 / sqrt(2^14) = 0.8%
+        if not (4 <= p <= 18):
+            raise ValueError(f"HyperLogLog precision p={p} should be between 4 and 18.")
+        self.p = p
+        self.m = 1 << p
+        self.sparse_index = np.zeros(0, dtype=np.uint32)
+        self.sparse_rank = np.zeros(0, dtype=np.uint8)
+        self.registers = None  # dense registers, once promoted
+        self.pending = []
+        self.npending = 0
+
+    def add(self, hashes):
+        # adds an array of 64-bit hashes
+        if len(hashes) == 0:
+            return
+        self.pending.append(hashes)
+        self.npending += len(hashes)
+        if self.npending >= self.batch_size:
+            self.flush()
 
-def gather_subs_and_kmers(bamfile_path, lcafile_path, kn, upto, stranded):
-    print("\nGathering substitution and kmer metrics per node...")
+    def flush(self):
+        if not self.pending:
+            return
+        hashes = (
+            self.pending[0] if len(self.pending) == 1 else np.concatenate(self.pending)
+        )
+        self.pending = []
+        self.npending = 0
+        # the low p bits pick the register, the register keeps the max rank (position of the first 1 bit) of the rest
+        index = (hashes & np.uint64(self.m - 1)).astype(np.uint32)
+        w = hashes >> np.uint64(self.p)
+        # exact bit length of w, in two 32-bit halves so the float conversion is always exact
+        high = (w >> np.uint64(32)).astype(np.float64)
+        low = (w & np.uint64(0xFFFFFFFF)).astype(np.float64)
+        bit_length = np.where(high > 0, np.frexp(high)[1] + 32, np.frexp(low)[1])
+        rank = (64 - self.p + 1 - bit_length).astype(np.uint8)
+        self._add_registers(index, rank)
+
+    def _add_registers(self, index, rank):
+        if self.registers is not None:
+            np.maximum.at(self.registers, index, rank)
+            return
+        index = np.concatenate((self.sparse_index, index))
+        rank = np.concatenate((self.sparse_rank, rank))
+        # keep the max rank per register: sort by register then rank, and take the last of each run
+        order = np.lexsort((rank, index))
+        index = index[order]
+        rank = rank[order]
+        last = np.ones(len(index), dtype=bool)
+        last[:-1] = index[1:] != index[:-1]
+        self.sparse_index = index[last]
+        self.sparse_rank = rank[last]
+        # sparse costs 5 bytes per set register, dense costs 1 byte per register
+        if len(self.sparse_index) * 5 > self.m:
+            self.registers = np.zeros(self.m, dtype=np.uint8)
+            self.registers[self.sparse_index] = self.sparse_rank
+            self.sparse_index = np.zeros(0, dtype=np.uint32)
+            self.sparse_rank = np.zeros(0, dtype=np.uint8)
+
+    def merge(self, other):
+        # union with another sketch of the same precision: register-wise max
+        if self.p != other.p:
+            raise ValueError("Cannot merge HyperLogLogs with different precisions.")
+        self.flush()
+        other.flush()
+        if other.registers is None:
+            self._add_registers(other.sparse_index, other.sparse_rank)
+        elif self.registers is None:
+            registers = other.registers.copy()
+            registers[self.sparse_index] = np.maximum(
+                registers[self.sparse_index], self.sparse_rank
+            )
+            self.registers = registers
+            self.sparse_index = np.zeros(0, dtype=np.uint32)
+            self.sparse_rank = np.zeros(0, dtype=np.uint8)
+        else:
+            np.maximum(self.registers, other.registers, out=self.registers)
+
+    def cardinality(self):
+        self.flush()
+        q = 64 - self.p
+        if self.registers is None:
+            counts = np.bincount(self.sparse_rank, minlength=q + 2)
+            counts[0] = self.m - len(self.sparse_index)
+        else:
+            counts = np.bincount(self.registers, minlength=q + 2)
+        m = self.m
+        z = m * hll_tau((m - counts[q + 1]) / m)
+        for k in range(q, 0, -1):
+            z = 0.5 * (z + counts[k])
+        z += m * hll_sigma(counts[0] / m)
+        if z == math.inf:
+            return 0.0
+        return m * m / (2 * math.log(2) * z)
+
+    def __len__(self):
+        return round(self.cardinality())
+
+    def to_bytes(self):
+        # compact serialization: a small header, then either the sparse (register, rank) pairs or the zlib-compressed dense registers
+        self.flush()
+        if self.registers is None:
+            body = (
+                self.sparse_index.astype("<u4").tobytes() + self.sparse_rank.tobytes()
+            )
+            mode = 0
+        else:
+            body = zlib.compress(self.registers.tobytes(), 1)
+            mode = 1
+        return self.magic + bytes([self.p, mode]) + body
+
+    @classmethod
+    def from_bytes(cls, data):
+        if data[:4] != cls.magic:
+            raise ValueError("Not a serialized bamdam HyperLogLog.")
+        hll = cls(data[4])
+        body = data[6:]
+        if data[5] == 0:
+            n = len(body) // 5
+            hll.sparse_index = np.frombuffer(body[: 4 * n], dtype="<u4").astype(
+                np.uint32
+            )
+            hll.sparse_rank = np.frombuffer(body[4 * n :], dtype=np.uint8).copy()
+        else:
+            hll.registers = np.frombuffer(zlib.decompress(body), dtype=np.uint8).copy()
+        return hll
+
+    def __reduce__(self):
+        # pickle (e.g. to send between processes) through the compact serialization
+        return (HyperLogLog.from_bytes, (self.to_bytes(),))
+
+
+def hll_sigma(x):
+    # helper series for the hyperloglog estimate, see Ertl 2017
+    if x == 1:
+        return math.inf
+    y = 1
+    z = x
+    while True:
+        x = x * x
+        z_old = z
+        z += x * y
+        y += y
+        if z == z_old:
+            return z
+
+
+def hll_tau(x):
+    # helper series for the hyperloglog estimate, see Ertl 2017
+    if x == 0 or x == 1:
+        return 0
+    y = 1
+    z = 1 - x
+    while True:
+        x = math.sqrt(x)
+        z_old = z
+        y *= 0.5
+        z -= (1 - x) ** 2 * y
+        if z == z_old:
+            return z / 3
+
+
+def new_node_entry(pmds_in_bam, histograms=False, max_position=subs_max_position):
+    # per-node accumulator. everything is kept as a plain sum so that nodes can be merged into each other;
+    # means are only taken when writing the output
+    entry = {
+        "total_reads": 0,
+        "sumlength": 0,
+        "total_alignments": 0,
+        "sumani": 0,
+        "sumdust": 0,
+        "dustreads": 0,  # reads with a valid dust score (no non-ACGT characters)
+        "sumreadgc": 0,
+        "tax_path": "",
+        "subs": np.zeros((5, 5, 2 * max_position)),  # see subs_index
+        "refcomp": np.zeros(5),  # reference bases further in than the subs tensor
+        "hll": HyperLogLog(),
+        "totalkmers": 0,
+    }
+    if pmds_in_bam:
+        entry["pmdsover2"] = 0
+        entry["pmdsover4"] = 0
+    if histograms:
+        # read length -> number of reads, and NM -> number of reads with each read split evenly over its alignments
+        entry["lengths"] = {}
+        entry["nms"] = {}
+    return entry
+
+
+def merge_node_entry(into, other):
+    # adds the stats of one node accumulator into another: sums are added, hll registers are max-merged and subs tables are summed
+    for key in (
+        "total_reads",
+        "sumlength",
+        "total_alignments",
+        "sumani",
+        "sumdust",
+        "dustreads",
+        "sumreadgc",
+        "totalkmers",
+        "pmdsover2",
+        "pmdsover4",
+    ):
+        if key in other:
+            into[key] += other[key]
+    into["hll"].merge(other["hll"])
+    into["subs"] += other["subs"]
+    into["refcomp"] += other["refcomp"]
+    if "lengths" in other:
+        for key in ("lengths", "nms"):
+            for value, count in other[key].items():
+                into[key][value] = into[key].get(value, 0) + count
+    if into["tax_path"] == "":
+        into["tax_path"] = other["tax_path"]
+
+
+def roll_up_node_data(node_data, node_parent, node_depth):
+    # propagates per-node stats up the taxonomy, so every node ends up with the stats of all reads assigned to it or underneath.
+    # deepest nodes go first, so each node is complete by the time it is added into its parent, and each node is only merged once.
+    for node in sorted(node_data, key=lambda n: node_depth[n], reverse=True):
+        parent = node_parent[node]
+        if parent is not None:
+            merge_node_entry(node_data[parent], node_data[node])
+
+
+def gather_subs_and_kmers_chunk(
+    bamfile_path,
+    lcafile_path,
+    kn,
+    upto,
+    pmds_in_bam,
+    bam_offset,
+    lca_offset,
+    stop_offset,
+    histograms=False,
+    max_position=subs_max_position,
+):
+    # handles one chunk, starting at a bgzf virtual offset in the bam and a byte offset in the lca and stopping at the read at bam virtual offset
+    # stop_offset (or at the end of the bam if it's None), and returns the partial node data for that chunk (see gather_subs_and_kmers).
+    bamfile = pysam.AlignmentFile(bamfile_path, "rb", require_index=False)
+    bamfile.seek(bam_offset)
+    lcafile = open(lcafile_path, "rb")
+    lcafile.seek(lca_offset)
+    chunk = accumulate_node_data(
+        bam_alignments(bamfile),
+        lcafile,
+        lca_offset,
+        kn,
+        upto,
+        pmds_in_bam,
+        stop_offset,
+        histograms,
+        max_position,
+    )
+    bamfile.close()
+    lcafile.close()
+    return chunk
+
+
+def bam_alignments(bamfile):
+    # yields (bgzf virtual offset, alignment) pairs from an open bam, so accumulate_node_data knows where to stop a chunk
+    while True:
+        offset_here = bamfile.tell()
+        read = next(bamfile, None)
+        if read is None:
+            return
+        yield offset_here, read
+
+
+def accumulate_node_data(
+    alignments,
+    lcafile,
+    lca_offset,
+    kn,
+    upto,
+    pmds_in_bam,
+    stop_offset=None,
+    histograms=False,
+    max_position=subs_max_position,
+):
     # this function is organized in an unintuitive way. it uses a bunch of nested loops to pop between the bam and lca files line by line.
     # it matches up bam read names and lca read names and aggregates some things per alignment, some per read, and some per node, the last of which are added into a large structure node_data.
+    # alignments yields (bam offset, alignment) pairs, and lcafile is an lca file opened in binary mode at byte offset lca_offset.
+    # stops at the first read at bam offset stop_offset or after it (or never, if stop_offset is None) and returns the partial node data.
+    # with histograms, each node also gets histograms of read length and NM (see write_node_histograms).
+    # substitutions are counted out to max_position from either end of the read (see subs_index).
     # altogether this uses very little ram
 
-    lcaheaderlines = 0
-    with open(lcafile_path, "r") as lcafile:
-        for lcaline in lcafile:
-            if "root" in lcaline and "#" not in lcaline:
-                break
-            lcaheaderlines += 1
-
     # initialize
     node_data = {}
-    bamfile = pysam.AlignmentFile(bamfile_path, "rb", require_index=False)
-    lcafile = open(lcafile_path, "r")
+    node_parent = {}  # parent of each node within the tax path (None at upto or at the top of the path)
+    node_depth = {}  # number of tax path entries from this node to the top; children are always deeper than parents
     oldreadname = ""
     oldmd = ""
     oldcigar = ""
     oldflagsum = ""
-    nodestodumpinto = []
     num_alignments = 0
-    currentsubdict = {}
+    currentsubs = []  # subs tensor indices of the matches and mismatches of each alignment of this read
+    currentnms = []  # NM of each alignment of this read, for the histograms
+    dustbatch = []  # (node entry, read) pairs waiting for their dust scores
     nms = 0
     pmdsover2 = 0
     pmdsover4 = 0
-    are_pmds_in_the_bam = True  # just assume true, then set to false quickly below if you notice otherwise
     lcalinesskipped = 0
     readswithNs = 0
+    lcalines = 0
 
-    currentlcalinenum = 0
-    if tqdm_imported:
-        totallcalines = line_count(lcafile_path)
-        # should be super fast compared to anything else; probably worth it to initiate a progress bar.
-        progress_bar = (
-            tqdm(
-                total=totallcalines - lcaheaderlines,
-                unit="lines",
-                disable=not tqdm_imported,
-            )
-            if tqdm_imported
-            else None
-        )
-        if progress_bar:
-            update_interval = (
-                100  # this is arbitrary ofc. could also be e.g. (totallcalines // 1000)
-            )
-
-    for _ in range(lcaheaderlines + 1):
-        currentlcaline = next(lcafile)
-
-    for read in bamfile:
+    while True:
         # get the basic info for this read
-        readname = read.query_name
+        offset_here, read = next(alignments, (None, None))
+        readname = read.query_name if read is not None else None
 
-        # find out if it's a new read. if so, you just finished the last read, so do a bunch of stuff for it.
+        # find out if it's a new read (or the end of the file). if so, you just finished the last read, so do a bunch of stuff for it.
         # the first read will skip this if statement because of the second condition
         if readname != oldreadname and oldreadname != "":
-            # do k-mer things for this read
-            dust = calculate_dust(seq)
-            # then get all the rep kmers to dump into the hyperloglog for each relevant node below
-            rep_kmers, total_kmers = get_hll_info(seq, kn)
+            # do k-mer things for this read. dust scores are done in batches (see add_dust_batch)
+            # then get all the hashed rep kmers to dump into the hyperloglog of the assigned node below
+            kmer_hashes, total_kmers = get_hll_info(seq, kn)
 
             # get the lca entry and nodes we wanna update
-            lcaentry = currentlcaline.split("\t")
-            colon_split = lcaentry[0].rsplit(":", 3)[0]
-            lcareadname = colon_split
-
-            while oldreadname != lcareadname:
-                # skip em but don't forget your progress bar
+            while True:
+                rawline = lcafile.readline()
+                if not rawline:
+                    print(
+                        f"Error: The read {oldreadname} is in the bam file but could not be found in the lca file. Are they in the same order?"
+                    )
+                    sys.exit(-1)
+                lca_offset += len(rawline)
+                lcalines += 1
+                currentlcaline = rawline.decode()
+                lcaentry = currentlcaline.split("\t")
+                lcareadname = lcaentry[0].rsplit(":", 3)[0]
+                if lcareadname == oldreadname:
+                    break
+                # skip em.
                 # this must be because there are reads in the lca which are not in the bam. presumably because we didn't write them because none of them met the similarity cutoff.
                 lcalinesskipped += 1
-                currentlcaline = next(lcafile)
-                currentlcalinenum += 1
-                lcaentry = currentlcaline.split("\t")
-                colon_split = lcaentry[0].rsplit(":", 3)[0]
-                lcareadname = colon_split
-                if progress_bar and (currentlcalinenum % update_interval == 0):
-                    progress_bar.update(update_interval)  # update the progress bar
 
+            # stats are only accumulated at the node the read is assigned to; they get rolled up the taxonomy at the end
             fields = lcaentry[1:]
-            nodestodumpinto = []
-            for i in range(len(fields)):
-                # i recently changed fields to level here, it should be safer
-                splitfields = fields[i].split(":")
-                level = splitfields[2].strip("'").strip('"')
-                nodename = splitfields[0].strip("'").strip('"')
-                if level == upto:
+            node = fields[0].split(":")[0].strip("'").strip('"')
+
+            if node not in node_data:
+                # first time we see this node, so walk up its tax path once to register it and any new ancestors (up to upto).
+                # nodes are inserted in the same order as they are first touched, which keeps the row order of ties in the output stable.
+                nodestodumpinto = []
+                for i in range(len(fields)):
+                    splitfields = fields[i].split(":")
+                    level = splitfields[2].strip("'").strip('"')
+                    nodename = splitfields[0].strip("'").strip('"')
                     nodestodumpinto.append(nodename)
-                    break
-                nodestodumpinto.append(nodename)
-
-            # now update everything to all the relevant nodes
-            for node in nodestodumpinto:
-                # you will skip this if statement if your node already exists; otherwise just initialize it then move on
-                if node not in node_data:
-                    if are_pmds_in_the_bam:
-                        node_data[node] = {
-                            "total_reads": 0,
-                            "pmdsover2": 0,
-                            "pmdsover4": 0,
-                            "meanlength": 0,
-                            "total_alignments": 0,
-                            "ani": 0,
-                            "avgdust": 0,
-                            "avgreadgc": 0,
-                            "tax_path": "",
-                            "subs": {},
-                            "damagerelevantreadsp1": 0,
-                            "damagerelevantreadsm1": 0,
-                            "dp1": 0,
-                            "dm1": 0,
-                            "hll": hyperloglog.HyperLogLog(0.01),
-                            "totalkmers": 0,
-                        }
-                    else:
-                        node_data[node] = {
-                            "total_reads": 0,
-                            "meanlength": 0,
-                            "total_alignments": 0,
-                            "ani": 0,
-                            "avgdust": 0,
-                            "avgreadgc": 0,
-                            "tax_path": "",
-                            "subs": {},
-                            "damagerelevantreadsp1": 0,
-                            "damagerelevantreadsm1": 0,
-                            "dp1": 0,
-                            "dm1": 0,
-                            "hll": hyperloglog.HyperLogLog(0.01),
-                            "totalkmers": 0,
-                        }
-
-                # now populate/update it
-                node_data[node]["meanlength"] = (
-                    (node_data[node]["meanlength"] * node_data[node]["total_reads"])
-                    + readlength
-                ) / (node_data[node]["total_reads"] + 1)
-
-                if dust != -1:
-                    node_data[node]["avgdust"] = (
-                        (node_data[node]["avgdust"] * node_data[node]["total_reads"])
-                        + dust
-                    ) / (node_data[node]["total_reads"] + 1)
-                else:
-                    readswithNs += 1
-
-                ani_for_this_read = (readlength - nms / num_alignments) / readlength
-                node_data[node]["ani"] = (
-                    ani_for_this_read
-                    + node_data[node]["ani"] * node_data[node]["total_reads"]
-                ) / (node_data[node]["total_reads"] + 1)
-                gc_content_for_this_read = (
-                    seq.count("C") + seq.count("G")
-                ) / readlength
-                node_data[node]["avgreadgc"] = (
-                    (node_data[node]["avgreadgc"] * node_data[node]["total_reads"])
-                    + gc_content_for_this_read
-                ) / (node_data[node]["total_reads"] + 1)
-                node_data[node]["total_alignments"] += num_alignments
-
-                if are_pmds_in_the_bam:
-                    node_data[node]["pmdsover2"] += pmdsover2 / num_alignments
-                    node_data[node]["pmdsover4"] += pmdsover4 / num_alignments
-
-                # update hyperloglogs
-                for kmer in rep_kmers:
-                    node_data[node]["hll"].add(kmer)
-                node_data[node]["totalkmers"] += total_kmers
-
-                # updates substitution tables similarly
-                other_sub_count = 0
-                if currentsubdict:
-                    for sub, count in currentsubdict.items():
-                        if not (
-                            (sub[0] == "C" and sub[1] == "T")
-                            or (sub[0] == "G" and sub[1] == "A")
-                        ):
-                            other_sub_count += count  # don't include c>t or g>a in any case, regardless of library
-                        if sub in node_data[node]["subs"]:
-                            node_data[node]["subs"][sub] += count / num_alignments
-                        else:
-                            node_data[node]["subs"][sub] = (
-                                count / num_alignments
-                            )  # so, this can be up to 1 per node.
-                # add the tax path if it's not already there
-                if node_data[node]["tax_path"] == "":
+                    if level == upto:
+                        break
+                for i, pathnode in enumerate(nodestodumpinto):
+                    if pathnode in node_data:
+                        continue
+                    node_data[pathnode] = new_node_entry(
+                        pmds_in_bam, histograms, max_position
+                    )
+                    node_depth[pathnode] = len(fields) - i
+                    node_parent[pathnode] = (
+                        nodestodumpinto[i + 1] if i + 1 < len(nodestodumpinto) else None
+                    )
+                    # add the tax path
                     try:
                         lca_index = next(
-                            i
-                            for i, entry in enumerate(lcaentry)
-                            if entry.split(":")[0].strip("'").strip('"') == node
+                            j
+                            for j, entry in enumerate(lcaentry)
+                            if entry.split(":")[0].strip("'").strip('"') == pathnode
                         )
                         tax_path = ";".join(lcaentry[lca_index:]).replace("\n", "")
-                        node_data[node]["tax_path"] = tax_path
+                        node_data[pathnode]["tax_path"] = tax_path
                     except StopIteration:  # this should not happen
                         print(
-                            f"Error: Something weird has gone wrong. Cannot find node '{node}' in its supposed lca entry. Are there weird characters in your lca entries?"
+                            f"Error: Something weird has gone wrong. Cannot find node '{pathnode}' in its supposed lca entry. Are there weird characters in your lca entries?"
                         )
                         print(f"The problematic line is {currentlcaline}")
                         print(f"Will try to continue.")
 
-                # only at the end should you update total reads
-                node_data[node]["total_reads"] += 1
+            # now update the assigned node
+            tn = node_data[node]
+            tn["total_reads"] += 1
+            tn["sumlength"] += readlength
+            dustbatch.append((tn, seq))
+            if len(dustbatch) >= dust_batch_size:
+                readswithNs += add_dust_batch(dustbatch)
+            tn["sumani"] += (readlength - nms / num_alignments) / readlength
+            tn["sumreadgc"] += (seq.count("C") + seq.count("G")) / readlength
+            tn["total_alignments"] += num_alignments
+
+            if pmds_in_bam:
+                tn["pmdsover2"] += pmdsover2 / num_alignments
+                tn["pmdsover4"] += pmdsover4 / num_alignments
+
+            if histograms:
+                tn["lengths"][readlength] = tn["lengths"].get(readlength, 0) + 1
+                for nm, count in collections.Counter(currentnms).items():
+                    tn["nms"][nm] = tn["nms"].get(nm, 0) + count / num_alignments
+
+            # update hyperloglogs
+            tn["hll"].add(kmer_hashes)
+            tn["totalkmers"] += total_kmers
+
+            # updates substitution tables similarly. so, each entry can go up by up to 1 per read.
+            subssize = tn["subs"].size
+            subcounts = (
+                np.bincount(np.concatenate(currentsubs), minlength=subssize + 5)
+                / num_alignments
+            )
+            tn["subs"] += subcounts[:subssize].reshape(tn["subs"].shape)
+            tn["refcomp"] += subcounts[subssize:]
+
+            if (
+                read is not None
+                and stop_offset is not None
+                and offset_here >= stop_offset
+            ):
+                # the next chunk starts at this read
+                break
 
-            # move on to the next lca entry. re initialize a bunch of things here
+            # move on to the next read. re initialize a bunch of things here
             oldreadname = readname
             oldmd = ""
             oldcigar = ""
             oldflagsum = ""
-            currentlcaline = next(lcafile)
-            currentlcalinenum += 1
-            if progress_bar and (currentlcalinenum % update_interval == 0):
-                progress_bar.update(update_interval)  # Update the progress bar
-            currentsubdict = {}
+            currentsubs = []
+            currentnms = []
             num_alignments = 0
             nms = 0
-            if are_pmds_in_the_bam:
-                pmdsover2 = 0
-                pmdsover4 = 0
+            pmdsover2 = 0
+            pmdsover4 = 0
+
+        if read is None:
+            break
 
         # now for the current alignment.
         # the following might change for different alignments of the same read:
@@ -1029,8 +1566,11 @@ def gather_subs_and_kmers(bamfile_path, lcafile_path, kn, upto, stranded):
         readlength = len(seq)
         cigar = read.cigarstring
         md = read.get_tag("MD")
-        nms += read.get_tag("NM")
-        if are_pmds_in_the_bam:
+        nm = read.get_tag("NM")
+        nms += nm
+        if histograms:
+            currentnms.append(nm)
+        if pmds_in_bam:
             try:
                 pmd = float(read.get_tag("DS"))
             except KeyError:
@@ -1049,33 +1589,274 @@ def gather_subs_and_kmers(bamfile_path, lcafile_path, kn, upto, stranded):
             or (md != oldmd)
             or (flagsum != oldflagsum)
         ):
-            subs, matches, refseq = mismatch_table(seq, cigar, md, flagsum)
+            subs = mismatch_table(seq, read.cigartuples, md, flagsum, max_position)
             oldcigar = cigar
             oldmd = md
             oldflagsum = flagsum
 
-        allsubs = subs + matches
-        for sub in allsubs:
-            key = "".join(str(sub))
-            if key in currentsubdict:
-                currentsubdict[key] += 1
-            else:
-                currentsubdict[key] = 1
+        currentsubs.append(subs)
 
-        # quick catch for the starting read; check if the first read (and then presumably the whole bam) has a pmd score
         if oldreadname == "":
             oldreadname = readname
-            try:
-                pmd = float(read.get_tag("DS"))
-            except KeyError:
-                are_pmds_in_the_bam = False
+
+    readswithNs += add_dust_batch(dustbatch)
+
+    return {
+        "node_data": node_data,
+        "node_parent": node_parent,
+        "node_depth": node_depth,
+        "lcalinesskipped": lcalinesskipped,
+        "readswithNs": readswithNs,
+        "lcalines": lcalines,
+    }
+
+
+def plan_compute_chunks(
+    bamfile_path, lcafile_path, bam_offset, lca_offset, chunk_bytes
+):
+    # splits compute into chunks of about chunk_bytes of compressed bam, as (bam virtual offset, lca byte offset, bam virtual offset of the next chunk) triples.
+    # a chunk holds the reads whose first alignment is in a bgzf block starting within its chunk_bytes, so the chunks only depend on the bam and not on
+    # the number of processes. each split only reads a couple of bgzf blocks around it (see find_read_start) and searches the lca for one read name,
+    # so this does not go through every alignment. the lca part of a chunk starts right after the lca line of the last read of the previous chunk.
+    bamsize = os.path.getsize(bamfile_path)
+    boundary = (bam_offset >> 16) + chunk_bytes
+    if boundary >= bamsize or os.path.getsize(lcafile_path) == 0:
+        yield bam_offset, lca_offset, None
+        return
+    with pysam.AlignmentFile(bamfile_path, "rb", require_index=False) as bamfile:
+        with open(bamfile_path, "rb") as rawbam, open(lcafile_path, "rb") as lcafile:
+            with mmap.mmap(lcafile.fileno(), 0, access=mmap.ACCESS_READ) as lcadata:
+                n_ref = bamfile.nreferences
+                while boundary < bamsize:
+                    blockstart = find_bgzf_block(rawbam, bamsize, boundary)
+                    boundary = blockstart + chunk_bytes
+                    found = find_read_start(bamfile, rawbam, bamsize, blockstart, n_ref)
+                    if found is None or found[0] <= bam_offset:
+                        continue  # can't split here, so this chunk just gets bigger
+                    split_offset, lastreadname = found
+                    split_lca_offset = find_lca_line_end(
+                        lcadata, lastreadname.encode(), lca_offset
+                    )
+                    if split_lca_offset is None:
+                        break  # let the chunk itself complain about this
+                    yield bam_offset, lca_offset, split_offset
+                    bam_offset, lca_offset = split_offset, split_lca_offset
+    yield bam_offset, lca_offset, None
+
+
+def find_read_start(bamfile, rawbam, bamsize, blockstart, n_ref):
+    # finds the first read in a bam whose first alignment is in the bgzf block starting at file offset blockstart or after it, and returns
+    # its virtual offset along with the name of the read before it (or None if there isn't one, or no alignment to start from could be found).
+    # bamfile is the bam opened with pysam and rawbam the same file opened in binary mode. a bgzf block needn't start with an alignment,
+    # so this finds one in the block before (see looks_like_bam_record), checks it with pysam and reads on from there.
+    # blocks are at most 64kb, so the block before starts within 64kb and the blocks from there chain up to this one
+    prevblock = find_bgzf_block(rawbam, bamsize, max(blockstart - (1 << 16), 0))
+    while True:
+        rawbam.seek(prevblock)
+        header = rawbam.read(18)
+        if len(header) < 18:
+            return None
+        nextblock = prevblock + int.from_bytes(header[16:18], "little") + 1
+        if nextblock >= blockstart:
+            break
+        prevblock = nextblock
+    if nextblock != blockstart:
+        return None
+    data = zlib.decompress(rawbam.read(nextblock - prevblock - 18)[:-8], -15)
+
+    for start in range(len(data) - 36):
+        l_read_name = data[start + 12]
+        if (
+            l_read_name < 2
+            or not looks_like_bam_record(data, start, l_read_name, n_ref)
+            or data[start + 35 + l_read_name] != 0
+        ):
+            continue
+        bamfile.seek((prevblock << 16) | start)
+        try:
+            read = next(bamfile, None)
+        except (OSError, ValueError):
+            continue
+        if (
+            read is not None
+            and read.query_name.encode() == data[start + 36 : start + 35 + l_read_name]
+        ):
+            break
+    else:
+        return None
+
+    readname = read.query_name
+    while True:
+        offset_here = bamfile.tell()
+        read = next(bamfile, None)
+        if read is None:
+            return None
+        if offset_here >> 16 >= blockstart and read.query_name != readname:
+            return offset_here, readname
+        readname = read.query_name
+
+
+def find_lca_line_end(lcadata, readname, start):
+    # returns the byte offset right after the lca line of a read, searching lca data from the line starting at byte offset start,
+    # or None if the read isn't there
+    pattern = b"\n" + readname + b":"
+    linestart = start
+    while True:
+        lineend = lcadata.find(b"\n", linestart)
+        lineend = len(lcadata) if lineend == -1 else lineend + 1
+        line = lcadata[linestart:lineend]
+        if (
+            line.startswith(readname + b":")
+            and line[: line.find(b"\t")].rsplit(b":", 3)[0] == readname
+        ):
+            return lineend
+        linestart = lcadata.find(pattern, linestart)
+        if linestart == -1:
+            return None
+        linestart += 1
+
+
+def add_dust_batch(dustbatch):
+    # scores a batch of reads with calculate_dusts and adds them to their nodes in order, then empties the batch.
+    # reads with non-ACGT characters don't get a dust score; returns how many of those there were
+    readswithNs = 0
+    for (tn, seq), dust in zip(
+        dustbatch, calculate_dusts([seq for tn, seq in dustbatch])
+    ):
+        if dust != -1:
+            tn["sumdust"] += dust
+            tn["dustreads"] += 1
+        else:
+            readswithNs += 1
+    dustbatch.clear()
+    return readswithNs
+
+
+def merge_chunk_results(total, chunk):
+    # merges the partial node data of a chunk into the running total, in chunk order
+    node_data = total["node_data"]
+    for node, entry in chunk["node_data"].items():
+        if node in node_data:
+            merge_node_entry(node_data[node], entry)
+        else:
+            node_data[node] = entry
+    for node, parent in chunk["node_parent"].items():
+        total["node_parent"].setdefault(node, parent)
+    for node, depth in chunk["node_depth"].items():
+        total["node_depth"].setdefault(node, depth)
+    total["lcalinesskipped"] += chunk["lcalinesskipped"]
+    total["readswithNs"] += chunk["readswithNs"]
+
+
+def gather_subs_and_kmers(
+    bamfile_path,
+    lcafile_path,
+    kn,
+    upto,
+    stranded,
+    threads=1,
+    histograms=False,
+    max_position=subs_max_position,
+):
+    print("\nGathering substitution and kmer metrics per node...")
+    # reads are processed in chunks of a fixed amount of the bam (compute_chunk_bytes, see plan_compute_chunks), each of which gives a partial
+    # node_data holding plain sums. the partials are merged in order, so the output does not depend on how many processes are used;
+    # with threads > 1 the chunks are spread over a process pool.
+
+    lcaheaderlines, lca_offset = find_lca_header(lcafile_path)
+
+    # check if the first read (and then presumably the whole bam) has a pmd score
+    with pysam.AlignmentFile(bamfile_path, "rb", require_index=False) as bamfile:
+        bam_offset = bamfile.tell()
+        firstread = next(bamfile, None)
+        are_pmds_in_the_bam = firstread is None or firstread.has_tag("DS")
+
+    progress_bar = None
+    if tqdm_imported:
+        totallcalines = line_count(lcafile_path)
+        # should be super fast compared to anything else; probably worth it to initiate a progress bar.
+        progress_bar = tqdm(total=totallcalines - lcaheaderlines, unit="lines")
+
+    total = {
+        "node_data": {},
+        "node_parent": {},
+        "node_depth": {},
+        "lcalinesskipped": 0,
+        "readswithNs": 0,
+    }
+    chunkargs = (bamfile_path, lcafile_path, kn, upto, are_pmds_in_the_bam)
+
+    def add_chunk(chunk):
+        merge_chunk_results(total, chunk)
+        if progress_bar:
+            progress_bar.update(chunk["lcalines"])
+
+    chunks = plan_compute_chunks(
+        bamfile_path, lcafile_path, bam_offset, lca_offset, compute_chunk_bytes
+    )
+    if threads > 1:
+        # keep a bounded number of chunks in flight, so finished partials don't pile up in memory
+        with concurrent.futures.ProcessPoolExecutor(max_workers=threads) as pool:
+            pending = collections.deque()
+            for chunk_bam_offset, chunk_lca_offset, stop_offset in chunks:
+                pending.append(
+                    pool.submit(
+                        gather_subs_and_kmers_chunk,
+                        *chunkargs,
+                        chunk_bam_offset,
+                        chunk_lca_offset,
+                        stop_offset,
+                        histograms,
+                        max_position,
+                    )
+                )
+                while len(pending) > 2 * threads:
+                    add_chunk(pending.popleft().result())
+            while pending:
+                add_chunk(pending.popleft().result())
+    else:
+        for chunk_bam_offset, chunk_lca_offset, stop_offset in chunks:
+            add_chunk(
+                gather_subs_and_kmers_chunk(
+                    *chunkargs,
+                    chunk_bam_offset,
+                    chunk_lca_offset,
+                    stop_offset,
+                    histograms,
+                    max_position,
+                )
+            )
 
     if progress_bar:
         progress_bar.close()
 
-    bamfile.close()
-    lcafile.close()
+    node_data = finish_node_data(total)
+
+    return node_data, are_pmds_in_the_bam
+
+
+def find_lca_header(lcafile_path):
+    # returns the number of header lines in an lca file and the byte offset of the first read line after them
+    lcaheaderlines = 0
+    with open(lcafile_path, "r") as lcafile:
+        for lcaline in lcafile:
+            if "root" in lcaline and "#" not in lcaline:
+                break
+            lcaheaderlines += 1
+    with open(lcafile_path, "rb") as lcafile:
+        for _ in range(lcaheaderlines):
+            lcafile.readline()
+        lca_offset = lcafile.tell()
+    return lcaheaderlines, lca_offset
+
 
+def finish_node_data(total):
+    # rolls the merged per-node sums up the taxonomy and reports anything that was skipped along the way
+    node_data = total["node_data"]
+    roll_up_node_data(node_data, total["node_parent"], total["node_depth"])
+
+    lcalinesskipped = total["lcalinesskipped"]
+    readswithNs = total["readswithNs"]
     if lcalinesskipped > 0:
         print(
             "\nWarning: "
@@ -1097,70 +1878,117 @@ def gather_subs_and_kmers(bamfile_path, lcafile_path, kn, upto, stranded):
         + " taxonomic nodes. Now sorting and writing output files... "
     )
 
-    return node_data, are_pmds_in_the_bam
-
+    return node_data
 
-def format_subs(subs, nreads):
-    formatted_subs = []
 
-    for key, value in subs.items():
-        # extract position and check if it is within the range -15 to 15 (more is unnecessary for damage)
-        # easy to remove the condition if you want to write all of the subs though!
-        parts = key.strip("[]").replace("'", "").split(", ")
-        pos = int(parts[2])
-        if (
-            (-15 <= pos <= 15)
-            and (parts[0] in {"A", "C", "T", "G"})
-            and (parts[1] in {"A", "C", "T", "G"})
-        ):
-            formatted_key = "".join(parts)
-            formatted_value = round(value / nreads, 3)
-            formatted_subs.append((pos, f"{formatted_key}:{formatted_value}"))
-            formatted_subs.sort(key=lambda x: (x[0] > 0, (x[0])))
-
-    return " ".join(sub[1] for sub in formatted_subs)
+def gather_subs_and_kmers_while_shrinking(
+    original_bam_path,
+    short_lca_path,
+    short_bam_path,
+    stranded,
+    minsimilarity,
+    annotate_pmd,
+    totallcalines,
+    kn,
+    upto,
+    threads=1,
+    compression_level=None,
+    histograms=False,
+    max_position=subs_max_position,
+):
+    # does the bam half of shrink and all of compute in a single pass for bamdam run: the alignments kept by filter_bam_reads
+    # go straight into the per-node sums instead of being written to a short bam and read back in.
+    # the short bam is still written along the way if short_bam_path is given. the output is the same as shrink followed by compute.
+    print(
+        "\nFiltering the bam file and gathering substitution and kmer metrics per node in the same pass..."
+    )
 
+    with pysam.AlignmentFile(
+        original_bam_path, "rb", check_sq=False, require_index=False, threads=threads
+    ) as infile:
+        outfile = None
+        if short_bam_path:
+            outfile = pysam.AlignmentFile(
+                short_bam_path,
+                "wb",
+                header=infile.header,
+                threads=threads,
+                format_options=bam_format_options(compression_level),
+            )
 
-def calculate_node_damage(subs, stranded):
-    # also in here calculate the avg gc content of the reference
+        lcaheaderlines, lca_offset = find_lca_header(short_lca_path)
+        bamreads = filter_bam_reads(
+            infile,
+            read_lca_lines(short_lca_path, lca_offset),
+            stranded,
+            minsimilarity,
+            annotate_pmd,
+            totallcalines - lcaheaderlines,
+        )
+        # check if the first kept read (and then presumably all of them) has a pmd score, as compute would on the short bam
+        firstread = next(bamreads, None)
+        are_pmds_in_the_bam = firstread is None or firstread.has_tag("DS")
+        if firstread is not None:
+            bamreads = itertools.chain([firstread], bamreads)
+
+        def kept_alignments():
+            for bamread in bamreads:
+                if outfile is not None:
+                    outfile.write(bamread)
+                yield None, bamread
+
+        with open(short_lca_path, "rb") as lcafile:
+            lcafile.seek(lca_offset)
+            total = accumulate_node_data(
+                kept_alignments(),
+                lcafile,
+                lca_offset,
+                kn,
+                upto,
+                are_pmds_in_the_bam,
+                None,
+                histograms,
+                max_position,
+            )
+        if outfile is not None:
+            outfile.close()
+            print("Wrote a filtered bam file.")
 
-    ctp1 = 0  # C>T at 5' position 1
-    ctm1 = 0  # C>T at 3' position -1 for ss
-    gam1 = 0  # G>A at 3' position -1 for ds
-    c_p1 = 0  # total C at 5' position 1
-    c_m1 = 0  # total C at 3' position -1 for ss
-    g_m1 = 0  # total G at 3' position -1 for ds
-    total_gc = 0  # gc content in ref
-    total_bases = 0
+    node_data = finish_node_data(total)
 
-    for key, count in subs.items():
-        parts = key.strip("[]").replace("'", "").split(", ")
+    return node_data, are_pmds_in_the_bam
 
-        from_base, to_base, pos = parts[0], parts[1], int(parts[2])
 
-        # 5' end: check for C>T and all Cs at position +1
-        if from_base == "C" and pos == 1:
-            if to_base == "T":
-                ctp1 += count  # C>T at position 1
-            c_p1 += count  # all Cs at position 1
+def format_subs(subs, nreads):
+    # writes the matches and mismatches between A C T and Gs at every position of the subs tensor (max_position from either end of the read, more is unnecessary for damage),
+    # going from -max_position to -1 and then 1 to max_position, as values per read
+    max_position = subs.shape[2] // 2
+    positions = np.concatenate(
+        (np.arange(-max_position, 0), np.arange(1, max_position + 1))
+    )
+    window = subs[:4, :4, positions + max_position - (positions > 0)]
+    formatted_subs = []
+    for p, f, t in zip(*np.nonzero(window.transpose(2, 0, 1))):
+        value = round(float(window[f, t, p]) / nreads, 3)
+        formatted_subs.append(f"{'ACGT'[f]}{'ACGT'[t]}{positions[p]}:{value}")
 
-        # 3' end (ss): check for C>T and all Cs at position -1
-        if stranded == "ss" and from_base == "C" and pos == -1:
-            if to_base == "T":
-                ctm1 += count  # C>T at position -1
-            c_m1 += count  # all Cs at position -1
+    return " ".join(formatted_subs)
 
-        # 3' end (ds): check for G>A and all Gs at position -1
-        if stranded == "ds" and from_base == "G" and pos == -1:
-            if to_base == "A":
-                gam1 += count  # G>A at position -1
-            g_m1 += count  # all Gs at position -1
 
-        # calculate total GC content on the reference
-        if from_base == "C" or from_base == "G":
-            total_gc += count
+def calculate_node_damage(subs, refcomp, stranded):
+    # works on the subs tensor of a node. also in here calculate the avg gc content of the reference, over the whole read
+    A, C, G, T = range(4)
+    p1 = subs.shape[2] // 2  # index of 5' position 1
+    m1 = p1 - 1  # index of 3' position -1
 
-        total_bases += count
+    ctp1 = float(subs[C, T, p1])  # C>T at 5' position 1
+    c_p1 = float(subs[C, :, p1].sum())  # total C at 5' position 1
+    ctm1 = float(subs[C, T, m1])  # C>T at 3' position -1 for ss
+    c_m1 = float(subs[C, :, m1].sum())  # total C at 3' position -1 for ss
+    gam1 = float(subs[G, A, m1])  # G>A at 3' position -1 for ds
+    g_m1 = float(subs[G, :, m1].sum())  # total G at 3' position -1 for ds
+    total_gc = float(subs[[C, G]].sum() + refcomp[[C, G]].sum())  # gc content in ref
+    total_bases = float(subs.sum() + refcomp.sum())
 
     avgrefgc = total_gc / total_bases if total_bases > 0 else 0
 
@@ -1175,7 +2003,7 @@ def calculate_node_damage(subs, stranded):
 
 
 def parse_and_write_node_data(nodedata, tsv_path, subs_path, stranded, pmds_in_bam):
-    # parses a dictionary where keys are node tax ids, and entries are total_reads, meanlength, total_alignments, etc
+    # parses a dictionary where keys are node tax ids, and entries are total_reads, sumlength, total_alignments, etc (see new_node_entry)
 
     statsfile = open(tsv_path, "w", newline="")
     subsfile = open(subs_path, "w", newline="")
@@ -1249,11 +2077,14 @@ def parse_and_write_node_data(nodedata, tsv_path, subs_path, stranded, pmds_in_b
 
         taxname = tn["tax_path"].split(";")[0].split(":")[1]
 
+        # reads with non-ACGT characters don't get a dust score, so they don't count towards the mean
+        avgdust = tn["sumdust"] / tn["dustreads"] if tn["dustreads"] > 0 else 0
+
         # only now calculate damage per node from the subs dict (see output subs file)
         # do not use formatted subs ; these should be raw numbers: how many READS for this taxa have these matches/mismatches?
         # # (avg'd over all the alignments per read, so maybe not an integer)
         # also calculate the gc content for the average ref (so, unbiased by damage), weighted equally by read, not alignment
-        dp1, dm1, avgrefgc = calculate_node_damage(tn["subs"], stranded)
+        dp1, dm1, avgrefgc = calculate_node_damage(tn["subs"], tn["refcomp"], stranded)
 
         # write
         if pmds_in_bam:
@@ -1262,12 +2093,12 @@ def parse_and_write_node_data(nodedata, tsv_path, subs_path, stranded, pmds_in_b
                 taxname,
                 tn["total_reads"],
                 round(duplicity, 3),
-                round(tn["avgdust"], 2),
+                round(avgdust, 2),
                 round(dp1, 4),
                 round(dm1, 4),
-                round(tn["meanlength"], 2),
-                round(tn["ani"], 4),
-                round(tn["avgreadgc"], 3),
+                round(tn["sumlength"] / tn["total_reads"], 2),
+                round(tn["sumani"] / tn["total_reads"], 4),
+                round(tn["sumreadgc"] / tn["total_reads"], 3),
                 round(avgrefgc, 3),
                 numuniquekmers,
                 round(ratiodup, 3),
@@ -1282,12 +2113,12 @@ def parse_and_write_node_data(nodedata, tsv_path, subs_path, stranded, pmds_in_b
                 taxname,
                 tn["total_reads"],
                 round(duplicity, 2),
-                round(tn["avgdust"], 2),
+                round(avgdust, 2),
                 round(dp1, 4),
                 round(dm1, 4),
-                round(tn["meanlength"], 2),
-                round(tn["ani"], 4),
-                round(tn["avgreadgc"], 3),
+                round(tn["sumlength"] / tn["total_reads"], 2),
+                round(tn["sumani"] / tn["total_reads"], 4),
+                round(tn["sumreadgc"] / tn["total_reads"], 3),
                 round(avgrefgc, 3),
                 numuniquekmers,
                 round(ratiodup, 3),
@@ -1312,12 +2143,65 @@ def parse_and_write_node_data(nodedata, tsv_path, subs_path, stranded, pmds_in_b
     print("Wrote final tsv and subs files. Done!")
 
 
+def write_node_histograms(nodedata, hist_path):
+    # writes the read length and NM histograms of every node (see accumulate_node_data) to a sidecar file for plotbaminfo --in_hist.
+    # it's a numpy .npz file: the node ids and names, then the histogram values and counts of every node one after the other, and where each node's start
+    nodes = list(nodedata)
+    length_starts = np.zeros(len(nodes) + 1, dtype=np.int64)
+    length_starts[1:] = np.cumsum([len(nodedata[node]["lengths"]) for node in nodes])
+    nm_starts = np.zeros(len(nodes) + 1, dtype=np.int64)
+    nm_starts[1:] = np.cumsum([len(nodedata[node]["nms"]) for node in nodes])
+    lengths = [sorted(nodedata[node]["lengths"].items()) for node in nodes]
+    nms = [sorted(nodedata[node]["nms"].items()) for node in nodes]
+    with open(
+        hist_path, "wb"
+    ) as histfile:  # (an open file, so numpy doesn't add .npz to the name)
+        np.savez(
+            histfile,
+            nodes=np.array(nodes, dtype=str),
+            names=np.array(
+                [
+                    nodedata[node]["tax_path"].split(";")[0].split(":")[1]
+                    for node in nodes
+                ],
+                dtype=str,
+            ),
+            length_starts=length_starts,
+            length_values=np.array(
+                [value for node in lengths for value, _ in node], dtype=np.int64
+            ),
+            length_counts=np.array(
+                [count for node in lengths for _, count in node], dtype=np.int64
+            ),
+            nm_starts=nm_starts,
+            nm_values=np.array(
+                [value for node in nms for value, _ in node], dtype=np.int64
+            ),
+            nm_freqs=np.array(
+                [freq for node in nms for _, freq in node], dtype=np.float64
+            ),
+        )
+    print(
+        f"Wrote read length and mismatch histograms of {len(nodes)} nodes to {hist_path}."
+    )
+
+
 def extract_reads(
-    in_lca, in_bam, out_bam, tax, subset_header=False, only_top_ref=False
+    in_lca,
+    in_bam,
+    out_bams,
+    taxa,
+    subset_header=False,
+    only_top_ref=False,
+    threads=1,
+    compression_level=None,
+    index=None,
+    exact_node=False,
 ):
-    # extracts all reads with a tax path containing a certain keyword.
-    # also optionally shortens the header to only necessary ids.
-    # subsetting the header is kinda slow because it requires running through the input twice.
+    # extracts all reads assigned to the node given by a keyword or underneath it (see tax_line_matcher), for each keyword in taxa, into the bam at the same place in out_bams.
+    # all the keywords are done together in a single pass over the bam, and a read goes to every output it matches.
+    # also optionally shortens the headers to only necessary ids.
+    # if there is a tax index for the bam (see write_tax_index), keywords which are tax ids in it are done first, straight from where the index says their alignments are.
 
     if only_top_ref and not subset_header:
         print(
@@ -1325,94 +2209,629 @@ def extract_reads(
         )
         sys.exit()
 
-    # parse keyword.
-    # if you gave in a tax id as a digit, you probably are referring to the tax id and don't want to also get paths with the keyword as a substring of another tax id (eg you gave 200 and you get 2001)
-    tax_pattern = f"[[:space:]]{tax}:" if tax.isdigit() else tax
-
-    # if you don't need to subset the header and you're happy with keeping all the refs, this is easy.
-    # in this case, the fastest way to do this is to pass samtools a file of read names.
-    if not subset_header and not only_top_ref:
-        # essentially this is a wrapper for grep / awk / samtools view (with the samtools inside pysam).
-        # writes (then later deletes) a temp file with readnames, because that's what samtools view wants.
-        # actually i did try to do this more cleverly, using the known ordering of bam and lca, but it was slower.
-        hashtax = abs(
-            hash(tax_pattern)
-        )  # ensures no accidental file overwriting; the abs is because sometimes the hash is negative
-        print("Writing a temp file to the current directory. Will delete when done.")
-        tmp_file = f"{out_bam}.{hashtax}.readnames.tmp"
-        # get all the associated read names with the tax keyword
-        grep_command = (
-            f"grep '{tax_pattern}' {in_lca} | awk -F'\\t' '{{print $1}}' "
-            f"| awk -F':' '{{for(i=1; i<=NF-3; i++) printf $i (i<NF-3 ? \":\" : \"\\n\")}}' > {tmp_file}"
+    explicit_index = index is not None
+    if index is None and os.path.exists(f"{in_bam}.taxindex"):
+        index = f"{in_bam}.taxindex"
+    if index is not None and exact_node:
+        print(
+            f"The tax index {index} covers whole subtrees, so it can't be used with --exact_node."
         )
-        # writes all the read names to a temp file
-        result = subprocess.run(grep_command, shell=True)
-        if result.returncode != 0:
-            print(f"No matches found for keyword: {tax} or grep/awk command failed.")
+    elif index is not None and check_tax_index(index, in_bam, in_lca, explicit_index):
+        scanned = []
+        for tax, out_bam in zip(taxa, out_bams):
+            runs = find_tax_index_runs(index, tax)
+            if runs is not None:
+                extract_indexed_reads(
+                    in_bam,
+                    out_bam,
+                    runs,
+                    subset_header,
+                    only_top_ref,
+                    threads,
+                    compression_level,
+                )
+            else:
+                scanned.append((tax, out_bam))
+        if not scanned:
             return
-        pysam.view("-N", tmp_file, "-b", in_bam, "-o", out_bam, catch_stdout=False)
+        taxa, out_bams = zip(*scanned)
+
+    # walk through the lca file alongside the bam (they are in the same read order, as after shrink), sending the alignments of each read to the outputs whose keyword its tax path matches.
+    # with --subset_header, the kept alignments go to temp bams first: which references to keep is only known at the end, and the temp bams are much smaller than the input.
+    matches = tax_line_matcher(taxa, exact_node)
+    lcaheaderlines, lca_offset = find_lca_header(in_lca)
+    if subset_header:
+        print("Writing temp files next to the output bams. Will delete when done.")
+        kept_bams = [f"{out_bam}.tmp" for out_bam in out_bams]
+    else:
+        kept_bams = list(out_bams)
+    nkept = [0] * len(taxa)
+    # (with lots of outputs, giving every one of them its own compression threads would be too many threads)
+    writer_threads = threads if len(taxa) == 1 else 1
+    with pysam.AlignmentFile(
+        in_bam, "rb", check_sq=False, require_index=False, threads=threads
+    ) as bam_in:
+        header = bam_in.header.to_dict()
+        reference_counts = [ReferenceCounts(bam_in.nreferences) for _ in taxa]
+        bam_writers = [
+            pysam.AlignmentFile(
+                kept_bam,
+                "wb",
+                header=bam_in.header,
+                threads=writer_threads,
+                format_options=bam_format_options(
+                    1 if subset_header else compression_level
+                ),  # the temp bams are only read once, so it's not worth compressing them much
+            )
+            for kept_bam in kept_bams
+        ]
+        for read, outputs in select_tax_alignments(
+            bam_in,
+            in_lca,
+            lca_offset,
+            matches,
+            tmp_dir=os.path.dirname(os.path.abspath(out_bams[0])),
+        ):
+            for i in outputs:
+                bam_writers[i].write(read)
+                nkept[i] += 1
+                if subset_header:
+                    reference_counts[i].add(read.reference_id)
+        for bam_writer in bam_writers:
+            bam_writer.close()
+
+    for tax, out_bam, kept_bam, n, reference_count in zip(
+        taxa, out_bams, kept_bams, nkept, reference_counts
+    ):
+        if n == 0:
+            print(f"No matches found for keyword: {tax}")
+            try:
+                os.remove(kept_bam)
+            except OSError as e:
+                print(f"Error removing file: {kept_bam} : {e.strerror}")
+            continue
+        if not subset_header:
+            continue
+
+        outheader = dict(header)  # (each output gets its own SQ lines)
+        new_reference_ids = subset_header_references(
+            outheader, reference_count, only_top_ref
+        )
+        # write the filtered reads with the updated header and re-linked reference IDs
+        with pysam.AlignmentFile(
+            out_bam,
+            "wb",
+            header=outheader,
+            threads=threads,
+            format_options=bam_format_options(compression_level),
+        ) as bam_writer:
+            with pysam.AlignmentFile(
+                kept_bam, "rb", check_sq=False, threads=threads
+            ) as bam_reader_again:
+                for read in bam_reader_again:
+                    # relink the reference_id to match the new header
+                    if read.reference_id >= 0:
+                        new_reference_id = new_reference_ids[read.reference_id]
+                        if new_reference_id < 0:
+                            continue  # skip reads with references not in the new header
+                        read.reference_id = new_reference_id
+                    bam_writer.write(read)
         try:
-            os.remove(tmp_file)
+            os.remove(kept_bam)
         except OSError as e:
-            print(f"Error removing temp file: {tmp_file} : {e.strerror}")
-        return
+            print(f"Error removing temp file: {kept_bam} : {e.strerror}")
+
+
+def tax_line_matcher(taxa, exact_node=False):
+    # returns a function giving the indices of the extract keywords in taxa which an lca line is a match for.
+    # a keyword stands for a node, by its tax id, its full tax string (id:name:level) or its name, and a read matches if it is assigned to that node or anywhere underneath it
+    # (or only to the node itself, with exact_node). ids and names only ever match as a whole, so 200 doesn't get you 2001 and Homo doesn't get you Homo sapiens.
+    # every lca line holds the tax path of its node, so the tree is pieced together from the lines themselves: the first time a node turns up,
+    # its path is matched against the keywords once, and every read assigned to it after that is a single dict lookup
+    keyword_indices = {}
+    for i, tax in enumerate(taxa):
+        keyword_indices.setdefault(tax, []).append(i)
+    node_outputs = {}
+
+    def matches(lcaline):
+        tab_split = lcaline.find("\t")
+        node = lcaline[tab_split + 1 : lcaline.find(":", tab_split + 1)]
+        outputs = node_outputs.get(node)
+        if outputs is None:
+            outputs = set()
+            fields = lcaline[tab_split + 1 :].rstrip("\n").split("\t")
+            for field in fields[:1] if exact_node else fields:
+                splitfields = [part.strip("'").strip('"') for part in field.split(":")]
+                # the tax id, the name and the full tax string of this node on the path
+                for key in {
+                    splitfields[0],
+                    ":".join(splitfields[1:-1]),
+                    ":".join(splitfields),
+                }:
+                    outputs.update(keyword_indices.get(key, ()))
+            outputs = sorted(outputs)
+            node_outputs[node] = outputs
+        return outputs
+
+    return matches
+
+
+def select_tax_alignments(bamfile, in_lca, lca_offset, matches, tmp_dir=None):
+    # yields (alignment, outputs) pairs for the reads whose lca line matches something, where outputs is what matches returned for it,
+    # walking through the lca lines (from byte offset lca_offset) alongside an open bam in the same read order.
+    # a read can be in the lca file but not in the bam (shrink leaves out reads where no alignment meets minsim), so each bam read is looked for up to lca_lookahead_lines lines ahead.
+    # the lines read ahead are kept by read name, so the next reads are found in them without reading anything twice.
+    # a read which isn't within that window is looked up by name in a ReadNameSet of the whole lca file (made the first time it's needed, in tmp_dir):
+    # if it's further ahead, the walk jumps there, and if it isn't in the lca file at all, it's skipped. only if it was already walked past are the two not in the same order after all
+    # (e.g. the bam was read-sorted again after the lca was made), and then the rest of the reads are looked up by name
+    lcalines = read_lca_line_spans(in_lca, lca_offset)
+    # read name -> (start, end, lca line) for the lines read ahead
+    ahead = collections.OrderedDict()
+    walked_to = lca_offset  # where the first line not yet walked past starts
+    nameset = None
+    unordered = False
+    skipped = 0
+    oldreadname = None
+    outputs = []
+    try:
+        for read in bamfile:
+            if read.query_name != oldreadname:
+                oldreadname = read.query_name
+                lcaline = None
+                if not unordered:
+                    span = ahead.pop(oldreadname, None)
+                    if span is not None:
+                        # walk past the lines before it too (reads which aren't in the bam)
+                        while ahead and next(iter(ahead.values()))[0] < span[0]:
+                            ahead.popitem(last=False)
+                    while span is None and len(ahead) < lca_lookahead_lines:
+                        span = next(lcalines, None)
+                        if span is None:
+                            break
+                        lcaname = span[2][: span[2].find("\t")].rsplit(":", 3)[0]
+                        if lcaname != oldreadname:
+                            ahead[lcaname] = span
+                            span = None
+                        else:
+                            ahead.clear()
+                    if span is not None:
+                        walked_to = span[1]
+                        lcaline = span[2]
+                if lcaline is None:
+                    if nameset is None:
+                        print(
+                            f"The read {oldreadname} is not in the next {lca_lookahead_lines} lines of the lca file, so looking it up by name instead."
+                        )
+                        nameset = ReadNameSet(in_lca, lca_offset, tmp_dir)
+                    located = nameset.locate(oldreadname)
+                    if located is None:
+                        skipped += 1
+                    elif unordered:
+                        lcaline = located[1]
+                    elif located[0] >= walked_to:
+                        # further ahead than we looked, so jump there
+                        lcaline = located[1]
+                        walked_to = located[0] + len(lcaline.encode())
+                        ahead.clear()
+                        lcalines.close()
+                        lcalines = read_lca_line_spans(in_lca, walked_to)
+                    else:
+                        print(
+                            f"The read {oldreadname} is not in the same place in the bam and lca files, so looking up the rest of the reads by name instead (slower)."
+                        )
+                        unordered = True
+                        ahead.clear()
+                        lcaline = located[1]
+                outputs = matches(lcaline) if lcaline is not None else []
+            if outputs:
+                yield read, outputs
+        if skipped:
+            print(
+                f"Skipped {skipped} reads which are in the bam file but not in the lca file."
+            )
+    finally:
+        lcalines.close()
+        if nameset is not None:
+            nameset.close()
+
+
+class ReadNameSet:
+    # the reads of an lca file from some byte offset on, kept as sorted 64 bit hashes of their names next to the byte offsets of their lca lines.
+    # that's 16 bytes a read, where a python set of the names would take over 100 (the names are ~40 characters). the two arrays are kept in a temp file in tmp_dir (as a numpy memmap)
+    # rather than in memory, and sorted there a bucket at a time (see sort_read_name_hashes), so memory stays bounded however many reads there are.
+    # hashes can collide, so a hit is checked against the name on the lca line it points to, which makes lookups exact (and gives back the line)
+
+    def __init__(self, lcafile_path, lca_offset, tmp_dir=None):
+        # the hashes and offsets go to a temp file unsorted as they're read, read_name_set_run reads at a time
+        unsortedfile = tempfile.TemporaryFile(dir=tmp_dir)
+        hashes = array.array("Q")
+        offsets = array.array("Q")
+        nreads = 0
+        with open(lcafile_path, "rb") as lcafile:
+            lcafile.seek(lca_offset)
+            offset = lca_offset
+            for rawline in lcafile:
+                readname = rawline[: rawline.find(b"\t")].rsplit(b":", 3)[0]
+                hashes.append(read_name_hash(readname))
+                offsets.append(offset)
+                if len(hashes) == read_name_set_run:
+                    nreads += write_read_name_run(unsortedfile, hashes, offsets)
+                    hashes = array.array("Q")
+                    offsets = array.array("Q")
+                offset += len(rawline)
+        nreads += write_read_name_run(unsortedfile, hashes, offsets)
+        del hashes, offsets
+
+        self.lcafile = open(lcafile_path, "rb")
+        self.tmpfile = tempfile.TemporaryFile(dir=tmp_dir)
+        if nreads == 0:  # (numpy can't map an empty file)
+            self.hashes = np.zeros(0, dtype=np.uint64)
+            self.offsets = np.zeros(0, dtype=np.uint64)
+        else:
+            unsortedfile.flush()
+            unsorted = np.memmap(
+                unsortedfile, dtype=np.uint64, mode="r", shape=(nreads, 2)
+            )
+            self.tmpfile.truncate(2 * nreads * 8)
+            table = np.memmap(
+                self.tmpfile, dtype=np.uint64, mode="r+", shape=(2, nreads)
+            )
+            sort_read_name_hashes(unsorted, table)
+            del unsorted
+            self.hashes = np.asarray(table[0])
+            self.offsets = np.asarray(table[1])
+        unsortedfile.close()
+
+    def locate(self, readname):
+        # returns the byte offset and lca line of a read, or None if it isn't in the set
+        readhash = read_name_hash(readname.encode())
+        i = int(np.searchsorted(self.hashes, readhash))
+        while i < len(self.hashes) and self.hashes[i] == readhash:
+            offset = int(self.offsets[i])
+            self.lcafile.seek(offset)
+            lcaline = self.lcafile.readline().decode()
+            if lcaline[: lcaline.find("\t")].rsplit(":", 3)[0] == readname:
+                return offset, lcaline
+            i += 1
+        return None
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def close(self):
+        self.lcafile.close()
+        self.hashes = None
+        self.offsets = None
+        self.tmpfile.close()
+
+
+def write_read_name_run(file, hashes, offsets):
+    # appends (hash, offset) pairs to a ReadNameSet temp file, and returns how many there were
+    np.column_stack(
+        (
+            np.frombuffer(hashes, dtype=np.uint64),
+            np.frombuffer(offsets, dtype=np.uint64),
+        )
+    ).tofile(file)
+    return len(hashes)
+
+
+def sort_read_name_hashes(unsorted, table):
+    # sorts the (hash, offset) pairs of a ReadNameSet from unsorted (an n x 2 array) into table (2 x n, hashes then offsets), by hash.
+    # the hashes are uniformly random, so splitting them by their top bits gives buckets of about the same size, each of which covers one range of hashes:
+    # the pairs are first copied into their buckets, read_name_set_run at a time, and then each bucket (about read_name_set_run pairs) is sorted by itself.
+    # ties keep the order of the lca file
+    nreads = len(unsorted)
+    bits = ((nreads - 1) // read_name_set_run).bit_length()
+    nbuckets = 1 << bits
+
+    def bucket_of(chunk):
+        if bits == 0:
+            return np.zeros(len(chunk), dtype=np.int64)
+        return (chunk[:, 0] >> np.uint64(64 - bits)).astype(np.int64)
+
+    bucket_counts = np.zeros(nbuckets, dtype=np.int64)
+    for start in range(0, nreads, read_name_set_run):
+        chunk = np.array(unsorted[start : start + read_name_set_run])
+        bucket_counts += np.bincount(bucket_of(chunk), minlength=nbuckets)
+    bucket_starts = np.zeros(nbuckets + 1, dtype=np.int64)
+    np.cumsum(bucket_counts, out=bucket_starts[1:])
+
+    bucket_ends = bucket_starts[:-1].copy()
+    for start in range(0, nreads, read_name_set_run):
+        chunk = np.array(unsorted[start : start + read_name_set_run])
+        buckets = bucket_of(chunk)
+        order = np.argsort(buckets, kind="stable")
+        chunk = chunk[order]
+        chunk_bounds = np.searchsorted(buckets[order], np.arange(nbuckets + 1))
+        for bucket in np.flatnonzero(np.diff(chunk_bounds)):
+            lo, hi = chunk_bounds[bucket], chunk_bounds[bucket + 1]
+            end = bucket_ends[bucket]
+            table[0, end : end + hi - lo] = chunk[lo:hi, 0]
+            table[1, end : end + hi - lo] = chunk[lo:hi, 1]
+            bucket_ends[bucket] += hi - lo
+
+    for bucket in range(nbuckets):
+        lo, hi = bucket_starts[bucket], bucket_starts[bucket + 1]
+        hashes = np.array(table[0, lo:hi])
+        order = np.argsort(hashes, kind="stable")
+        table[0, lo:hi] = hashes[order]
+        table[1, lo:hi] = table[1, lo:hi][order]
+    table.flush()
+
+
+def read_name_hash(readname):
+    # 64 bit hash of a read name (as bytes)
+    return int.from_bytes(hashlib.blake2b(readname, digest_size=8).digest(), "little")
+
+
+class ReferenceCounts:
+    # counts alignments per reference id for extract --subset_header, in an array with a count for every reference in the header.
+    # the ids are gathered into arrays and added a batch at a time with np.bincount. also remembers where each reference was first hit,
+    # so a tie for the most common reference goes to the one seen first
+
+    def __init__(self, nreferences):
+        self.counts = np.zeros(nreferences, dtype=np.int64)
+        # alignment number of the first hit on each reference, counting from 1 (0 if it hasn't been hit)
+        self.first_hit = np.zeros(nreferences, dtype=np.int64)
+        self.batch = array.array("i")
+        self.nseen = 0
+
+    def add(self, reference_id):
+        if reference_id >= 0:  # (unmapped)
+            self.batch.append(reference_id)
+            if len(self.batch) >= reference_batch_size:
+                self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+        batch = np.frombuffer(self.batch, dtype=np.int32)
+        counts = np.bincount(batch)
+        self.counts[: len(counts)] += counts
+        # references hit for the first time: if one is hit more than once in this batch, the earliest hit wins
+        new = self.first_hit[batch] == 0
+        if new.any():
+            newids = batch[new]
+            self.first_hit[newids] = np.iinfo(np.int64).max
+            np.minimum.at(self.first_hit, newids, self.nseen + 1 + np.flatnonzero(new))
+        self.nseen += len(self.batch)
+        self.batch = array.array("i")
+
+    def hit_references(self):
+        # the ids of the references with any alignments, in order
+        self.flush()
+        return np.flatnonzero(self.counts).tolist()
+
+    def most_common(self):
+        # the reference id with the most alignments (the first one hit on a tie), or None if no alignment was on a reference
+        self.flush()
+        if self.counts.size == 0 or self.counts.max() == 0:
+            return None
+        top = np.flatnonzero(self.counts == self.counts.max())
+        return int(top[np.argmin(self.first_hit[top])])
+
+
+def subset_header_references(header, reference_counts, only_top_ref):
+    # cuts the SQ lines of a header dict down to the references hit in reference_counts (or just the most common one, with only_top_ref),
+    # and returns a list from old reference id to new reference id (-1 for references that were dropped)
+    reference_counts.flush()
+    sqlines = header.get("SQ", [])
+    if only_top_ref:
+        # find the most common reference
+        most_common_reference = reference_counts.most_common()
+        if most_common_reference is None:
+            print(
+                "None of the extracted alignments are on a reference, so your output bam header will have no references."
+            )
+            kept_references = []
+        else:
+            print(
+                f"The most common reference is {sqlines[most_common_reference]['SN']} with {int(reference_counts.counts[most_common_reference])} alignments."
+            )
+            print(
+                f"Your output bam will contain all alignments to this reference, even if there is more than one per read."
+            )
+            kept_references = [most_common_reference]
+    else:  # get all the headers matching all of the refs
+        kept_references = reference_counts.hit_references()
+    header["SQ"] = [sqlines[reference_id] for reference_id in kept_references]
+
+    # important step: we have to re-link the reference IDs in each read row to the new header because of how the bam compression works
+    new_reference_ids = [-1] * len(sqlines)
+    for new_reference_id, reference_id in enumerate(kept_references):
+        new_reference_ids[reference_id] = new_reference_id
+    return new_reference_ids
+
+
+def write_tax_index(in_bam, in_lca, out_index, upto, threads=1):
+    # goes through a read-sorted bam and its lca file once (e.g. the output of shrink), and writes a sidecar index of where the alignments of each node's reads are in the bam.
+    # every node is indexed along with its ancestors up to upto, like in compute. the alignments of a node are stored as runs of bgzf virtual offsets [start, end):
+    # reads which sit next to each other in the bam share a run, so a node whose reads are all together is a single run.
+    # the index is a numpy .npz file: the node ids, the runs of every node one after the other, where each node's runs start,
+    # and the size and modification time of the bam and the lca file, along with the lca path (to catch stale indexes, see check_tax_index)
+    print(f"\nIndexing the alignments of each node in {in_bam}...")
+    node_runs = {}
+    lcaheaderlines, lca_offset = find_lca_header(in_lca)
+    lcalines = read_lca_lines(in_lca, lca_offset)
+    progress_bar = (
+        tqdm(total=line_count(in_lca) - lcaheaderlines, unit="lines")
+        if tqdm_imported
+        else None
+    )
+
+    def add_read(readname, start, end):
+        # find the lca line of the read and add [start, end) to all of its nodes
+        for lcaline in lcalines:
+            if progress_bar:
+                progress_bar.update(1)
+            lcaentry = lcaline.split("\t")
+            if lcaentry[0].rsplit(":", 3)[0] == readname:
+                break
+        else:
+            print(
+                f"Error: The read {readname} is in the bam file but could not be found in the lca file. Are they in the same order?"
+            )
+            sys.exit(-1)
+        for field in lcaentry[1:]:
+            splitfields = field.split(":")
+            node = splitfields[0].strip("'").strip('"')
+            runs = node_runs.get(node)
+            if runs is None:
+                node_runs[node] = [start, end]
+            elif runs[-1] == start:
+                runs[-1] = (
+                    end  # right after this node's last read, so extend its last run
+                )
+            else:
+                runs += [start, end]
+            if splitfields[2].strip("'").strip('"').strip() == upto:
+                break
+
+    with pysam.AlignmentFile(
+        in_bam, "rb", check_sq=False, require_index=False, threads=threads
+    ) as bamfile:
+        oldreadname = None
+        readstart = None
+        for offset_here, read in bam_alignments(bamfile):
+            if read.query_name != oldreadname:
+                if oldreadname is not None:
+                    add_read(oldreadname, readstart, offset_here)
+                oldreadname = read.query_name
+                readstart = offset_here
+        if oldreadname is not None:
+            add_read(oldreadname, readstart, bamfile.tell())
+    if progress_bar:
+        progress_bar.close()
+
+    bam_stat = os.stat(in_bam)
+    lca_stat = os.stat(in_lca)
+    nodes = list(node_runs)
+    run_starts = np.zeros(len(nodes) + 1, dtype=np.int64)
+    run_starts[1:] = np.cumsum([len(node_runs[node]) // 2 for node in nodes])
+    runs = np.fromiter(
+        itertools.chain.from_iterable(node_runs[node] for node in nodes),
+        dtype=np.uint64,
+        count=2 * int(run_starts[-1]),
+    ).reshape(-1, 2)
+    with open(
+        out_index, "wb"
+    ) as indexfile:  # (an open file, so numpy doesn't add .npz to the name)
+        np.savez(
+            indexfile,
+            nodes=np.array(nodes, dtype=str),
+            run_starts=run_starts,
+            runs=runs,
+            bam_size=np.int64(bam_stat.st_size),
+            bam_mtime=np.int64(bam_stat.st_mtime_ns),
+            lca_path=np.str_(os.path.abspath(in_lca)),
+            lca_size=np.int64(lca_stat.st_size),
+            lca_mtime=np.int64(lca_stat.st_mtime_ns),
+            upto=np.str_(upto),
+        )
+    print(f"Wrote an index of {len(nodes)} nodes to {out_index}. Done! \n")
+
 
-    # otherwise, we gotta deal with keeping the read names in memory. go get all the relevant references
-    grep_command = (
-        f"grep '{tax_pattern}' {in_lca} | awk -F'\\t' '{{print $1}}' "
-        f"| awk -F':' '{{for(i=1; i<=NF-3; i++) printf $i (i<NF-3 ? \":\" : \"\\n\")}}'"
-    )
-    result = subprocess.run(grep_command, shell=True, capture_output=True, text=True)
-    if result.returncode != 0:
-        print(f"No matches found for keyword: {tax} or grep/awk command failed.")
-        return
-    read_names = set(result.stdout.strip().splitlines())
+def check_tax_index(index, in_bam, in_lca, explicit):
+    # whether a tax index (see write_tax_index) still matches the bam and lca file, so extract_reads can trust it instead of the lca file.
+    # an index found next to the bam is only used if it was made from this same lca file. one given with --index may have been made from a copy
+    # of the lca file somewhere else, so then the lca file just has to be the same size
+    bam_stat = os.stat(in_bam)
+    lca_stat = os.stat(in_lca)
+    with np.load(index) as taxindex:
+        if "lca_path" not in taxindex.files:
+            print(
+                f"Warning: The tax index {index} was made by an older version of bamdam and can't be checked against {in_lca}. Not using it; rerun bamdam index."
+            )
+            return False
+        if (
+            int(taxindex["bam_size"]) != bam_stat.st_size
+            or int(taxindex["bam_mtime"]) != bam_stat.st_mtime_ns
+        ):
+            print(
+                f"Warning: The tax index {index} does not match {in_bam} (was the bam changed after indexing?). Not using it."
+            )
+            return False
+        same_lca = str(taxindex["lca_path"]) == os.path.abspath(in_lca)
+        if not same_lca and not explicit:
+            print(
+                f"The tax index {index} was made from {taxindex['lca_path']}, not {in_lca}, so not using it. Give it with --index to use it anyway."
+            )
+            return False
+        if int(taxindex["lca_size"]) != lca_stat.st_size or (
+            same_lca and int(taxindex["lca_mtime"]) != lca_stat.st_mtime_ns
+        ):
+            print(
+                f"Warning: The tax index {index} does not match {in_lca} (was the lca file changed after indexing?). Not using it."
+            )
+            return False
+    return True
 
-    with pysam.AlignmentFile(in_bam, "rb") as bam_in:
-        header = bam_in.header.to_dict()
-        reference_count = {}
 
-        for read in bam_in:
-            if read.query_name in read_names:
-                ref_name = bam_in.get_reference_name(read.reference_id)
-                if ref_name:
-                    reference_count[ref_name] = reference_count.get(ref_name, 0) + 1
-    if only_top_ref:
-        # find the most common reference
-        most_common_reference = max(reference_count, key=reference_count.get)
+def find_tax_index_runs(index, tax):
+    # looks up the runs of bgzf virtual offsets of a tax id in a tax index (see write_tax_index), once check_tax_index has passed.
+    # returns None if the index can't be used for it, so extract_reads falls back to looking through the whole lca and bam
+    if not tax.isdigit():
         print(
-            f"The most common reference is {most_common_reference} with {reference_count[most_common_reference]} alignments."
+            f"The keyword {tax} is not a tax id, so the tax index {index} can't be used."
         )
-        print(
-            f"Your output bam will contain all alignments to this reference, even if there is more than one per read."
-        )
-        header["SQ"] = [
-            sq for sq in header.get("SQ", []) if sq["SN"] == most_common_reference
-        ]
-        reference_names = {most_common_reference}
-    else:  # get all the headers matching all of the refs
-        reference_names = set(reference_count.keys())
-        header["SQ"] = [
-            sq for sq in header.get("SQ", []) if sq["SN"] in reference_names
-        ]
+        return None
+    with np.load(index) as taxindex:
+        hits = np.flatnonzero(taxindex["nodes"] == tax)
+        if len(hits) == 0:
+            print(
+                f"The tax id {tax} is not in the tax index {index} (it was made with --upto {taxindex['upto']}), so not using it."
+            )
+            return None
+        run_starts = taxindex["run_starts"]
+        print(f"Using the tax index {index}.")
+        return taxindex["runs"][run_starts[hits[0]] : run_starts[hits[0] + 1]].tolist()
+
+
+def indexed_alignments(bamfile, runs):
+    # yields the alignments in the runs of bgzf virtual offsets [start, end) from a tax index, in bam order.
+    # a seek decompresses the whole bgzf block again, so runs which start in the block we're already in are just read up to instead
+    for start, end in runs:
+        offset_here = bamfile.tell()
+        if start >> 16 != offset_here >> 16 or start < offset_here:
+            bamfile.seek(start)
+        else:
+            while bamfile.tell() < start:
+                next(bamfile)
+        while bamfile.tell() < end:
+            yield next(bamfile)
 
-    # important step: we have to re-link the reference IDs in each read row to the new header because of how the bam compression works
-    ref_name_to_id = {sq["SN"]: idx for idx, sq in enumerate(header.get("SQ", []))}
-    # write the filtered reads with the updated header and re-linked reference IDs
-    with pysam.AlignmentFile(out_bam, "wb", header=header) as bam_writer:
-        with pysam.AlignmentFile(in_bam, "rb") as bam_reader_again:
-            for read in bam_reader_again:
-                if read.query_name in read_names:
+
+def extract_indexed_reads(
+    in_bam, out_bam, runs, subset_header, only_top_ref, threads, compression_level
+):
+    # the tax index version of extract_reads: seeks straight to the alignments of the node instead of reading the whole bam (twice, to subset the header)
+    with pysam.AlignmentFile(
+        in_bam, "rb", check_sq=False, require_index=False, threads=threads
+    ) as bam_in:
+        header = bam_in.header.to_dict()
+        if subset_header:
+            reference_counts = ReferenceCounts(bam_in.nreferences)
+            for read in indexed_alignments(bam_in, runs):
+                reference_counts.add(read.reference_id)
+            new_reference_ids = subset_header_references(
+                header, reference_counts, only_top_ref
+            )
+        with pysam.AlignmentFile(
+            out_bam,
+            "wb",
+            header=header,
+            threads=threads,
+            format_options=bam_format_options(compression_level),
+        ) as bam_writer:
+            for read in indexed_alignments(bam_in, runs):
+                if subset_header and read.reference_id >= 0:
                     # relink the reference_id to match the new header
-                    if read.reference_id >= 0:
-                        ref_name = bam_reader_again.get_reference_name(
-                            read.reference_id
-                        )
-                        if ref_name in ref_name_to_id:
-                            read.reference_id = ref_name_to_id[ref_name]
-                        else:
-                            continue  # skip reads with references not in the new header
-                    bam_writer.write(read)
+                    new_reference_id = new_reference_ids[read.reference_id]
+                    if new_reference_id < 0:
+                        continue  # skip reads with references not in the new header
+                    read.reference_id = new_reference_id
+                bam_writer.write(read)
 
 
 def calculate_damage_for_plot(items):
@@ -1529,78 +2948,80 @@ def calculate_damage_for_plot(items):
     )
 
 
-def make_damage_plot(in_subs_list, in_subs, tax, plotfile, ymax=0):
-    # just damage from the subs file; should be super fast
-
-    if not matplotlib_imported:
-        print(
-            "Error: Cannot find matplotlib library for plotting. Try: pip install matplotlib"
-        )
+def subs_file_index(subs_path):
+    # goes through a subs file once and finds where each line starts, by tax id and by tax name,
+    # so the lines of many taxa can be read straight out of the file afterwards
+    index = {}
+    offset = 0
+    with open(subs_path, "rb") as f:
+        for line in f:
+            for key in dict.fromkeys(line.split(b"\t", 2)[:2]):
+                index.setdefault(key.decode(), []).append(offset)
+            offset += len(line)
+    return index
+
+
+def add_subs_regex_matches(subs_path, index, patterns):
+    # for the taxa that aren't a tax id or tax name in a subs file, matches them as regular expressions on the start of each line instead,
+    # which is how plotdamage used to find anything but numeric tax ids (so e.g. ".*\tMyrtaceae\t" still works), and adds the lines they match to the index
+    compiled = []
+    for pattern in patterns:
+        try:
+            compiled.append((pattern, re.compile(pattern)))
+        except re.error:
+            continue  # not a regular expression either, so it just won't match
+    if not compiled:
         return
+    offset = 0
+    with open(subs_path, "rb") as f:
+        for line in f:
+            text = line.decode()
+            for pattern, regex in compiled:
+                if regex.match(text):
+                    index.setdefault(pattern, []).append(offset)
+            offset += len(line)
+
+
+def damage_plot_values(subs_path, offset):
+    # reads the subs line of a taxon at offset and works out the frequencies to plot, at positions -15 to -1 and then 1 to 15
+    with open(subs_path, "rb") as f:
+        f.seek(offset)
+        split_line = f.readline().decode().split("\t")
+    tax_id, tax_name, data_part = split_line[0], split_line[1], split_line[2]
+    data_items = data_part.split()
+
+    ctp, gap_5prime, ctm, gap_3prime, other_5prime, other_3prime = (
+        calculate_damage_for_plot(data_items)
+    )
 
-    # did we get one or more files? check they exist then parse the input style
-    subs_files = []
-    if in_subs:
-        subs_files = in_subs
-    elif in_subs_list:
-        with open(in_subs_list, "r") as file:
-            subs_files = [line.strip() for line in file if line.strip()]
+    values = {"Other": [0] * 30, "CT": [0] * 30, "GA": [0] * 30}
+    for i in range(1, 16):
+        # 5'
+        values["CT"][14 + i] = ctp[i]
+        values["GA"][14 + i] = gap_5prime[i]
+        values["Other"][14 + i] = other_5prime[i]
 
-    # validate input files: check existence
-    for file in subs_files:
-        if not os.path.exists(file):
-            print(f"Error: File {file} does not exist.")
-            continue
+        # 3'
+        values["CT"][15 - i] = ctm[i]
+        values["GA"][15 - i] = gap_3prime[i]
+        values["Other"][15 - i] = other_3prime[i]
 
+    return tax_id, tax_name, values
+
+
+def draw_damage_plot(fig, subs_lines, ymax=0, layouts=None):
+    # draws the damage plot of one taxon onto fig, clearing whatever was there before, so one figure can be reused for many plots.
+    # subs_lines are the (subs file, offset) of the taxon's line in each subs file it's in.
+    # layouts is a dict of the subplot parameters tight_layout gave for each y axis maximum so far (see below)
     positions = list(range(-15, 0)) + list(range(1, 16))
     values_all_files = {
         key: [] for key in ["Other", "CT", "GA"]
     }  # store data for all files
-
-    for file in subs_files:
-        with open(file, "r") as f:
-            file_content = f.readlines()
-
-        tax_pattern = f"^{tax}\\t" if tax.isdigit() else tax
-        matched_line = [line for line in file_content if re.match(tax_pattern, line)]
-
-        if len(matched_line) == 0:
-            print(
-                f"Warning: {file} does not contain an entry for {tax}. Skipping this file."
-            )
-            continue
-        elif len(matched_line) > 1:
-            raise ValueError(
-                f"More than one matching line found in {file}. Please be more specific, e.g., by using a tax ID instead of a name."
-            )
-
-        split_line = matched_line[0].split("\t")
-        tax_id, tax_name, data_part = split_line[0], split_line[1], split_line[2]
-        data_items = data_part.split()
-
-        ctp, gap_5prime, ctm, gap_3prime, other_5prime, other_3prime = (
-            calculate_damage_for_plot(data_items)
-        )
-
-        values = {"Other": [0] * 30, "CT": [0] * 30, "GA": [0] * 30}
-        for i in range(1, 16):
-            # 5'
-            values["CT"][positions.index(i)] = ctp[i]
-            values["GA"][positions.index(i)] = gap_5prime[i]
-            values["Other"][positions.index(i)] = other_5prime[i]
-
-            # 3'
-            values["CT"][positions.index(-i)] = ctm[i]
-            values["GA"][positions.index(-i)] = gap_3prime[i]
-            values["Other"][positions.index(-i)] = other_3prime[i]
-
+    for subs_path, offset in subs_lines:
+        tax_id, tax_name, values = damage_plot_values(subs_path, offset)
         for key in values:
             values_all_files[key].append(values[key])
 
-    if not any(values_all_files["Other"]):
-        print("Warning: No valid rows found for the given tax ID.")
-        return
-
     if ymax == 0 or ymax == "0":
         max_y = min(
             1.0,
@@ -1615,7 +3036,7 @@ def make_damage_plot(in_subs_list, in_subs, tax, plotfile, ymax=0):
 
     # do the plotting
 
-    plt.figure(figsize=(10, 5))
+    fig.clear()
     color_palette = {
         "Other": "#009E73",
         "CT": "#F8766D",
@@ -1623,7 +3044,7 @@ def make_damage_plot(in_subs_list, in_subs, tax, plotfile, ymax=0):
     }  # colorblind-friendly palette
 
     # 5'
-    ax1 = plt.subplot(1, 2, 1)
+    ax1 = fig.add_subplot(1, 2, 1)
     handles1 = []  # store the line handles for ax1
     labels1 = [
         "Other",
@@ -1636,7 +3057,7 @@ def make_damage_plot(in_subs_list, in_subs, tax, plotfile, ymax=0):
             (line,) = ax1.plot(
                 [str(pos) for pos in positions if pos > 0],
                 [file_values[i] for i, pos in enumerate(positions) if pos > 0],
-                label=f"{key} ({subs_files[j]})",
+                label=f"{key} ({subs_lines[j][0]})",
                 color=color,
                 linewidth=2,
             )
@@ -1650,7 +3071,7 @@ def make_damage_plot(in_subs_list, in_subs, tax, plotfile, ymax=0):
     ax1.tick_params(axis="x", labelsize=12)
 
     # 3'
-    ax2 = plt.subplot(1, 2, 2)
+    ax2 = fig.add_subplot(1, 2, 2)
     handles2 = []
     for key in values_all_files:
         color = color_palette[key]
@@ -1658,7 +3079,7 @@ def make_damage_plot(in_subs_list, in_subs, tax, plotfile, ymax=0):
             (line,) = ax2.plot(
                 [str(pos) for pos in positions if pos < 0],
                 [file_values[i] for i, pos in enumerate(positions) if pos < 0],
-                label=f"{key} ({subs_files[j]})",
+                label=f"{key} ({subs_lines[j][0]})",
                 color=color,
                 linewidth=2,
             )
@@ -1673,105 +3094,255 @@ def make_damage_plot(in_subs_list, in_subs, tax, plotfile, ymax=0):
         handles=handles2, labels=labels1, loc="upper left", fontsize=12
     )  # legend
 
-    plt.suptitle(f"Damage Plot for {tax_name} (tax ID {tax_id})", fontsize=18)
-    plt.tight_layout(rect=[0, 0, 1, 0.95])
-
-    file_extension = os.path.splitext(plotfile)[1].lower()
-    if file_extension == ".pdf":
-        plt.savefig(plotfile, format="pdf")
+    fig.suptitle(f"Damage Plot for {tax_name} (tax ID {tax_id})", fontsize=18)
+    # tight_layout takes as long as saving the plot, and everything it depends on is the same for every taxon except for the y axis,
+    # so with a fixed --ymax it only has to be done once
+    if layouts is not None and max_y in layouts:
+        fig.subplots_adjust(**layouts[max_y])
     else:
-        if file_extension != ".png":
-            print(
-                "Warning: Invalid plot file suffix. Your plot file is being saved in png format with the filename you requested."
-            )
-        plt.savefig(plotfile)
+        fig.tight_layout(rect=[0, 0, 1, 0.95])
+        if layouts is not None:
+            layouts[max_y] = {
+                param: getattr(fig.subplotpars, param)
+                for param in ["left", "bottom", "right", "top", "wspace", "hspace"]
+            }
 
-    plt.close()
+
+def render_damage_plots(plots, ymax=0, pdf=None):
+    # draws each (subs lines, plot file) in plots with the same figure (see draw_damage_plot), and saves it to its plot file,
+    # or as the next page of pdf (a PdfPages) if given. this is what each process does when plotting in parallel
+    fig = Figure(figsize=(10, 5))
+    layouts = {}
+    for subs_lines, plotfile in plots:
+        draw_damage_plot(fig, subs_lines, ymax, layouts)
+        if pdf is not None:
+            pdf.savefig(fig)
+        elif os.path.splitext(plotfile)[1].lower() == ".pdf":
+            fig.savefig(plotfile, format="pdf")
+        else:
+            fig.savefig(plotfile)
 
 
-def make_baminfo_plot(in_bam, in_bam_list, plotfile):
-    if matplotlib_imported == False:
+def make_damage_plot(in_subs_list, in_subs, taxa, plotfile, ymax=0, threads=1):
+    # just damage from the subs file; should be super fast.
+    # taxa can be one tax id or name, or a list of them. with more than one, a .pdf plotfile gets a page per taxon,
+    # and otherwise each taxon gets its own png named after it (like extract's output bams), drawn in threads processes
+
+    if not matplotlib_imported:
         print(
-            f"Error: Cannot find matplotlib library for plotting. Try: pip install matplotlib"
+            "Error: Cannot find matplotlib library for plotting. Try: pip install matplotlib"
         )
         return
 
-    if in_bam:
-        bamfiles = in_bam if isinstance(in_bam, list) else [in_bam]
-    elif in_bam_list:
-        with open(in_bam_list, "r") as file:
-            bamfiles = [line.strip() for line in file if line.strip()]
+    # did we get one or more files? check they exist then parse the input style
+    subs_files = []
+    if in_subs:
+        subs_files = in_subs
+    elif in_subs_list:
+        with open(in_subs_list, "r") as file:
+            subs_files = [line.strip() for line in file if line.strip()]
+
+    # validate input files: check existence
+    for file in subs_files:
+        if not os.path.exists(file):
+            print(f"Error: File {file} does not exist.")
+    subs_files = [file for file in subs_files if os.path.exists(file)]
+
+    if not isinstance(taxa, list):
+        taxa = [taxa]
+    multipage = len(taxa) > 1 and os.path.splitext(plotfile)[1].lower() == ".pdf"
+    if not multipage and os.path.splitext(plotfile)[1].lower() not in [".png", ".pdf"]:
+        print(
+            "Warning: Invalid plot file suffix. Your plot file is being saved in png format with the filename you requested."
+        )
+    plotfiles = keyword_out_paths(plotfile, taxa, ".png")
+
+    # find the line of each taxon in each subs file, going through each file just once.
+    # taxa match the tax id or tax name of a line exactly; any that match neither get another pass as regular expressions (see add_subs_regex_matches)
+    subs_indexes = [subs_file_index(file) for file in subs_files]
+    for file, subs_index in zip(subs_files, subs_indexes):
+        add_subs_regex_matches(
+            file,
+            subs_index,
+            [tax for tax in taxa if tax not in subs_index and not tax.isdigit()],
+        )
+    plots = []
+    skipped = []
+    for tax, taxplotfile in zip(taxa, plotfiles):
+        subs_lines = []
+        for file, subs_index in zip(subs_files, subs_indexes):
+            offsets = subs_index.get(tax, [])
+            if len(offsets) == 0:
+                print(
+                    f"Warning: {file} does not contain an entry for {tax}. Skipping this file."
+                )
+            elif len(offsets) > 1:
+                print(
+                    f"Warning: More than one line for {tax} found in {file}. Please be more specific, e.g., by using a tax ID instead of a name. Skipping this file."
+                )
+            else:
+                subs_lines.append((file, offsets[0]))
+        if not subs_lines:
+            print(f"Warning: No valid rows found for {tax}.")
+            skipped.append(tax)
+            continue
+        plots.append((subs_lines, taxplotfile))
+    if not plots:
+        print(
+            f"Error: None of the requested taxa were found in the subs files: {', '.join(skipped)}"
+        )
+        sys.exit(1)
+    if skipped:
+        print(f"Skipped {len(skipped)} taxa which were not found: {', '.join(skipped)}")
+
+    if multipage:
+        # the pages have to go into the pdf in order, so these are all drawn in this process
+        with PdfPages(plotfile) as pdf:
+            render_damage_plots(plots, ymax, pdf)
+    elif threads > 1 and len(plots) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=threads) as pool:
+            list(
+                pool.map(
+                    render_damage_plots,
+                    [plots[i::threads] for i in range(threads)],
+                    itertools.repeat(ymax),
+                )
+            )
     else:
-        raise ValueError("Either --in_bam or --in_bam_list must be provided.")
-    if not all(isinstance(b, str) for b in bamfiles):
-        raise TypeError(f"bamfiles contains non-string elements: {bamfiles}")
+        render_damage_plots(plots, ymax)
+    if len(taxa) > 1:
+        print(
+            f"Wrote damage plots of {len(plots)} taxa to {plotfile if multipage else ', '.join(plotfile for _, plotfile in plots)}"
+        )
 
-    mismatch_counts_all = []
-    read_length_counts_all = []
 
-    for bam_file in bamfiles:
-        bamfile = pysam.AlignmentFile(bam_file, "rb", require_index=False)
+def baminfo_counts(bam_file, threads=1):
+    # the mismatch (NM) and read length histograms of a bam: each read adds 1 to its length, and its alignments add 1/(number of alignments) to their NMs
+    bamfile = pysam.AlignmentFile(bam_file, "rb", require_index=False, threads=threads)
 
-        mismatch_counts = {}
-        read_length_counts = {}
-        current_readname = None
-        mismatch_bins = {}
-        alignment_count = 0
-        current_read_length = 0
-        total_reads = 0
+    mismatch_counts = {}
+    read_length_counts = {}
+    current_readname = None
+    mismatch_bins = {}
+    alignment_count = 0
+    current_read_length = 0
+    total_reads = 0
 
-        for read in bamfile:
-            readname = read.query_name
-
-            if readname != current_readname:
-                if current_readname is not None:
-                    for mismatch_bin, count in mismatch_bins.items():
-                        fraction = count / alignment_count
-                        if mismatch_bin not in mismatch_counts:
-                            mismatch_counts[mismatch_bin] = fraction
-                        else:
-                            mismatch_counts[mismatch_bin] += fraction
+    for read in bamfile:
+        readname = read.query_name
 
-                    if current_read_length not in read_length_counts:
-                        read_length_counts[current_read_length] = 1
+        if readname != current_readname:
+            if current_readname is not None:
+                for mismatch_bin, count in mismatch_bins.items():
+                    fraction = count / alignment_count
+                    if mismatch_bin not in mismatch_counts:
+                        mismatch_counts[mismatch_bin] = fraction
                     else:
-                        read_length_counts[current_read_length] += 1
+                        mismatch_counts[mismatch_bin] += fraction
 
-                    total_reads += 1
+                if current_read_length not in read_length_counts:
+                    read_length_counts[current_read_length] = 1
+                else:
+                    read_length_counts[current_read_length] += 1
 
-                current_readname = readname
-                mismatch_bins = {}
-                alignment_count = 0
-                current_read_length = read.query_length
+                total_reads += 1
 
-            mismatches = read.get_tag("NM") if read.has_tag("NM") else 0
-            if mismatches not in mismatch_bins:
-                mismatch_bins[mismatches] = 1
-            else:
-                mismatch_bins[mismatches] += 1
+            current_readname = readname
+            mismatch_bins = {}
+            alignment_count = 0
+            current_read_length = read.query_length
 
-            alignment_count += 1
+        mismatches = read.get_tag("NM") if read.has_tag("NM") else 0
+        if mismatches not in mismatch_bins:
+            mismatch_bins[mismatches] = 1
+        else:
+            mismatch_bins[mismatches] += 1
 
-        if current_readname is not None:
-            for mismatch_bin, count in mismatch_bins.items():
-                fraction = count / alignment_count
-                if mismatch_bin not in mismatch_counts:
-                    mismatch_counts[mismatch_bin] = fraction
-                else:
-                    mismatch_counts[mismatch_bin] += fraction
+        alignment_count += 1
 
-            if current_read_length not in read_length_counts:
-                read_length_counts[current_read_length] = 1
+    if current_readname is not None:
+        for mismatch_bin, count in mismatch_bins.items():
+            fraction = count / alignment_count
+            if mismatch_bin not in mismatch_counts:
+                mismatch_counts[mismatch_bin] = fraction
             else:
-                read_length_counts[current_read_length] += 1
+                mismatch_counts[mismatch_bin] += fraction
+
+        if current_read_length not in read_length_counts:
+            read_length_counts[current_read_length] = 1
+        else:
+            read_length_counts[current_read_length] += 1
+
+        total_reads += 1
+
+    bamfile.close()
+
+    return mismatch_counts, read_length_counts
+
+
+def node_histogram_counts(hist_path, tax):
+    # the same histograms as baminfo_counts, for one node of a histogram file from compute --out_hist (see write_node_histograms).
+    # tax can be a tax id or a tax name. returns None if the node isn't in the file
+    with np.load(hist_path) as hist:
+        hits = np.flatnonzero(hist["nodes"] == tax)
+        if len(hits) == 0:
+            hits = np.flatnonzero(hist["names"] == tax)
+        if len(hits) == 0:
+            return None
+        n = hits[0]
+        length_starts = hist["length_starts"]
+        nm_starts = hist["nm_starts"]
+        lengths = slice(length_starts[n], length_starts[n + 1])
+        nms = slice(nm_starts[n], nm_starts[n + 1])
+        read_length_counts = dict(
+            zip(
+                hist["length_values"][lengths].tolist(),
+                hist["length_counts"][lengths].tolist(),
+            )
+        )
+        mismatch_counts = dict(
+            zip(hist["nm_values"][nms].tolist(), hist["nm_freqs"][nms].tolist())
+        )
+    return mismatch_counts, read_length_counts
+
 
-            total_reads += 1
+def make_baminfo_plot(in_bam, in_bam_list, plotfile, threads=1, in_hist=None, tax=None):
+    if matplotlib_imported == False:
+        print(
+            f"Error: Cannot find matplotlib library for plotting. Try: pip install matplotlib"
+        )
+        return
+
+    mismatch_counts_all = []
+    read_length_counts_all = []
 
-        bamfile.close()
+    if in_hist:
+        # the histograms were already made by compute, so there's no bam to read
+        bamfiles = in_hist
+        for hist_path in in_hist:
+            counts = node_histogram_counts(hist_path, tax)
+            if counts is None:
+                print(f"Error: Could not find the taxon {tax} in {hist_path}.")
+                sys.exit()
+            mismatch_counts_all.append(counts[0])
+            read_length_counts_all.append(counts[1])
+    else:
+        if in_bam:
+            bamfiles = in_bam if isinstance(in_bam, list) else [in_bam]
+        elif in_bam_list:
+            with open(in_bam_list, "r") as file:
+                bamfiles = [line.strip() for line in file if line.strip()]
+        else:
+            raise ValueError("Either --in_bam or --in_bam_list must be provided.")
+        if not all(isinstance(b, str) for b in bamfiles):
+            raise TypeError(f"bamfiles contains non-string elements: {bamfiles}")
 
-        # Add the results to the overall dictionaries for all files
-        mismatch_counts_all.append(mismatch_counts)
-        read_length_counts_all.append(read_length_counts)
+        for bam_file in bamfiles:
+            mismatch_counts, read_length_counts = baminfo_counts(bam_file, threads)
+
+            # Add the results to the overall dictionaries for all files
+            mismatch_counts_all.append(mismatch_counts)
+            read_length_counts_all.append(read_length_counts)
 
     # Plotting
     plt.figure(figsize=(10, 5))
@@ -1867,8 +3438,205 @@ def parse_exclude_keywords(args):
         return []
 
 
-def tsvs_to_matrix(parsed_data, output_file, include="all", minreads=50):
-    # for combine. pretty straightforward, read them all in and construct the matrix by pulling values out as needed
+def parse_extract_keywords(args):
+    # the keywords to extract, from --keyword and/or --keyword_file
+    keywords = args.keyword if args.keyword else []
+    if not isinstance(keywords, list):
+        keywords = [keywords]
+    keywords = list(keywords)
+
+    if getattr(args, "keyword_file", None):
+        if not os.path.exists(args.keyword_file):
+            raise FileNotFoundError(
+                f"keyword_file path does not exist: {args.keyword_file}"
+            )
+        with open(args.keyword_file, "r") as f:
+            keywords.extend([line.strip() for line in f if line.strip()])
+
+    keywords = [
+        kw.lstrip("'").lstrip('"').rstrip("'").rstrip('"') for kw in keywords
+    ]  # strip quotes
+    keywords = list(dict.fromkeys(keywords))  # drop repeats, keep the order
+    if not keywords:
+        print("Error: Please give at least one keyword to extract.")
+        sys.exit()
+    return keywords
+
+
+def parse_plot_taxa(args):
+    # the taxa to plot, from --tax and/or --tax_file, and every taxon with at least --minreads reads in the --in_tsv files (most reads first)
+    taxa = args.tax if args.tax else []
+    if not isinstance(taxa, list):
+        taxa = [taxa]
+    taxa = list(taxa)
+
+    if getattr(args, "tax_file", None):
+        with open(args.tax_file, "r") as f:
+            taxa.extend([line.strip() for line in f if line.strip()])
+
+    if getattr(args, "in_tsv", None):
+        tsv_reads = {}
+        for tsv in args.in_tsv:
+            columns = read_tsv_columns(tsv)
+            for taxpath, reads in zip(columns["taxpaths"], columns["reads"].tolist()):
+                tax = taxpath.strip('"').split(":")[0]
+                tsv_reads[tax] = tsv_reads.get(tax, 0) + reads
+        taxa.extend(
+            sorted(
+                (tax for tax, reads in tsv_reads.items() if reads >= args.minreads),
+                key=lambda tax: tsv_reads[tax],
+                reverse=True,
+            )
+        )
+
+    taxa = list(dict.fromkeys(taxa))  # drop repeats, keep the order
+    if not taxa:
+        print("Error: There are no taxa to plot.")
+        sys.exit()
+    return taxa
+
+
+def keyword_out_paths(out_path, keywords, extension):
+    # with one keyword the output is just out_path. with more, each keyword gets its own output named after it,
+    # e.g. for extract, out.bam -> out.1026.bam, out.1001.bam
+    if len(keywords) == 1:
+        return [out_path]
+    root = os.path.splitext(out_path)[0] if out_path.endswith(extension) else out_path
+    return [
+        f"{root}.{re.sub(r'[^A-Za-z0-9_.-]+', '_', kw)}{extension}" for kw in keywords
+    ]
+
+
+def parse_tsv_columns(tsv_path):
+    # reads the columns of a bamdam tsv that combine and krona use: reads, duplicity, dust, damage and mean length as floats,
+    # and the tax path (the last column) as it is in the file
+    numbers = {column: array.array("d") for column in tsv_number_columns}
+    taxpaths = []
+    with open(tsv_path, "r") as file:
+        next(file, None)  # skip the header line
+        for line in file:
+            fields = line.strip().split("\t")
+            if fields == [""]:
+                continue
+            for column, field in tsv_number_columns.items():
+                numbers[column].append(
+                    float(fields[field]) if field < len(fields) - 1 else math.nan
+                )
+            taxpaths.append(fields[-1])
+    columns = {
+        column: np.frombuffer(values, dtype=np.float64)
+        for column, values in numbers.items()
+    }
+    columns["taxpaths"] = taxpaths
+    return columns
+
+
+def tsv_cache_path(tsv_path):
+    return f"{tsv_path}.bamdamcache"
+
+
+def load_tsv_cache(tsv_path):
+    # the columns of a tsv from its sidecar cache, or None if there's no cache or the tsv has changed since it was made
+    tsv_stat = os.stat(tsv_path)
+    try:
+        with np.load(tsv_cache_path(tsv_path)) as cache:
+            if (
+                int(cache["version"]) != tsv_cache_version
+                or int(cache["tsv_size"]) != tsv_stat.st_size
+                or int(cache["tsv_mtime"]) != tsv_stat.st_mtime_ns
+            ):
+                return None
+            columns = {column: cache[column] for column in tsv_number_columns}
+            taxpaths = cache["taxpaths"].tobytes().decode()
+    except (OSError, EOFError, ValueError, KeyError, zipfile.BadZipFile):
+        # missing or unreadable, so just parse the tsv again
+        return None
+    columns["taxpaths"] = taxpaths.split("\n") if len(columns["reads"]) > 0 else []
+    return columns
+
+
+def write_tsv_cache(tsv_path):
+    # parses a tsv and writes its columns to a sidecar cache next to it (a numpy .npz file), with the size and modification time of the tsv
+    # so a stale cache can be caught. returns the columns
+    tsv_stat = os.stat(tsv_path)
+    columns = parse_tsv_columns(tsv_path)
+    cache_path = tsv_cache_path(tsv_path)
+    try:
+        with open(
+            cache_path + ".tmp", "wb"
+        ) as cachefile:  # (an open file, so numpy doesn't add .npz to the name)
+            np.savez(
+                cachefile,
+                version=np.int64(tsv_cache_version),
+                tsv_size=np.int64(tsv_stat.st_size),
+                tsv_mtime=np.int64(tsv_stat.st_mtime_ns),
+                taxpaths=np.frombuffer(
+                    "\n".join(columns["taxpaths"]).encode(), dtype=np.uint8
+                ),
+                **{column: columns[column] for column in tsv_number_columns},
+            )
+        os.replace(cache_path + ".tmp", cache_path)
+    except OSError:
+        print(
+            f"Warning: Could not write a cache file for {tsv_path} (is the directory read only?), so it will be parsed again next time."
+        )
+    return columns
+
+
+def read_tsv_columns(tsv_path):
+    # the columns of a tsv, from its sidecar cache if that's up to date, otherwise parsed from the text and cached for next time
+    columns = load_tsv_cache(tsv_path)
+    if columns is None:
+        columns = write_tsv_cache(tsv_path)
+    return columns
+
+
+def refresh_tsv_cache(tsv_path):
+    if load_tsv_cache(tsv_path) is None:
+        write_tsv_cache(tsv_path)
+
+
+def refresh_tsv_caches(tsv_paths, threads=1):
+    # parses the tsvs without an up to date cache in a pool of processes, so that reading them all in order afterwards is quick
+    if threads > 1 and len(tsv_paths) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(refresh_tsv_cache, tsv_paths))
+
+
+def read_tsvs_columns(tsv_paths, threads=1, cache=True):
+    # yields the columns of each tsv in order. with cache, they come from the sidecar caches (see read_tsv_columns), and with threads > 1 the tsvs
+    # without an up to date cache are cached in parallel first. without cache, the tsvs are just parsed, and with threads > 1 a few at a time
+    # are parsed ahead in a pool of processes, so parsed tsvs don't pile up in memory
+    if cache:
+        refresh_tsv_caches(tsv_paths, threads)
+        for tsv_path in tsv_paths:
+            yield read_tsv_columns(tsv_path)
+    elif threads > 1 and len(tsv_paths) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=threads) as pool:
+            pending = collections.deque()
+            for tsv_path in tsv_paths:
+                pending.append(pool.submit(parse_tsv_columns, tsv_path))
+                while len(pending) > 2 * threads:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+    else:
+        for tsv_path in tsv_paths:
+            yield parse_tsv_columns(tsv_path)
+
+
+def tsvs_to_matrix(
+    sample_files,
+    output_file,
+    include="all",
+    minreads=50,
+    long_file=None,
+    threads=1,
+    cache=True,
+):
+    # for combine. each tsv is read once (from its cache if it has one, see read_tsv_columns) into flat columns, one entry per (taxon, sample) line actually in the files,
+    # with taxa and samples as integer indices, so memory goes with the number of lines in the tsvs rather than taxa x samples.
+    # then the matrix is written a row at a time.
     # "meandamage" output is actually weighted by number of reads
 
     include_damage = "damage" in include or "all" in include
@@ -1876,61 +3644,98 @@ def tsvs_to_matrix(parsed_data, output_file, include="all", minreads=50):
     include_dust = "dust" in include or "all" in include
     include_taxpath = "taxpath" in include or "all" in include
 
-    tax_data = {}
-    for (
-        sample_name,
-        records,
-    ) in parsed_data.items():  # parsed_data is a dict: {sample_name: records}
-        if sample_name.endswith(".tsv"):
-            sample_name = sample_name.replace(".tsv", "")
-
-        print(f"Processing sample: {sample_name} with {len(records)} records.")
-        for record in records:
-            taxpath = record[-1]
+    # per taxon, in the order they're first seen
+    tax_index = {}
+    tax_names = []
+    tax_paths = []
+    total_reads = []
+    weighted_damage = []
+    weight_sum = []
+
+    # per entry
+    entry_tax = array.array("i")
+    entry_sample = array.array("i")
+    entry_reads = array.array("q")
+    entry_damage = array.array("d")
+    entry_duplicity = array.array("d")
+    entry_dust = array.array("d")
+
+    sample_names = list(sample_files)  # sample_files is a dict: {sample_name: tsv path}
+    all_columns = read_tsvs_columns(list(sample_files.values()), threads, cache)
+    for sample_idx, (sample_name, columns) in enumerate(zip(sample_names, all_columns)):
+        print(
+            f"Processing sample: {sample_name} with {len(columns['taxpaths'])} records."
+        )
+        sample_reads = columns["reads"].astype(np.int64)
+        for taxpath, reads, damage in zip(
+            columns["taxpaths"], sample_reads.tolist(), columns["damage"].tolist()
+        ):
             tax = taxpath.split(";")[0].strip('"')
-            if tax not in tax_data:
-                tax_data[tax] = {
-                    "TaxPath": taxpath,
-                    "samples": {},
-                    "TotalReads": 0,
-                    "WeightedDamage": 0 if include_damage else None,
-                    "WeightSum": 0,
-                }
-
-            sample_data = {
-                "reads": int(record[2]),
-                "damage": float(record[5]) if include_damage else None,
-                "duplicity": float(record[3]) if include_duplicity else None,
-                "dust": float(record[4]) if include_dust else None,
-            }
-            tax_data[tax]["samples"][sample_name] = sample_data
-            tax_data[tax]["TotalReads"] += sample_data["reads"]
-            if include_damage and sample_data["damage"] is not None:
-                tax_data[tax]["WeightedDamage"] += (
-                    sample_data["damage"] * sample_data["reads"]
-                )
-            tax_data[tax]["WeightSum"] += sample_data["reads"]
+            t = tax_index.get(tax)
+            if t is None:
+                t = len(tax_names)
+                tax_index[tax] = t
+                tax_names.append(tax)
+                tax_paths.append(taxpath)
+                total_reads.append(0)
+                weighted_damage.append(0)
+                weight_sum.append(0)
+            entry_tax.append(t)
+            total_reads[t] += reads
+            weight_sum[t] += reads
+            if include_damage:
+                weighted_damage[t] += damage * reads
 
-    for tax, data in tax_data.items():
-        if include_damage and data["WeightSum"] > 0:
-            data["MeanDamage"] = data["WeightedDamage"] / data["WeightSum"]
-        else:
-            data["MeanDamage"] = "NA"
+        entry_sample.extend([sample_idx] * len(sample_reads))
+        entry_reads.frombytes(sample_reads.tobytes())
+        if include_damage:
+            entry_damage.frombytes(columns["damage"].tobytes())
+        if include_duplicity:
+            entry_duplicity.frombytes(columns["duplicity"].tobytes())
+        if include_dust:
+            entry_dust.frombytes(columns["dust"].tobytes())
+    del tax_index
+
+    # the entries of each taxon, in the order they were read
+    entry_taxa = np.frombuffer(entry_tax, dtype=np.int32)
+    entry_order = np.argsort(entry_taxa, kind="stable")
+    tax_entry_starts = np.zeros(len(tax_names) + 1, dtype=np.int64)
+    np.cumsum(
+        np.bincount(entry_taxa, minlength=len(tax_names)), out=tax_entry_starts[1:]
+    )
+    del entry_taxa
 
-    tax_data = {
-        tax: data for tax, data in tax_data.items() if data["TotalReads"] >= minreads
-    }
-    sorted_tax_data = sorted(
-        tax_data.items(), key=lambda x: x[1]["TotalReads"], reverse=True
+    # samples are written in alphabetical order
+    sorted_sample_names = sorted(sample_names)
+    sample_columns = {name: column for column, name in enumerate(sorted_sample_names)}
+    sample_columns = [sample_columns[name] for name in sample_names]
+
+    def entry_cells(e):
+        cells = [str(entry_reads[e])]
+        if include_damage:
+            cells.append(str(entry_damage[e]))
+        if include_duplicity:
+            cells.append(str(entry_duplicity[e]))
+        if include_dust:
+            cells.append(str(entry_dust[e]))
+        return "\t".join(cells)
+
+    empty_cells = "\t".join(
+        ["0"] + ["NA"] * (include_damage + include_duplicity + include_dust)
+    )
+
+    kept_taxa = sorted(
+        (t for t in range(len(tax_names)) if total_reads[t] >= minreads),
+        key=lambda t: total_reads[t],
+        reverse=True,
     )
 
     with open(output_file, "w") as outfile:
+        long_outfile = open(long_file, "w") if long_file else None
         header = ["Tax", "TotalReads"]
         if include_damage:
             header.append("MeanDamage")
-        for sample_name in sorted(list(parsed_data.keys())):
-            if sample_name.endswith(".tsv"):
-                sample_name = sample_name.replace(".tsv", "")
+        for sample_name in sorted_sample_names:
             header.append(f"{sample_name}_reads")
             if include_damage:
                 header.append(f"{sample_name}_damage")
@@ -1941,40 +3746,48 @@ def tsvs_to_matrix(parsed_data, output_file, include="all", minreads=50):
         if include_taxpath:
             header.append("TaxPath")
         outfile.write("\t".join(header) + "\n")
+        if long_outfile:
+            header = ["Tax", "Sample", "Reads"]
+            if include_damage:
+                header.append("Damage")
+            if include_duplicity:
+                header.append("Duplicity")
+            if include_dust:
+                header.append("Dust")
+            long_outfile.write("\t".join(header) + "\n")
 
-        for tax, data in sorted_tax_data:
-            row = [tax, str(data["TotalReads"])]
+        for t in kept_taxa:
+            row = [tax_names[t], str(total_reads[t])]
             if include_damage:
-                row.append(str(round(data["MeanDamage"], 3)))
-            for sample_name in sorted(parsed_data.keys()):
-                if sample_name.endswith(".tsv"):
-                    sample_name = sample_name.replace(".tsv", "")
-                sample_data = data["samples"].get(sample_name, {})
-                row.append(str(sample_data.get("reads", 0)))
-                if include_damage:
-                    row.append(
-                        str(sample_data.get("damage"))
-                        if sample_data.get("damage") is not None
-                        else "NA"
-                    )
-                if include_duplicity:
-                    row.append(
-                        str(sample_data.get("duplicity"))
-                        if sample_data.get("duplicity") is not None
-                        else "NA"
-                    )
-                if include_dust:
-                    row.append(
-                        str(sample_data.get("dust"))
-                        if sample_data.get("dust") is not None
-                        else "NA"
-                    )
+                if weight_sum[t] > 0:
+                    row.append(str(round(weighted_damage[t] / weight_sum[t], 3)))
+                else:
+                    row.append("NA")
+            # if a taxon is in a tsv twice, the last line wins (but both count towards the total)
+            tax_cells = {}
+            for e in entry_order[
+                tax_entry_starts[t] : tax_entry_starts[t + 1]
+            ].tolist():
+                tax_cells[sample_columns[entry_sample[e]]] = entry_cells(e)
+            cells = [empty_cells] * len(sample_names)
+            for column, cell in tax_cells.items():
+                cells[column] = cell
+            row.extend(cells)
             if include_taxpath:
-                row.append(data["TaxPath"])
+                row.append(tax_paths[t])
             outfile.write("\t".join(row) + "\n")
+            if long_outfile:
+                for column in sorted(tax_cells):
+                    long_outfile.write(
+                        f"{tax_names[t]}\t{sorted_sample_names[column]}\t{tax_cells[column]}\n"
+                    )
+        if long_outfile:
+            long_outfile.close()
 
 
-def make_krona_xml(in_tsv, in_tsv_files, out_xml, minreads, maxdamage):
+def make_krona_xml(
+    in_tsv, in_tsv_files, out_xml, minreads, maxdamage, threads=1, cache=True
+):
     # create an xml text file to be loaded into kronatools for visualization. adds damage as a colour option.
 
     level_order = [
@@ -2003,7 +3816,7 @@ def make_krona_xml(in_tsv, in_tsv_files, out_xml, minreads, maxdamage):
             print(f"Error: File {file} does not exist.")
             continue
         with open(file, "r") as f:
-            lines = f.readlines()
+            lines = list(itertools.islice(f, 2))  # (just the header and the top line)
             if len(lines) < 2:
                 print(f"Error: File {file} does not have enough lines to check reads.")
                 continue
@@ -2038,30 +3851,29 @@ def make_krona_xml(in_tsv, in_tsv_files, out_xml, minreads, maxdamage):
 
     # put everything into a tree structure in memory (these tsv files are usually pretty small) and then afterwards interpret it into krona xml format
     tree = {}
+    node_parent = {}  # parent of each node that has one, so the roots are just the nodes that aren't in here
     sample_names = []
     sample_max_reads = {}  # for colour scale
     sample_max_damage = {}  # for colour scale
     sample_reads_at_root = {}  # krona format needs this
+    sample_node_ids = {}  # the nodes that have info for each sample, filled in as the tsvs are read
 
-    for file in input_files:
+    for file, columns in zip(
+        input_files, read_tsvs_columns(input_files, threads, cache)
+    ):
         sample_name = file.split("/")[-1].replace(".tsv", "")
         sample_names.append(sample_name)
 
-        with open(file, "r") as file:
-            lines = file.readlines()
-        header = lines[0].strip().split("\t")
+        # tsvs are ordered by reads, so we only need the lines before the first one under minreads
+        below_minreads = np.flatnonzero(columns["reads"] < minreads)
+        kept_lines = below_minreads[0] if len(below_minreads) else len(columns["reads"])
+        taxpaths = columns["taxpaths"][:kept_lines]
 
         # the first thing to do is get the top level; the "upto" that was used
-        taxpath_col = header.index("TaxPath") if "TaxPath" in header else -1
-
         if not "toplevel" in locals():
             # toplevel should be the same across tsv files!
             levels_found = set()
-            for line in lines[1:]:
-                fields = line.strip().split("\t")
-                if int(fields[2]) < minreads:
-                    break
-                taxpath = fields[taxpath_col]
+            for taxpath in taxpaths:
                 first_node = taxpath.split(";")[0]
                 level = first_node.split(":")[2].strip('"')
                 levels_found.add(level)
@@ -2071,21 +3883,19 @@ def make_krona_xml(in_tsv, in_tsv_files, out_xml, minreads, maxdamage):
                     toplevel = level
                     break
 
-        max_reads = int(
-            lines[1].strip().split("\t")[2]
-        )  # tsvs are ordered; top line is max reads
+        max_reads = int(columns["reads"][0])  # tsvs are ordered; top line is max reads
         sample_max_reads[sample_name] = max_reads
 
-        for line in lines[1:]:  # skip the header
-            fields = line.strip().split("\t")
-            reads = float(fields[2])
-            if reads < minreads:
-                break  # you're done with this file
-            dup = float(fields[3])
-            dust = float(fields[4])
-            damage = float(fields[5])
-            lengths = float(fields[7])
-            taxpath = fields[-1].strip('"').strip("'")  # 16 used to be -1
+        # the nodes that have info for this sample (normally none yet, unless the same sample name is in the list twice)
+        sample_taxids = sample_node_ids.setdefault(sample_name, [])
+        for taxpath, reads, dup, dust, damage, lengths in zip(
+            taxpaths,
+            *(
+                columns[column][:kept_lines].tolist()
+                for column in ["reads", "duplicity", "dust", "damage", "length"]
+            ),
+        ):
+            taxpath = taxpath.strip('"').strip("'")
             taxpathsplit = taxpath.split(";")
             fullnode = taxpathsplit[0].split(":")
             taxid = fullnode[0]
@@ -2111,6 +3921,7 @@ def make_krona_xml(in_tsv, in_tsv_files, out_xml, minreads, maxdamage):
                         "taxpath": taxpath,
                         "children": set(),
                     }
+                    sample_taxids.append(taxid)
                 else:  # otherwise just add this sample info in
                     if sample_name not in tree[taxid]["samples"]:
                         tree[taxid]["samples"][sample_name] = {
@@ -2120,6 +3931,7 @@ def make_krona_xml(in_tsv, in_tsv_files, out_xml, minreads, maxdamage):
                             "damage": damage,
                             "length": lengths,
                         }
+                        sample_taxids.append(taxid)
                     # else:  # this should not ever happen anymore
                     # print(f"Warning: The file {sample_name} has two lines for the same tax id {taxid}, or this file is in your list more than once.")
                 if level != toplevel:
@@ -2137,22 +3949,18 @@ def make_krona_xml(in_tsv, in_tsv_files, out_xml, minreads, maxdamage):
                             "children": set(),
                         }
                     tree[parent_taxid]["children"].add(taxid)
+                    node_parent[taxid] = parent_taxid
 
-        # sum up the reads at the nodes without children in all the nodes which have info for this sample
-        root_reads = sum(
+        # sum up the reads at the nodes without parents (so far) in all the nodes which have info for this sample
+        sample_reads_at_root[sample_name] = sum(
             tree[taxid]["samples"][sample_name]["reads"]
-            for taxid in tree
-            if sample_name in tree[taxid]["samples"]
-            and not any(taxid in tree[child_id]["children"] for child_id in tree)
+            for taxid in sample_taxids
+            if taxid not in node_parent
         )
-        sample_reads_at_root[sample_name] = root_reads
 
         # also get max damage of all the taxa for this sample
         sample_max_damage[sample_name] = max(
-            node["samples"][sample_name]["damage"]
-            for node in tree.values()
-            if sample_name in node["samples"]
-            and node["samples"][sample_name]["damage"] is not None
+            tree[taxid]["samples"][sample_name]["damage"] for taxid in sample_taxids
         )
 
     # a very handy debug point, i will leave it here in case anyone is ever changing this code and needs it (needs pprint package):
@@ -2169,10 +3977,7 @@ def make_krona_xml(in_tsv, in_tsv_files, out_xml, minreads, maxdamage):
     # first build a summary of everything if there is more than one thing;
     # just iterate through existing nodes to do this then treat the summary like a bonus sample
     if len(input_files) > 1:
-        all_children = {child for node in tree.values() for child in node["children"]}
-        tree_items = list(tree.items())
-
-        for taxid, node in tree_items:
+        for taxid, node in tree.items():
             all_reads = 0
             weighted_damage_sum = 0
             total_reads_for_damage = 0
@@ -2209,12 +4014,11 @@ def make_krona_xml(in_tsv, in_tsv_files, out_xml, minreads, maxdamage):
                 "length": round(avg_length, 3),
             }
 
-        summary_root_reads = sum(
+        sample_reads_at_root["Summary"] = sum(
             node["samples"]["Summary"]["reads"]
-            for taxid, node in tree_items
-            if "Summary" in node["samples"] and taxid not in all_children
+            for taxid, node in tree.items()
+            if taxid not in node_parent
         )
-        sample_reads_at_root["Summary"] = summary_root_reads
 
         sample_names.insert(0, "Summary")
 
@@ -2240,28 +4044,44 @@ def make_krona_xml(in_tsv, in_tsv_files, out_xml, minreads, maxdamage):
             overall_max_damage, 0.3
         )  # otherwise auto-detect but ensure at least 0.3
 
-    def add_node_to_xml(node_id, tree, indent_level=2):
-        node_data = tree[node_id]
-        indent = "\t" * indent_level
-        node_str = f'{indent}<node name="{node_data["taxname"]}">\n'
-
-        for attr in ["reads", "damage", "duplicity", "dust", "length"]:
-            node_str += f"{indent}\t<{attr}>"
-            for sample_name in sample_names:
-                # add a 0 if this sample name doesn't appear for this node
-                value = node_data["samples"].get(sample_name, {}).get(attr, 0)
-                node_str += f"<val>{value}</val>"
-            node_str += f"</{attr}>\n"
-
-        node_str += (
-            f"{indent}\t<taxid><val>{node_id}</val></taxid>\n"  # add the tax id too
-        )
-
-        for child_id in node_data["children"]:
-            node_str += add_node_to_xml(child_id, tree, indent_level + 1)
+    def write_node_xml(file, root_id):
+        # writes a node and everything underneath it, depth first with a stack rather than by recursion, so deep trees are fine.
+        # a stack entry is (tax id, indent level, whether we're closing the node on the way back up)
+        stack = [(root_id, 2, False)]
+        on_path = set()  # the nodes currently open, to catch loops in a tree pieced together from several files
+        while stack:
+            node_id, indent_level, closing = stack.pop()
+            indent = "\t" * indent_level
+            if closing:
+                on_path.discard(node_id)
+                file.write(f"{indent}</node>\n")
+                continue
+            node_data = tree[node_id]
+            node_str = f'{indent}<node name="{node_data["taxname"]}">\n'
+
+            for attr in ["reads", "damage", "duplicity", "dust", "length"]:
+                node_str += f"{indent}\t<{attr}>"
+                for sample_name in sample_names:
+                    # add a 0 if this sample name doesn't appear for this node
+                    value = node_data["samples"].get(sample_name, {}).get(attr, 0)
+                    node_str += f"<val>{value}</val>"
+                node_str += f"</{attr}>\n"
+
+            node_str += (
+                f"{indent}\t<taxid><val>{node_id}</val></taxid>\n"  # add the tax id too
+            )
+            file.write(node_str)
 
-        node_str += f"{indent}</node>\n"
-        return node_str
+            on_path.add(node_id)
+            stack.append((node_id, indent_level, True))
+            # (reversed, so the children come off the stack in their usual order)
+            for child_id in reversed(list(node_data["children"])):
+                if child_id in on_path:
+                    print(
+                        f"Warning: {child_id} is both above and below {node_id} in the tax paths. Skipping it under {node_id}."
+                    )
+                    continue
+                stack.append((child_id, indent_level + 1, False))
 
     with open(out_xml, "w") as file:
         file.write("<krona>\n")
@@ -2290,62 +4110,113 @@ def make_krona_xml(in_tsv, in_tsv_files, out_xml, minreads, maxdamage):
             file.write(f"<val>{root_reads}</val>")
         file.write("</reads>\n")
 
-        for root_taxid in [
-            taxid
-            for taxid in tree
-            if not any(taxid in tree[child_id]["children"] for child_id in tree)
-        ]:
-            try:
-                file.write(add_node_to_xml(root_taxid, tree))
-            except RecursionError:
-                print(
-                    f"There was a recursion error for {root_taxid}. We will skip it. If your tree is truly ginormous, you can increase the default recursion limit."
-                )
-                continue
+        for root_taxid in [taxid for taxid in tree if taxid not in node_parent]:
+            write_node_xml(file, root_taxid)
 
         file.write("</krona>\n")
     print(f"Krona XML written to {out_xml}")
 
 
-def shrink(args):
+def shrink(args):
+    formatted_exclude_keywords = parse_exclude_keywords(args)
+    lca_file_type = find_lca_type(args.in_lca)
+    if lca_file_type == "metadmg":
+        print(
+            "You are running bamdam shrink with a metaDMG-style lca file. This is ok, but be aware the output lca file will be in ngsLCA lca file format, as all the other functions in bamdam require this format."
+        )
+    shortlcalines = write_shortened_lca(
+        args.in_lca,
+        args.out_lca,
+        args.upto,
+        args.mincount,
+        formatted_exclude_keywords,
+        lca_file_type,
+    )
+    write_shortened_bam(
+        args.in_bam,
+        args.out_lca,
+        args.out_bam,
+        args.stranded,
+        args.minsim,
+        args.annotate_pmd,
+        shortlcalines,
+        threads=args.threads,
+        compression_level=args.compression_level,
+        workers=args.workers,
+    )
+
+
+def compute(args):
+    lca_file_type = find_lca_type(args.in_lca)
+    if lca_file_type == "metadmg":
+        print(
+            "Error: It looks like you're trying to run bamdam compute with a metaDMG-style lca file. Please use an ngsLCA-style lca file."
+        )
+        sys.exit()
+    nodedata, pmds_in_bam = gather_subs_and_kmers(
+        args.in_bam,
+        args.in_lca,
+        kn=args.k,
+        upto=args.upto,
+        stranded=args.stranded,
+        threads=args.threads,
+        histograms=args.out_hist is not None,
+        max_position=args.subs_positions,
+    )
+    parse_and_write_node_data(
+        nodedata, args.out_tsv, args.out_subs, args.stranded, pmds_in_bam
+    )
+    if args.out_hist:
+        write_node_histograms(nodedata, args.out_hist)
+
+
+def run(args):
+    # shrink and compute in one go. the short lca file is written as in shrink, but the short bam is only written if asked for
     formatted_exclude_keywords = parse_exclude_keywords(args)
     lca_file_type = find_lca_type(args.in_lca)
-    if lca_file_type == "metadmg":
+    if lca_file_type == "metadmg" and args.out_lca:
         print(
-            "You are running bamdam shrink with a metaDMG-style lca file. This is ok, but be aware the output lca file will be in ngsLCA lca file format, as all the other functions in bamdam require this format."
+            "You are running bamdam run with a metaDMG-style lca file. This is ok, but be aware the output lca file will be in ngsLCA lca file format, as all the other functions in bamdam require this format."
+        )
+    short_lca_path = args.out_lca
+    if not short_lca_path:
+        short_lca_path = f"{args.out_tsv}.lca.tmp"
+        print(
+            "Writing a temp lca file to the output tsv directory. Will delete when done."
         )
     shortlcalines = write_shortened_lca(
         args.in_lca,
-        args.out_lca,
+        short_lca_path,
         args.upto,
         args.mincount,
         formatted_exclude_keywords,
         lca_file_type,
     )
-    write_shortened_bam(
+    nodedata, pmds_in_bam = gather_subs_and_kmers_while_shrinking(
         args.in_bam,
-        args.out_lca,
+        short_lca_path,
         args.out_bam,
         args.stranded,
         args.minsim,
         args.annotate_pmd,
         shortlcalines,
+        kn=args.k,
+        upto=args.upto,
+        threads=args.threads,
+        compression_level=args.compression_level,
+        histograms=args.out_hist is not None,
+        max_position=args.subs_positions,
     )
-
-
-def compute(args):
-    lca_file_type = find_lca_type(args.in_lca)
-    if lca_file_type == "metadmg":
-        print(
-            "Error: It looks like you're trying to run bamdam compute with a metaDMG-style lca file. Please use an ngsLCA-style lca file."
-        )
-        sys.exit()
-    nodedata, pmds_in_bam = gather_subs_and_kmers(
-        args.in_bam, args.in_lca, kn=args.k, upto=args.upto, stranded=args.stranded
-    )
+    if not args.out_lca:
+        try:
+            os.remove(short_lca_path)
+        except OSError as e:
+            print(f"Error removing temp file: {short_lca_path} : {e.strerror}")
     parse_and_write_node_data(
         nodedata, args.out_tsv, args.out_subs, args.stranded, pmds_in_bam
     )
+    if args.out_hist:
+        write_node_histograms(nodedata, args.out_hist)
 
 
 def extract(args):
@@ -2355,22 +4226,57 @@ def extract(args):
             "Error: It looks like you're trying to run bamdam extract with a metaDMG-style lca file. Please use an ngsLCA-style lca file."
         )
         sys.exit()
+    keywords = parse_extract_keywords(args)
     extract_reads(
         args.in_lca,
         args.in_bam,
-        args.out_bam,
-        args.keyword,
+        keyword_out_paths(args.out_bam, keywords, ".bam"),
+        keywords,
         args.subset_header,
         args.only_top_ref,
+        threads=args.threads,
+        compression_level=args.compression_level,
+        index=args.index,
+        exact_node=getattr(args, "exact_node", False),
+    )
+
+
+def index(args):
+    lca_file_type = find_lca_type(args.in_lca)
+    if lca_file_type == "metadmg":
+        print(
+            "Error: It looks like you're trying to run bamdam index with a metaDMG-style lca file. Please use an ngsLCA-style lca file."
+        )
+        sys.exit()
+    write_tax_index(
+        args.in_bam,
+        args.in_lca,
+        args.out_index or f"{args.in_bam}.taxindex",
+        args.upto,
+        threads=args.threads,
     )
 
 
 def plotdamage(args):
-    make_damage_plot(args.in_subs_list, args.in_subs, args.tax, args.outplot, args.ymax)
+    make_damage_plot(
+        args.in_subs_list,
+        args.in_subs,
+        parse_plot_taxa(args),
+        args.outplot,
+        args.ymax,
+        threads=args.threads,
+    )
 
 
 def plotbaminfo(args):
-    make_baminfo_plot(args.in_bam, args.in_bam_list, args.outplot)
+    make_baminfo_plot(
+        args.in_bam,
+        args.in_bam_list,
+        args.outplot,
+        threads=args.threads,
+        in_hist=args.in_hist,
+        tax=args.tax,
+    )
 
 
 def combine(args):
@@ -2381,22 +4287,31 @@ def combine(args):
     elif args.in_tsv_list:
         with open(args.in_tsv_list, "r") as file:
             input_files = [line.strip() for line in file if line.strip()]
-    parsed_data = {}
+    # if the same sample name comes up twice, the later file is used
+    sample_files = {}
     for file_path in input_files:
         sample_name = file_path.split("/")[-1].replace(".tsv", "")
-        parsed_data[sample_name] = []
-        with open(file_path, "r") as file:
-            for i, line in enumerate(file):
-                fields = line.strip().split("\t")
-                if i == 0:  # skip the header line
-                    continue
-                parsed_data[sample_name].append(fields)
-    tsvs_to_matrix(parsed_data, args.out_tsv, args.include, args.minreads)
+        sample_files[sample_name] = file_path
+    tsvs_to_matrix(
+        sample_files,
+        args.out_tsv,
+        args.include,
+        args.minreads,
+        args.out_long,
+        threads=args.threads,
+        cache=not args.no_cache,
+    )
 
 
 def krona(args):
     make_krona_xml(
-        args.in_tsv, args.in_tsv_list, args.out_xml, args.minreads, args.maxdamage
+        args.in_tsv,
+        args.in_tsv_list,
+        args.out_xml,
+        args.minreads,
+        args.maxdamage,
+        threads=args.threads,
+        cache=not args.no_cache,
     )
 
 
@@ -2478,6 +4393,24 @@ def main():
         action="store_true",
         help="Annotate output bam file with PMD tags  (default: not set)",
     )
+    parser_shrink.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="Number of threads for bam compression and decompression (default: 1)",
+    )
+    parser_shrink.add_argument(
+        "--compression_level",
+        type=int,
+        default=None,
+        help="Compression level of the output bam, from 0 (none) to 9 (smallest); e.g. 1 is much faster for intermediate files (default: htslib default)",
+    )
+    parser_shrink.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes to filter the bam file with, each on its own shard of reads (default: 1)",
+    )
     parser_shrink.set_defaults(func=shrink)
 
     # Compute
@@ -2514,14 +4447,147 @@ def main():
         default=29,
         help="Value of k for per-node counts of unique k-mers and duplicity (default: 29)",
     )
+    parser_compute.add_argument(
+        "--subs_positions",
+        type=int,
+        default=subs_max_position,
+        help=f"Number of positions from each end of the read to count substitutions at and write to the subs file; plotdamage plots up to {subs_max_position} (default: {subs_max_position})",
+    )
     parser_compute.add_argument(
         "--upto",
         type=str,
         default="family",
         help="Keep nodes up to and including this tax threshold; use root to disable (default: family)",
     )
+    parser_compute.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="Number of processes to use (default: 1)",
+    )
+    parser_compute.add_argument(
+        "--out_hist",
+        type=str,
+        default=None,
+        help="Optional path to also write the read length and mismatch histograms of every node, for plotbaminfo --in_hist (default: None)",
+    )
     parser_compute.set_defaults(func=compute)
 
+    # Run
+    parser_run = subparsers.add_parser(
+        "run",
+        help="Shrink and compute in a single pass, without writing the short BAM and LCA files unless asked to.",
+    )
+    parser_run.add_argument(
+        "--in_lca",
+        type=str,
+        required=True,
+        help="Path to the input LCA file (required)",
+    )
+    parser_run.add_argument(
+        "--in_bam",
+        type=str,
+        required=True,
+        help="Path to the input (read-sorted) BAM file (required)",
+    )
+    parser_run.add_argument(
+        "--out_tsv",
+        type=str,
+        required=True,
+        help="Path to the output tsv file (required)",
+    )
+    parser_run.add_argument(
+        "--out_subs",
+        type=str,
+        required=True,
+        help="Path to the output subs file (required)",
+    )
+    parser_run.add_argument(
+        "--stranded",
+        type=str,
+        required=True,
+        help="Either ss for single stranded or ds for double stranded (required)",
+    )
+    parser_run.add_argument(
+        "--out_lca",
+        type=str,
+        default=None,
+        help="Path to a short output LCA file, if you want to keep it (default: not written)",
+    )
+    parser_run.add_argument(
+        "--out_bam",
+        type=str,
+        default=None,
+        help="Path to a short output BAM file, if you want to keep it (default: not written)",
+    )
+    parser_run.add_argument(
+        "--mincount",
+        type=int,
+        default=5,
+        help="Minimum read count to keep a node (default: 5)",
+    )
+    parser_run.add_argument(
+        "--upto",
+        type=str,
+        default="family",
+        help="Keep nodes up to and including this tax threshold (default: family)",
+    )
+    parser_run.add_argument(
+        "--minsim",
+        type=float,
+        default=0.9,
+        help="Minimum similarity to reference to keep an alignment (default: 0.9)",
+    )
+    parser_run.add_argument(
+        "--exclude_keywords",
+        type=str,
+        nargs="+",
+        default=[],
+        help="Keyword(s) to exclude when filtering (default: none)",
+    )
+    parser_run.add_argument(
+        "--exclude_keyword_file",
+        type=str,
+        default=None,
+        help="File of keywords to exclude when filtering, one per line (default: none)",
+    )
+    parser_run.add_argument(
+        "--annotate_pmd",
+        action="store_true",
+        help="Annotate output bam file with PMD tags  (default: not set)",
+    )
+    parser_run.add_argument(
+        "--k",
+        type=int,
+        default=29,
+        help="Value of k for per-node counts of unique k-mers and duplicity (default: 29)",
+    )
+    parser_run.add_argument(
+        "--subs_positions",
+        type=int,
+        default=subs_max_position,
+        help=f"Number of positions from each end of the read to count substitutions at and write to the subs file; plotdamage plots up to {subs_max_position} (default: {subs_max_position})",
+    )
+    parser_run.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="Number of threads for bam compression and decompression (default: 1)",
+    )
+    parser_run.add_argument(
+        "--compression_level",
+        type=int,
+        default=None,
+        help="Compression level of the output bam, from 0 (none) to 9 (smallest); e.g. 1 is much faster for intermediate files (default: htslib default)",
+    )
+    parser_run.add_argument(
+        "--out_hist",
+        type=str,
+        default=None,
+        help="Optional path to also write the read length and mismatch histograms of every node, for plotbaminfo --in_hist (default: None)",
+    )
+    parser_run.set_defaults(func=run)
+
     # Extract
     parser_extract = subparsers.add_parser(
         "extract",
@@ -2537,13 +4603,25 @@ def main():
         "--out_bam",
         type=str,
         required=True,
-        help="Path to the filtered BAM file (required)",
+        help="Path to the filtered BAM file; with more than one keyword, each gets its own file named after it, e.g. OUT.1026.bam (required)",
     )
     parser_extract.add_argument(
         "--keyword",
         type=str,
-        required=True,
-        help="Keyword or phrase to filter for, e.g. a taxonomic node ID (required)",
+        nargs="+",
+        default=[],
+        help="Keyword(s) or phrase(s) to filter for, e.g. taxonomic node IDs (required, unless --keyword_file is given)",
+    )
+    parser_extract.add_argument(
+        "--keyword_file",
+        type=str,
+        default=None,
+        help="File of keywords to filter for, one per line, all extracted in one pass (default: none)",
+    )
+    parser_extract.add_argument(
+        "--exact_node",
+        action="store_true",
+        help="Only extract reads assigned to the keyword node itself, not underneath it (default: not set)",
     )
     parser_extract.add_argument(
         "--subset_header",
@@ -2555,8 +4633,60 @@ def main():
         action="store_true",
         help="Only keep alignments to the most-hit reference (default: not set)",
     )
+    parser_extract.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="Number of threads for bam compression and decompression (default: 1)",
+    )
+    parser_extract.add_argument(
+        "--compression_level",
+        type=int,
+        default=None,
+        help="Compression level of the output bam, from 0 (none) to 9 (smallest); e.g. 1 is much faster for intermediate files (default: htslib default)",
+    )
+    parser_extract.add_argument(
+        "--index",
+        type=str,
+        default=None,
+        help="Path to a tax index of the BAM file from bamdam index, used if the keyword is a tax id in it (default: IN_BAM.taxindex, if it exists and was made from IN_LCA)",
+    )
     parser_extract.set_defaults(func=extract)
 
+    # Index
+    parser_index = subparsers.add_parser(
+        "index",
+        help="Index where the alignments of each node are in a bam file, for fast extract.",
+    )
+    parser_index.add_argument(
+        "--in_bam",
+        type=str,
+        required=True,
+        help="Path to the (read-sorted) BAM file, e.g. from bamdam shrink (required)",
+    )
+    parser_index.add_argument(
+        "--in_lca", type=str, required=True, help="Path to the LCA file (required)"
+    )
+    parser_index.add_argument(
+        "--out_index",
+        type=str,
+        default=None,
+        help="Path to the output index (default: IN_BAM.taxindex, where extract looks for it)",
+    )
+    parser_index.add_argument(
+        "--upto",
+        type=str,
+        default="family",
+        help="Index nodes up to and including this tax threshold; use root to index every node (default: family)",
+    )
+    parser_index.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="Number of threads for bam decompression (default: 1)",
+    )
+    parser_index.set_defaults(func=index)
+
     # Plot damage
     parser_plotdamage = subparsers.add_parser(
         "plotdamage",
@@ -2573,7 +4703,27 @@ def main():
         help="Path to a text file contaning input subs files, one per line",
     )
     parser_plotdamage.add_argument(
-        "--tax", type=str, required=True, help="Taxonomic node ID (required)"
+        "--tax",
+        type=str,
+        nargs="+",
+        help="Taxonomic node ID(s) or name(s) to plot. With more than one taxon, a .pdf outplot gets one page per taxon, and otherwise each taxon gets its own png named after it (e.g. damage_plot.1026.png)",
+    )
+    parser_plotdamage.add_argument(
+        "--tax_file",
+        type=str,
+        help="Path to a text file of taxonomic node IDs or names to plot, one per line",
+    )
+    parser_plotdamage.add_argument(
+        "--in_tsv",
+        type=str,
+        nargs="+",
+        help="Plot every taxon with at least --minreads reads in these tsv file(s) from bamdam compute (summed over them), most reads first",
+    )
+    parser_plotdamage.add_argument(
+        "--minreads",
+        type=int,
+        default=100,
+        help="Minimum reads for a taxon in the --in_tsv files to be plotted (default: 100)",
     )
     parser_plotdamage.add_argument(
         "--outplot",
@@ -2584,6 +4734,12 @@ def main():
     parser_plotdamage.add_argument(
         "--ymax", type=str, default="0", help="Maximum for y axis (optional)"
     )
+    parser_plotdamage.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="Number of processes to draw the plots with, when there's more than one png to make (default: 1)",
+    )
     parser_plotdamage.set_defaults(func=plotdamage)
 
     # Plot bam info
@@ -2600,12 +4756,28 @@ def main():
     group_input_plotbaminfo.add_argument(
         "--in_bam_list", help="Path to a text file containing input bams, one per line"
     )
+    group_input_plotbaminfo.add_argument(
+        "--in_hist",
+        nargs="+",
+        help="Input histogram file(s) from bamdam compute --out_hist, to plot --tax without reading a bam",
+    )
+    parser_plotbaminfo.add_argument(
+        "--tax",
+        type=str,
+        help="Taxonomic node ID or name to plot from the --in_hist file(s)",
+    )
     parser_plotbaminfo.add_argument(
         "--outplot",
         type=str,
         default="baminfo_plot.png",
         help="Filename for the output plot, ending in .png or .pdf (default: baminfo_plot.png)",
     )
+    parser_plotbaminfo.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="Number of threads for bam compression and decompression (default: 1)",
+    )
     parser_plotbaminfo.set_defaults(func=plotbaminfo)
 
     # Combine
@@ -2627,6 +4799,12 @@ def main():
         default="combined.tsv",
         help="Path to output tsv file name (default: combined.tsv)",
     )
+    parser_combine.add_argument(
+        "--out_long",
+        type=str,
+        default=None,
+        help="Optional path to also write a long format tsv, with one line per taxon and sample it was found in, instead of one column per sample (default: None)",
+    )
     parser_combine.add_argument(
         "--minreads",
         type=float,
@@ -2640,6 +4818,17 @@ def main():
         default=["all"],
         help="Additional metrics to include in output file. Specify any combination of the first four, 'all', or 'none'. (default: all)",
     )
+    parser_combine.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="Number of processes to read the tsv files with. Each tsv is cached in a .bamdamcache file next to it the first time it's read (unless --no_cache), so later runs on the same files are quick either way (default: 1)",
+    )
+    parser_combine.add_argument(
+        "--no_cache",
+        action="store_true",
+        help="Don't read or write .bamdamcache files next to the tsv files; just parse the tsv files every time (default: false)",
+    )
     parser_combine.set_defaults(func=combine)
 
     # krona
@@ -2672,6 +4861,17 @@ def main():
         default=None,
         help="Force a maximum value for the 5' C-to-T damage color scale. If not provided, the maximum value is determined from the data, with a minimum threshold of 0.3. (not recommended by default)",
     )
+    parser_krona.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="Number of processes to read the tsv files with. Each tsv is cached in a .bamdamcache file next to it the first time it's read (unless --no_cache), so later runs on the same files are quick either way (default: 1)",
+    )
+    parser_krona.add_argument(
+        "--no_cache",
+        action="store_true",
+        help="Don't read or write .bamdamcache files next to the tsv files; just parse the tsv files every time (default: false)",
+    )
     parser_krona.set_defaults(func=krona)
 
     if len(sys.argv) == 1:
@@ -2692,15 +4892,68 @@ def main():
     if hasattr(args, "mincount") and not isinstance(args.mincount, int):
         parser.error(f"Invalid integer value for mincount: {args.mincount}")
     if hasattr(args, "k") and (
-        not isinstance(args.k, int) or not isinstance(args.k, int) or args.k > 50
+        not isinstance(args.k, int) or args.k < 1 or args.k > 32
     ):
         parser.error(
-            f"Invalid integer value for k : {args.k} (max 49, and that is much higher than recommended in any case)"
+            f"Invalid integer value for k : {args.k} (max 32, so that a k-mer fits in 64 bits)"
+        )
+    if hasattr(args, "subs_positions") and args.subs_positions < 1:
+        parser.error(
+            f"Invalid value for subs_positions: {args.subs_positions}. Must be at least 1."
         )
     if hasattr(args, "upto") and not re.match("^[a-z]+$", args.upto):
         parser.error(
             f"Invalid value for upto: {args.upto}. Must be a string of only lowercase letters."
         )
+    if hasattr(args, "threads") and args.threads < 1:
+        parser.error(f"Invalid value for threads: {args.threads}. Must be at least 1.")
+    if hasattr(args, "workers") and args.workers < 1:
+        parser.error(f"Invalid value for workers: {args.workers}. Must be at least 1.")
+    if (
+        hasattr(args, "compression_level")
+        and args.compression_level is not None
+        and not 0 <= args.compression_level <= 9
+    ):
+        parser.error(
+            f"Invalid value for compression_level: {args.compression_level}. Must be between 0 and 9."
+        )
+    if hasattr(args, "keyword_file") and not args.keyword and not args.keyword_file:
+        parser.error("Please give a keyword with --keyword or --keyword_file.")
+    if (
+        hasattr(args, "keyword_file")
+        and args.keyword_file
+        and not os.path.exists(args.keyword_file)
+    ):
+        parser.error(f"Keyword file path does not exist: {args.keyword_file}")
+    if (
+        hasattr(args, "tax_file")
+        and not args.tax
+        and not args.tax_file
+        and not args.in_tsv
+    ):
+        parser.error("Please give the taxa to plot with --tax, --tax_file or --in_tsv.")
+    if (
+        hasattr(args, "tax_file")
+        and args.tax_file
+        and not os.path.exists(args.tax_file)
+    ):
+        parser.error(f"Tax file path does not exist: {args.tax_file}")
+    if hasattr(args, "tax_file") and args.in_tsv:
+        for tsv in args.in_tsv:
+            if not os.path.exists(tsv):
+                parser.error(f"Input tsv path does not exist: {tsv}")
+    if hasattr(args, "in_hist") and args.in_hist and not args.tax:
+        parser.error("Please give the taxon to plot from --in_hist with --tax.")
+    if hasattr(args, "in_hist") and args.tax and not args.in_hist:
+        parser.error(
+            "--tax only works with --in_hist. To plot one taxon from a bam, bamdam extract it first."
+        )
+    if hasattr(args, "in_hist") and args.in_hist:
+        for hist in args.in_hist:
+            if not os.path.exists(hist):
+                parser.error(f"Input histogram path does not exist: {hist}")
+    if hasattr(args, "index") and args.index and not os.path.exists(args.index):
+        parser.error(f"Index path does not exist: {args.index}")
     if hasattr(args, "minsim") and not isinstance(args.minsim, float):
         parser.error(f"Invalid float value for minsim: {args.minsim}")
     if hasattr(args, "in_lca") and not os.path.exists(args.in_lca):
@@ -2787,6 +5040,40 @@ def main():
             print(f"exclude_keywords: {args.exclude_keywords}")
         if hasattr(args, "annotate_pmd") and args.annotate_pmd:
             print(f"annotate_pmd: {args.annotate_pmd}")
+        print(f"threads: {args.threads}")
+        if args.compression_level is not None:
+            print(f"compression_level: {args.compression_level}")
+        if args.workers > 1:
+            print(f"workers: {args.workers}")
+
+    elif args.command == "run":
+        print("Hello! You are running bamdam run with the following arguments:")
+        print(f"in_lca: {args.in_lca}")
+        print(f"in_bam: {args.in_bam}")
+        print(f"out_tsv: {args.out_tsv}")
+        print(f"out_subs: {args.out_subs}")
+        if args.out_lca:
+            print(f"out_lca: {args.out_lca}")
+        if args.out_bam:
+            print(f"out_bam: {args.out_bam}")
+        print(f"stranded: {args.stranded}")
+        print(f"mincount: {args.mincount}")
+        print(f"upto: {args.upto}")
+        print(f"minsim: {args.minsim}")
+        if hasattr(args, "exclude_keyword_file") and args.exclude_keyword_file:
+            print(f"exclude_keywords: loaded from {args.exclude_keyword_file}")
+        if hasattr(args, "exclude_keywords") and args.exclude_keywords:
+            print(f"exclude_keywords: {args.exclude_keywords}")
+        if hasattr(args, "annotate_pmd") and args.annotate_pmd:
+            print(f"annotate_pmd: {args.annotate_pmd}")
+        print(f"k: {args.k}")
+        if args.subs_positions != subs_max_position:
+            print(f"subs_positions: {args.subs_positions}")
+        print(f"threads: {args.threads}")
+        if args.compression_level is not None:
+            print(f"compression_level: {args.compression_level}")
+        if args.out_hist:
+            print(f"out_hist: {args.out_hist}")
 
     elif args.command == "compute":
         print("Hello! You are running bamdam compute with the following arguments:")
@@ -2796,14 +5083,37 @@ def main():
         print(f"out_subs: {args.out_subs}")
         print(f"stranded: {args.stranded}")
         print(f"k: {args.k}")
+        if args.subs_positions != subs_max_position:
+            print(f"subs_positions: {args.subs_positions}")
         print(f"upto: {args.upto}")
+        print(f"threads: {args.threads}")
+        if args.out_hist:
+            print(f"out_hist: {args.out_hist}")
 
     elif args.command == "extract":
         print("Hello! You are running bamdam extract with the following arguments:")
         print(f"in_bam: {args.in_bam}")
         print(f"in_lca: {args.in_lca}")
         print(f"out_bam: {args.out_bam}")
-        print(f"keyword: {args.keyword}")
+        if args.keyword:
+            print(f"keyword: {' '.join(args.keyword)}")
+        if args.keyword_file:
+            print(f"keywords: loaded from {args.keyword_file}")
+        print(f"threads: {args.threads}")
+        if args.compression_level is not None:
+            print(f"compression_level: {args.compression_level}")
+        if args.exact_node:
+            print(f"exact_node: {args.exact_node}")
+        if args.index is not None:
+            print(f"index: {args.index}")
+
+    elif args.command == "index":
+        print("Hello! You are running bamdam index with the following arguments:")
+        print(f"in_bam: {args.in_bam}")
+        print(f"in_lca: {args.in_lca}")
+        print(f"out_index: {args.out_index or args.in_bam + '.taxindex'}")
+        print(f"upto: {args.upto}")
+        print(f"threads: {args.threads}")
 
     elif args.command == "combine":
         print("Hello! You are running bamdam combine with the following arguments:")
@@ -2812,9 +5122,14 @@ def main():
         if hasattr(args, "input_files") and args.in_tsv_files:
             print(f"Input file list: {args.in_tsv_files}")
         print(f"Output file: {args.out_tsv}")
+        if args.out_long:
+            print(f"Long format output file: {args.out_long}")
         print(f"Min reads: {args.minreads}")
         if args.include:
             print(f"Included metrics: {', '.join(args.include)}")
+        print(f"threads: {args.threads}")
+        if args.no_cache:
+            print("Not caching the tsv files")
 
     elif args.command == "krona":
         print("Hello! You are running bamdam krona with the following arguments:")
@@ -2826,6 +5141,9 @@ def main():
         print(f"Min reads: {args.minreads}")
         if hasattr(args, "maxdamage") and args.maxdamage is not None:
             print(f"Max damage value for colour scale: {args.maxdamage}")
+        print(f"threads: {args.threads}")
+        if args.no_cache:
+            print("Not caching the tsv files")
 
     if not tqdm_imported:
         print(
@@ -3,8 +3,13 @@
 Simple tests for bamdam commands.
 """
 
+import os
 import pytest
 import argparse
+import pickle
+import re
+import numpy as np
+import pysam
 from pathlib import Path
 
 
@@ -12,11 +17,27 @@ from pathlib import Path
 from bamdam.bamdam import (
     shrink,
     compute,
+    run,
     extract,
+    index,
     plotdamage,
     plotbaminfo,
     combine,
     krona,
+    HyperLogLog,
+    hash64,
+    get_pmd,
+    get_pmds,
+    mismatch_table,
+    subs_index,
+    subs_max_position,
+    calculate_dust,
+    calculate_dusts,
+    ReferenceCounts,
+    subset_header_references,
+    baminfo_counts,
+    node_histogram_counts,
+    plan_compute_chunks,
 )
 
 
@@ -43,9 +64,907 @@ def test_shrink(tmp_path):
     args.exclude_keywords = []
     args.exclude_keyword_file = None
     args.annotate_pmd = False
+    args.threads = 1
+    args.compression_level = None
+    args.workers = 1
 
     shrink(args)
 
     # Check if output files exist
     assert out_lca.exists()
     assert out_bam.exists()
+
+
+def test_shrink_threads(tmp_path):
+    """Test that shrink writes the same alignments with htslib threads and another compression level."""
+    test_shrink(tmp_path)
+
+    args = argparse.Namespace()
+    args.in_lca = "tests/data/small.lca"
+    args.in_bam = "tests/data/small.bam"
+    args.out_lca = str(tmp_path / "threads.lca")
+    args.out_bam = str(tmp_path / "threads.bam")
+    args.stranded = "ds"
+    args.upto = "family"
+    args.mincount = 1
+    args.minsim = 0.05
+    args.exclude_keywords = []
+    args.exclude_keyword_file = None
+    args.annotate_pmd = False
+    args.threads = 2
+    args.compression_level = 1
+    args.workers = 1
+
+    shrink(args)
+
+    with pysam.AlignmentFile(args.out_bam) as threadsbam:
+        with pysam.AlignmentFile(str(tmp_path / "small.bam")) as shrinkbam:
+            assert [read.to_string() for read in threadsbam] == [
+                read.to_string() for read in shrinkbam
+            ]
+
+
+def test_shrink_workers(tmp_path):
+    """Test that shrink writes the same alignments when the bam is filtered in shards by several processes."""
+    test_shrink(tmp_path)
+
+    args = argparse.Namespace()
+    args.in_lca = "tests/data/small.lca"
+    args.in_bam = "tests/data/small.bam"
+    args.out_lca = str(tmp_path / "workers.lca")
+    args.out_bam = str(tmp_path / "workers.bam")
+    args.stranded = "ds"
+    args.upto = "family"
+    args.mincount = 1
+    args.minsim = 0.05
+    args.exclude_keywords = []
+    args.exclude_keyword_file = None
+    args.annotate_pmd = False
+    args.threads = 1
+    args.compression_level = None
+    args.workers = 3
+
+    shrink(args)
+
+    with pysam.AlignmentFile(args.out_bam) as workersbam:
+        with pysam.AlignmentFile(str(tmp_path / "small.bam")) as shrinkbam:
+            assert [read.to_string() for read in workersbam] == [
+                read.to_string() for read in shrinkbam
+            ]
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_compute(tmp_path):
+    """Test the compute command on the output of shrink."""
+    test_shrink(tmp_path)
+
+    out_tsv = tmp_path / "small.tsv"
+    out_subs = tmp_path / "small.subs.txt"
+
+    args = argparse.Namespace()
+    args.in_lca = str(tmp_path / "small.lca")
+    args.in_bam = str(tmp_path / "small.bam")
+    args.out_tsv = str(out_tsv)
+    args.out_subs = str(out_subs)
+    args.stranded = "ds"
+    args.k = 29
+    args.subs_positions = 15
+    args.upto = "family"
+    args.threads = 1
+    args.out_hist = None
+
+    compute(args)
+
+    assert out_tsv.exists()
+    assert out_subs.exists()
+    lines = out_tsv.read_text().splitlines()
+    assert lines[0].startswith("TaxNodeID\tTaxName\tTotalReads")
+    # the family every read rolls up into has all the reads assigned below it
+    rows = {line.split("\t")[0]: line.split("\t") for line in lines[1:]}
+    assert int(rows["3931"][2]) >= int(rows["1699513"][2])
+
+
+def test_compute_subs_positions(tmp_path):
+    """Test that compute --subs_positions only changes how far into the reads the subs file goes."""
+    test_compute(tmp_path)
+
+    def subs_entries(path, upto):
+        # taxon -> subs file entries out to upto positions from either end
+        entries = {}
+        for line in path.read_text().splitlines():
+            taxon, _, subs = line.split("\t")
+            entries[taxon] = [
+                entry
+                for entry in subs.split()
+                if abs(int(entry.split(":")[0][2:])) <= upto
+            ]
+        return entries
+
+    for positions in [5, 30]:
+        args = argparse.Namespace()
+        args.in_lca = str(tmp_path / "small.lca")
+        args.in_bam = str(tmp_path / "small.bam")
+        args.out_tsv = str(tmp_path / f"positions{positions}.tsv")
+        args.out_subs = str(tmp_path / f"positions{positions}.subs.txt")
+        args.stranded = "ds"
+        args.k = 29
+        args.subs_positions = positions
+        args.upto = "family"
+        args.threads = 1
+        args.out_hist = None
+
+        compute(args)
+
+        assert Path(args.out_tsv).read_text() == (tmp_path / "small.tsv").read_text()
+        subs = subs_entries(Path(args.out_subs), 30)
+        assert subs == subs_entries(Path(args.out_subs), positions)
+        assert subs_entries(Path(args.out_subs), 15) == subs_entries(
+            tmp_path / "small.subs.txt", min(positions, 15)
+        )
+    # the test reads are ~33 bases, so they reach past 15 from both ends
+    assert any(
+        abs(int(entry.split(":")[0][2:])) > 15
+        for entries in subs.values()
+        for entry in entries
+    )
+
+
+def test_compute_threads(tmp_path, monkeypatch):
+    """Test that compute gives the same output with several processes as with one, and with the bam split into many chunks."""
+    test_shrink(tmp_path)
+
+    # copy the reads of the test data under new names until their alignments span a few bgzf blocks (after the large header)
+    lcalines = (tmp_path / "small.lca").read_text().splitlines(keepends=True)
+    with pysam.AlignmentFile(str(tmp_path / "small.bam"), "rb") as bam:
+        reads = list(bam)
+        with pysam.AlignmentFile(str(tmp_path / "many.bam"), "wb", template=bam) as out:
+            with open(tmp_path / "many.lca", "w") as lcafile:
+                for i in range(1000):
+                    for line in lcalines:
+                        name = line.split("\t")[0].rsplit(":", 3)[0]
+                        lcafile.write(f"{name}_{i}" + line[len(name) :])
+                    for read in reads:
+                        copy = pysam.AlignedSegment.fromstring(
+                            read.to_string(), bam.header
+                        )
+                        copy.query_name = f"{read.query_name}_{i}"
+                        out.write(copy)
+
+    outputs = []
+    for threads, chunk_bytes in [(1, 1 << 30), (1, 1 << 10), (2, 1 << 10)]:
+        monkeypatch.setattr("bamdam.bamdam.compute_chunk_bytes", chunk_bytes)
+        args = argparse.Namespace()
+        args.in_lca = str(tmp_path / "many.lca")
+        args.in_bam = str(tmp_path / "many.bam")
+        args.out_tsv = str(tmp_path / f"many.{threads}.{chunk_bytes}.tsv")
+        args.out_subs = str(tmp_path / f"many.{threads}.{chunk_bytes}.subs.txt")
+        args.stranded = "ds"
+        args.k = 29
+        args.subs_positions = 15
+        args.upto = "family"
+        args.threads = threads
+        args.out_hist = None
+
+        compute(args)
+
+        outputs.append(
+            (Path(args.out_tsv).read_text(), Path(args.out_subs).read_text())
+        )
+
+    assert outputs[0] == outputs[1] == outputs[2]
+    assert outputs[0][0].splitlines()[1].split("\t")[2] == str(3 * 1000)
+
+    # each chunk after the first starts at the first alignment of a read, right after the lca line of the read before it
+    with pysam.AlignmentFile(str(tmp_path / "many.bam"), "rb") as bam:
+        bam_offset = bam.tell()
+        readstarts = {}
+        oldreadname = None
+        while True:
+            offset_here = bam.tell()
+            read = next(bam, None)
+            if read is None:
+                break
+            if read.query_name != oldreadname:
+                readstarts[offset_here] = oldreadname
+            oldreadname = read.query_name
+    lca = (tmp_path / "many.lca").read_bytes()
+    chunks = list(
+        plan_compute_chunks(
+            str(tmp_path / "many.bam"),
+            str(tmp_path / "many.lca"),
+            bam_offset,
+            0,
+            1 << 10,
+        )
+    )
+    assert len(chunks) > 2
+    for (_, _, stop_offset), (chunk_bam_offset, chunk_lca_offset, _) in zip(
+        chunks, chunks[1:]
+    ):
+        assert stop_offset == chunk_bam_offset
+        lastline = lca[:chunk_lca_offset].splitlines()[-1]
+        assert lastline.startswith(readstarts[chunk_bam_offset].encode() + b":")
+
+
+def test_compute_against_baseline(tmp_path):
+    """Pin compute's tsv on the test data, next to the tsv bamdam wrote before per-node stats were rolled up at the end."""
+    test_compute(tmp_path)
+
+    # every read in the test data is on the same lineage, so all rows have the same stats.
+    # columns are TotalReads, Duplicity, MeanDust, Damage+1, Damage-1, MeanLength, ANI, AvgReadGC, AvgRefGC,
+    # UniqueKmers, RatioDupKmers and TotalAlignments
+    nodes = ["219896", "178174", "1699522", "1699513", "3931"]
+    old_stats = "2 1.0 1.4 0 0.0 32.5 0.9692 0.444 0.477 9 0.0 2".split()
+    new_stats = "3 1.0 1.36 1.0 0.0 32.67 0.9592 0.437 0.48 14 0.0 3".split()
+
+    def stats(tsv):
+        lines = tsv.read_text().splitlines()[1:]
+        assert [line.split("\t")[0] for line in lines] == nodes
+        return [line.split("\t")[2:14] for line in lines]
+
+    assert stats(tmp_path / "small.tsv") == [new_stats] * len(nodes)
+
+    # the only difference is that the final read of the bam used to be dropped, so without it the old tsv comes back exactly.
+    # (the subs file has the same entries too, but within a position they are now in A/C/G/T order rather than first-seen order)
+    with pysam.AlignmentFile(str(tmp_path / "small.bam"), "rb") as bam:
+        reads = list(bam)
+        last = reads[-1].query_name
+        with pysam.AlignmentFile(
+            str(tmp_path / "nolast.bam"), "wb", template=bam
+        ) as out:
+            for read in reads:
+                if read.query_name != last:
+                    out.write(read)
+    (tmp_path / "nolast.lca").write_text(
+        "".join(
+            line
+            for line in (tmp_path / "small.lca").read_text().splitlines(keepends=True)
+            if not line.startswith(last + ":")
+        )
+    )
+
+    args = argparse.Namespace()
+    args.in_lca = str(tmp_path / "nolast.lca")
+    args.in_bam = str(tmp_path / "nolast.bam")
+    args.out_tsv = str(tmp_path / "nolast.tsv")
+    args.out_subs = str(tmp_path / "nolast.subs.txt")
+    args.stranded = "ds"
+    args.k = 29
+    args.subs_positions = 15
+    args.upto = "family"
+    args.threads = 1
+    args.out_hist = None
+
+    compute(args)
+
+    assert stats(tmp_path / "nolast.tsv") == [old_stats] * len(nodes)
+
+
+def test_compute_dust_with_ns(tmp_path):
+    """Test that reads with non-ACGT characters are left out of MeanDust rather than counted as the mean so far."""
+    test_shrink(tmp_path)
+
+    # put an N in the first read of the test data
+    with pysam.AlignmentFile(str(tmp_path / "small.bam"), "rb") as bam:
+        reads = list(bam)
+        first = reads[0].query_name
+        with pysam.AlignmentFile(str(tmp_path / "ns.bam"), "wb", template=bam) as out:
+            for read in reads:
+                if read.query_name == first and read.query_sequence:
+                    qualities = read.query_qualities
+                    read.query_sequence = "N" + read.query_sequence[1:]
+                    read.query_qualities = qualities
+                out.write(read)
+    dusts = {
+        read.query_name: calculate_dust(read.query_sequence)
+        for read in reads
+        if read.query_sequence
+    }
+    assert len(dusts) == 3
+
+    args = argparse.Namespace()
+    args.in_lca = str(tmp_path / "small.lca")
+    args.in_bam = str(tmp_path / "ns.bam")
+    args.out_tsv = str(tmp_path / "ns.tsv")
+    args.out_subs = str(tmp_path / "ns.subs.txt")
+    args.stranded = "ds"
+    args.k = 29
+    args.subs_positions = 15
+    args.upto = "family"
+    args.threads = 1
+    args.out_hist = None
+
+    compute(args)
+
+    others = [dust for name, dust in dusts.items() if name != first]
+    # before, the N read kept the running mean at the point it was seen: being first, it counted as 0, giving sum(others) / 3
+    old_dust = round(sum(others) / 3, 2)
+    new_dust = round(sum(others) / 2, 2)
+    assert old_dust != new_dust
+    for line in Path(args.out_tsv).read_text().splitlines()[1:]:
+        assert float(line.split("\t")[4]) == new_dust
+
+
+def test_run(tmp_path):
+    """Test that run gives the same output as shrink followed by compute."""
+    test_compute(tmp_path)
+
+    args = argparse.Namespace()
+    args.in_lca = "tests/data/small.lca"
+    args.in_bam = "tests/data/small.bam"
+    args.out_tsv = str(tmp_path / "run.tsv")
+    args.out_subs = str(tmp_path / "run.subs.txt")
+    args.out_lca = None
+    args.out_bam = str(tmp_path / "run.bam")
+    args.stranded = "ds"
+    args.upto = "family"
+    args.mincount = 1
+    args.minsim = 0.05
+    args.exclude_keywords = []
+    args.exclude_keyword_file = None
+    args.annotate_pmd = False
+    args.k = 29
+    args.subs_positions = 15
+    args.threads = 1
+    args.compression_level = None
+    args.out_hist = None
+
+    run(args)
+
+    assert Path(args.out_tsv).read_text() == (tmp_path / "small.tsv").read_text()
+    assert Path(args.out_subs).read_text() == (tmp_path / "small.subs.txt").read_text()
+    with pysam.AlignmentFile(args.out_bam) as runbam:
+        with pysam.AlignmentFile(str(tmp_path / "small.bam")) as shrinkbam:
+            assert [read.to_string() for read in runbam] == [
+                read.to_string() for read in shrinkbam
+            ]
+    # the short lca file was only temporary
+    assert not Path(args.out_tsv + ".lca.tmp").exists()
+
+
+def test_compute_histograms(tmp_path):
+    """Test that the histograms from compute match plotbaminfo on the extracted reads, and plot from them."""
+    test_shrink(tmp_path)
+
+    args = argparse.Namespace()
+    args.in_lca = str(tmp_path / "small.lca")
+    args.in_bam = str(tmp_path / "small.bam")
+    args.out_tsv = str(tmp_path / "hist.tsv")
+    args.out_subs = str(tmp_path / "hist.subs.txt")
+    args.stranded = "ds"
+    args.k = 29
+    args.subs_positions = 15
+    args.upto = "family"
+    args.threads = 1
+    args.out_hist = str(tmp_path / "small.hist")
+
+    compute(args)
+
+    args = argparse.Namespace()
+    args.in_bam = str(tmp_path / "small.bam")
+    args.in_lca = str(tmp_path / "small.lca")
+    args.out_bam = str(tmp_path / "extracted.bam")
+    args.keyword = "3931"
+    args.exact_node = False
+    args.subset_header = False
+    args.only_top_ref = False
+    args.threads = 1
+    args.compression_level = None
+    args.index = None
+
+    extract(args)
+
+    mismatch_counts, read_length_counts = baminfo_counts(args.out_bam)
+    hist_mismatch_counts, hist_read_length_counts = node_histogram_counts(
+        str(tmp_path / "small.hist"), "3931"
+    )
+    assert hist_read_length_counts == read_length_counts
+    assert hist_mismatch_counts == pytest.approx(mismatch_counts)
+    assert node_histogram_counts(str(tmp_path / "small.hist"), "not a taxon") is None
+
+    args = argparse.Namespace()
+    args.in_bam = None
+    args.in_bam_list = None
+    args.in_hist = [str(tmp_path / "small.hist")]
+    args.tax = "3931"
+    args.outplot = str(tmp_path / "baminfo.png")
+    args.threads = 1
+
+    plotbaminfo(args)
+
+    assert Path(args.outplot).exists()
+
+
+def test_plotdamage(tmp_path, capsys):
+    """Test plotting many taxa at once, into pngs in parallel and into one pdf."""
+    test_compute(tmp_path)
+
+    args = argparse.Namespace()
+    args.in_subs = [str(tmp_path / "small.subs.txt")]
+    args.in_subs_list = None
+    args.tax = ["3931", "not a taxon"]
+    args.tax_file = None
+    args.in_tsv = [str(tmp_path / "small.tsv")]
+    args.minreads = 3
+    args.outplot = str(tmp_path / "damage.png")
+    args.ymax = "0"
+    args.threads = 2
+
+    plotdamage(args)
+
+    taxa = ["3931"] + [
+        line.split("\t")[0]
+        for line in (tmp_path / "small.tsv").read_text().splitlines()[1:]
+        if int(line.split("\t")[2]) >= 3 and line.split("\t")[0] != "3931"
+    ]
+    assert len(taxa) > 2
+    for tax in taxa:
+        assert (tmp_path / f"damage.{tax}.png").exists()
+    assert not (tmp_path / "damage.not_a_taxon.png").exists()
+
+    args.outplot = str(tmp_path / "damage.pdf")
+    args.threads = 1
+
+    plotdamage(args)
+
+    assert len(re.findall(rb"/Type /Page\b", Path(args.outplot).read_bytes())) == len(
+        taxa
+    )
+
+    # anything that isn't a tax id or tax name is matched as a regular expression on the start of the line, as before
+    args.tax = [".*\tMyrtaceae\t"]
+    args.in_tsv = None
+    args.outplot = str(tmp_path / "regex.png")
+
+    plotdamage(args)
+
+    assert Path(args.outplot).exists()
+
+    # with none of the taxa found, plotdamage stops with an error listing them
+    args.tax = ["not a taxon", "12345678"]
+    capsys.readouterr()
+    with pytest.raises(SystemExit):
+        plotdamage(args)
+    assert "not a taxon, 12345678" in capsys.readouterr().out
+
+
+def test_combine(tmp_path):
+    """Test that combine's matrix and long format outputs agree."""
+    test_compute(tmp_path)
+    for sample_name in ["one", "two"]:
+        (tmp_path / f"{sample_name}.tsv").write_text(
+            (tmp_path / "small.tsv").read_text()
+        )
+
+    args = argparse.Namespace()
+    args.in_tsv = [str(tmp_path / "one.tsv"), str(tmp_path / "two.tsv")]
+    args.in_tsv_list = None
+    args.out_tsv = str(tmp_path / "combined.tsv")
+    args.out_long = str(tmp_path / "combined.long.tsv")
+    args.minreads = 1
+    args.include = ["damage"]
+    args.threads = 1
+    args.no_cache = False
+
+    combine(args)
+
+    lines = Path(args.out_tsv).read_text().splitlines()
+    assert (
+        lines[0]
+        == "Tax\tTotalReads\tMeanDamage\tone_reads\tone_damage\ttwo_reads\ttwo_damage"
+    )
+    rows = [line.split("\t") for line in lines[1:]]
+    long_lines = Path(args.out_long).read_text().splitlines()
+    assert long_lines[0] == "Tax\tSample\tReads\tDamage"
+    long_rows = [line.split("\t") for line in long_lines[1:]]
+    assert len(long_rows) == 2 * len(rows)
+    for row, one, two in zip(rows, long_rows[::2], long_rows[1::2]):
+        assert int(row[1]) == 2 * int(row[3])
+        assert one == [row[0], "one"] + row[3:5]
+        assert two == [row[0], "two"] + row[5:7]
+
+
+def test_tsv_cache(tmp_path):
+    """Test that combine gives the same output from the tsv caches, in parallel, without caches, and after a tsv changes."""
+    test_combine(tmp_path)
+    assert (tmp_path / "one.tsv.bamdamcache").exists()
+    combined = Path(tmp_path / "combined.tsv").read_text()
+
+    args = argparse.Namespace()
+    args.in_tsv = [str(tmp_path / "one.tsv"), str(tmp_path / "two.tsv")]
+    args.in_tsv_list = None
+    args.out_tsv = str(tmp_path / "again.tsv")
+    args.out_long = None
+    args.minreads = 1
+    args.include = ["damage"]
+    args.threads = 2
+    args.no_cache = False
+
+    combine(args)
+    assert Path(args.out_tsv).read_text() == combined
+
+    # a broken cache is just ignored and remade
+    (tmp_path / "one.tsv.bamdamcache").write_bytes(b"not a cache")
+    combine(args)
+    assert Path(args.out_tsv).read_text() == combined
+    assert (tmp_path / "one.tsv.bamdamcache").read_bytes() != b"not a cache"
+
+    # without caches, the tsvs are just parsed and no cache is written
+    for cache in tmp_path.glob("*.bamdamcache"):
+        cache.unlink()
+    args.no_cache = True
+    combine(args)
+    assert Path(args.out_tsv).read_text() == combined
+    assert not list(tmp_path.glob("*.bamdamcache"))
+    args.no_cache = False
+
+    # drop the top taxon from one of the samples
+    lines = (tmp_path / "two.tsv").read_text().splitlines(keepends=True)
+    (tmp_path / "two.tsv").write_text("".join(lines[:1] + lines[2:]))
+    top_tax, top_reads = combined.splitlines()[1].split("\t")[:2]
+    args.threads = 1
+
+    combine(args)
+    rows = [line.split("\t") for line in Path(args.out_tsv).read_text().splitlines()]
+    assert [row[1] for row in rows if row[0] == top_tax] == [str(int(top_reads) // 2)]
+
+
+def test_krona(tmp_path):
+    """Test krona on the output of compute, and on a tree deeper than the recursion limit."""
+    test_compute(tmp_path)
+
+    args = argparse.Namespace()
+    args.in_tsv = [str(tmp_path / "small.tsv")]
+    args.in_tsv_list = None
+    args.out_xml = str(tmp_path / "small.xml")
+    args.minreads = 1
+    args.maxdamage = None
+    args.threads = 1
+    args.no_cache = False
+
+    krona(args)
+
+    xml = Path(args.out_xml).read_text()
+    assert "<taxid><val>3931</val></taxid>" in xml
+
+    # a chain of clades 1500 deep under one family
+    depth = 1500
+    header = "TaxNodeID\tTaxName\tTotalReads\tDuplicity\tMeanDust\tDamage+1\tDamage-1\tMeanLength\tTaxPath"
+    lines = [header, '1\tf\t10\t1\t1\t0.1\t0.1\t50\t"1:f:family"']
+    for taxid in range(2, depth + 2):
+        taxpath = f"{taxid}:c{taxid}:clade;{taxid - 1}:c{taxid - 1}:clade;1:f:family"
+        lines.append(f'{taxid}\tc{taxid}\t10\t1\t1\t0.1\t0.1\t50\t"{taxpath}"')
+    args.in_tsv = [str(tmp_path / "deep1.tsv"), str(tmp_path / "deep2.tsv")]
+    for deep_tsv in args.in_tsv:
+        Path(deep_tsv).write_text("\n".join(lines) + "\n")
+    args.out_xml = str(tmp_path / "deep.xml")
+
+    krona(args)
+
+    xml = Path(args.out_xml).read_text()
+    assert xml.count("</node>") == depth + 1  # the chain and the family
+    assert "<reads><val>20.0</val><val>10.0</val><val>10.0</val></reads>" in xml
+
+
+def test_index(tmp_path, capsys):
+    """Test that extract gives the same alignments with and without a tax index."""
+    test_shrink(tmp_path)
+
+    def extract_all(nodes):
+        extracted = []
+        for node in nodes:
+            for subset_header in [False, True]:
+                args = argparse.Namespace()
+                args.in_bam = str(tmp_path / "small.bam")
+                args.in_lca = str(tmp_path / "small.lca")
+                args.out_bam = str(tmp_path / "extracted.bam")
+                args.keyword = node
+                args.subset_header = subset_header
+                args.only_top_ref = False
+                args.threads = 1
+                args.compression_level = None
+                args.index = None
+
+                extract(args)
+
+                with pysam.AlignmentFile(args.out_bam) as extractedbam:
+                    extracted.append([read.to_string() for read in extractedbam])
+        return extracted
+
+    nodes = sorted(
+        {
+            field.split(":")[0]
+            for line in (tmp_path / "small.lca").read_text().splitlines()
+            for field in line.split("\t")[1:]
+        }
+    )
+    scanned = extract_all(nodes)
+
+    args = argparse.Namespace()
+    args.in_bam = str(tmp_path / "small.bam")
+    args.in_lca = str(tmp_path / "small.lca")
+    args.out_index = None
+    args.upto = "root"
+    args.threads = 1
+
+    index(args)
+
+    # extract finds the index next to the bam by itself
+    assert (tmp_path / "small.bam.taxindex").exists()
+    capsys.readouterr()
+    assert extract_all(nodes) == scanned
+    assert "Using the tax index" in capsys.readouterr().out
+    assert all(scanned)
+
+    def extract_node(in_lca, index):
+        args = argparse.Namespace()
+        args.in_bam = str(tmp_path / "small.bam")
+        args.in_lca = in_lca
+        args.out_bam = str(tmp_path / "extracted.bam")
+        args.keyword = nodes[0]
+        args.subset_header = False
+        args.only_top_ref = False
+        args.threads = 1
+        args.compression_level = None
+        args.index = index
+
+        extract(args)
+
+        return capsys.readouterr().out
+
+    # the index is only found by itself for the lca file it was made from, but can be given for a copy of it
+    copied_lca = tmp_path / "copied.lca"
+    copied_lca.write_text((tmp_path / "small.lca").read_text())
+    assert "Using the tax index" not in extract_node(str(copied_lca), None)
+    assert "Using the tax index" in extract_node(
+        str(copied_lca), str(tmp_path / "small.bam.taxindex")
+    )
+    # and not at all once the lca file has changed
+    os.utime(tmp_path / "small.lca", ns=(0, 0))
+    assert "does not match" in extract_node(str(tmp_path / "small.lca"), None)
+
+
+def test_extract_tax_id(tmp_path):
+    """Test that extract matches whole tax ids and names, not parts of them, and only the node itself with exact_node."""
+    test_shrink(tmp_path)
+
+    for keyword, exact_node, expected_reads in [
+        ("178174", False, 3),
+        ("17817", False, 0),
+        ("Syzygium", False, 3),
+        ("Syzyg", False, 0),
+        ("178174:Syzygium:genus", False, 3),
+        ("178174", True, 0),
+        ("219896", True, 3),
+    ]:
+        args = argparse.Namespace()
+        args.in_bam = str(tmp_path / "small.bam")
+        args.in_lca = str(tmp_path / "small.lca")
+        args.out_bam = str(tmp_path / "extracted.bam")
+        args.keyword = keyword
+        args.exact_node = exact_node
+        args.subset_header = True
+        args.only_top_ref = False
+        args.threads = 1
+        args.compression_level = None
+        args.index = None
+
+        extract(args)
+
+        if expected_reads:
+            with pysam.AlignmentFile(args.out_bam) as extractedbam:
+                assert len({read.query_name for read in extractedbam}) == expected_reads
+            Path(args.out_bam).unlink()
+        else:
+            assert not Path(args.out_bam).exists()
+        assert not Path(args.out_bam + ".tmp").exists()
+
+
+def test_extract_many(tmp_path):
+    """Test that extracting several keywords at once gives the same bams as extracting them one by one."""
+    test_shrink(tmp_path)
+
+    keywords = ["178174", "3931", "Myrtoideae"]
+    (tmp_path / "keywords.txt").write_text("\n".join(keywords[1:]) + "\n")
+
+    def extract_keywords(keyword, keyword_file, out_bam):
+        args = argparse.Namespace()
+        args.in_bam = str(tmp_path / "small.bam")
+        args.in_lca = str(tmp_path / "small.lca")
+        args.out_bam = str(tmp_path / out_bam)
+        args.keyword = keyword
+        args.keyword_file = keyword_file
+        args.subset_header = True
+        args.only_top_ref = False
+        args.threads = 1
+        args.compression_level = None
+        args.index = None
+        extract(args)
+
+    extract_keywords(keywords[:1], str(tmp_path / "keywords.txt"), "many.bam")
+    for keyword in keywords:
+        extract_keywords([keyword], None, "one.bam")
+        with pysam.AlignmentFile(str(tmp_path / f"many.{keyword}.bam")) as manybam:
+            with pysam.AlignmentFile(str(tmp_path / "one.bam")) as onebam:
+                assert str(manybam.header) == str(onebam.header)
+                reads = [read.to_string() for read in manybam]
+                assert reads == [read.to_string() for read in onebam]
+                assert reads
+
+
+def test_extract_unordered_lca(tmp_path, monkeypatch):
+    """Test that extract still finds the right reads when the lca file is not in the same read order as the bam."""
+    test_shrink(tmp_path)
+    # tiny runs, so the read name set is sorted in several buckets
+    monkeypatch.setattr("bamdam.bamdam.read_name_set_run", 2)
+
+    lines = (tmp_path / "small.lca").read_text().splitlines(keepends=True)
+    (tmp_path / "reversed.lca").write_text("".join(lines[::-1]))
+
+    extracted = []
+    for lca in ["small.lca", "reversed.lca"]:
+        args = argparse.Namespace()
+        args.in_bam = str(tmp_path / "small.bam")
+        args.in_lca = str(tmp_path / lca)
+        args.out_bam = str(tmp_path / f"{lca}.bam")
+        args.keyword = "219896"
+        args.subset_header = False
+        args.only_top_ref = False
+        args.threads = 1
+        args.compression_level = None
+        args.index = None
+
+        extract(args)
+
+        with pysam.AlignmentFile(args.out_bam) as extractedbam:
+            extracted.append([read.to_string() for read in extractedbam])
+    assert extracted[0] == extracted[1]
+    assert extracted[0]
+
+
+def test_extract_missing_reads(tmp_path, monkeypatch, capsys):
+    """Test that extract skips bam reads which aren't in the lca file, and jumps ahead past long stretches of lca lines which aren't in the bam, without giving up on the read order."""
+    test_shrink(tmp_path)
+    # a tiny window, so any read which isn't the very next line is looked up by name
+    monkeypatch.setattr("bamdam.bamdam.lca_lookahead_lines", 1)
+
+    with pysam.AlignmentFile(str(tmp_path / "small.bam")) as bam:
+        readnames = list(dict.fromkeys(read.query_name for read in bam))
+    lines = (tmp_path / "small.lca").read_text().splitlines(keepends=True)
+    # drop the line of a read in the middle of the bam
+    missing = readnames[len(readnames) // 2]
+    (tmp_path / "missing.lca").write_text(
+        "".join(line for line in lines if not line.startswith(missing + ":"))
+    )
+
+    def extract_from(lca):
+        args = argparse.Namespace()
+        args.in_bam = str(tmp_path / "small.bam")
+        args.in_lca = str(tmp_path / lca)
+        args.out_bam = str(tmp_path / f"{lca}.bam")
+        args.keyword = "3931"
+        args.exact_node = False
+        args.subset_header = False
+        args.only_top_ref = False
+        args.threads = 1
+        args.compression_level = None
+        args.index = None
+
+        extract(args)
+
+        with pysam.AlignmentFile(args.out_bam) as extractedbam:
+            return [read.to_string() for read in extractedbam]
+
+    extracted = extract_from("small.lca")
+    assert extracted
+    assert extract_from("missing.lca") == [
+        read for read in extracted if not read.startswith(missing + "\t")
+    ]
+    out = capsys.readouterr().out
+    assert "Skipped 1 reads" in out
+    assert "not in the same place" not in out
+
+
+def test_reference_counts(monkeypatch):
+    """Test counting alignments per reference id, and relinking the ids to a subset header."""
+    # tiny batches, so the counts and first hits are merged across them
+    monkeypatch.setattr("bamdam.bamdam.reference_batch_size", 3)
+    counts = ReferenceCounts(6)
+    for reference_id in [4, -1, 1, 1, 4, 2]:
+        counts.add(reference_id)
+
+    header = {"SQ": [{"SN": f"ref{i}", "LN": 100} for i in range(6)]}
+    assert subset_header_references(dict(header), counts, False) == [
+        -1,
+        0,
+        1,
+        -1,
+        2,
+        -1,
+    ]
+    assert counts.counts.tolist() == [0, 2, 1, 0, 2, 0]
+    # a tie goes to the reference that was hit first
+    topheader = dict(header)
+    assert subset_header_references(topheader, counts, True) == [
+        -1,
+        -1,
+        -1,
+        -1,
+        0,
+        -1,
+    ]
+    assert topheader["SQ"] == [{"SN": "ref4", "LN": 100}]
+
+    # no top reference when every alignment is unmapped, or there are no references
+    unmapped = ReferenceCounts(6)
+    unmapped.add(-1)
+    assert unmapped.most_common() is None
+    assert ReferenceCounts(0).most_common() is None
+    unmappedheader = dict(header)
+    assert subset_header_references(unmappedheader, unmapped, True) == [-1] * 6
+    assert unmappedheader["SQ"] == []
+
+
+def test_mismatch_table():
+    """Test the subs tensor indices of a small soft clipped alignment with a deletion."""
+    # sGTTCTG-AG read
+    # sGTACTGNAG ref
+    cells = mismatch_table("AGTTCTGAG", [(4, 1), (0, 6), (2, 1), (0, 2)], "2A3^G2", 0)
+    A, C, G, T = range(4)
+    expected = [subs_index(A, T, 4)]  # the mismatch
+    for base, pos in [(G, 2), (T, 3), (C, 5), (T, -5), (G, -4), (A, -2), (G, -1)]:
+        expected.append(subs_index(base, base, pos))
+    assert sorted(cells.tolist()) == sorted(expected)
+
+    # further in than the subs tensor, only the reference base is counted
+    subs_size = 25 * 2 * subs_max_position
+    assert subs_index(C, T, subs_max_position + 1) == subs_size + C
+    assert subs_index(G, G, -subs_max_position - 1) == subs_size + G
+
+
+def test_dust():
+    """Test dust scores on a few simple reads, one at a time and in a batch."""
+    seqs = ["A" * 100, "AC" * 40, "ACGTTGCAAGTCCTAGGATC" * 5, "ACGTN" * 10]
+    scores = calculate_dusts(seqs)
+    assert scores[0] == 100
+    assert 0 < scores[2] < scores[1] < 100
+    assert scores[3] == -1
+    assert scores == [calculate_dust(seq) for seq in seqs]
+
+
+def test_pmds():
+    """Test that scoring a batch of reads gives the same pmds as one at a time."""
+    with pysam.AlignmentFile("tests/data/small.bam", "rb", check_sq=False) as bam:
+        reads = [read for _, read in zip(range(500), bam)]
+
+    for stranded in ["ss", "ds"]:
+        batch = get_pmds(reads, stranded)
+        assert len(batch) == len(reads)
+        assert np.all(np.isfinite(batch))
+        single = [get_pmd(read, stranded) for read in reads]
+        assert np.allclose(batch, single, rtol=0, atol=1e-9)
+
+
+def test_hyperloglog():
+    """Test that sparse and dense sketches merge and serialize consistently."""
+    hashes = hash64(np.arange(20000, dtype=np.uint64))
+
+    small = HyperLogLog()
+    small.add(hashes[:50])
+    assert small.registers is None  # still sparse
+    assert len(small) == 50
+
+    big = HyperLogLog()
+    big.add(hashes[40:])
+    assert big.registers is not None  # promoted to dense
+
+    everything = HyperLogLog()
+    everything.add(hashes)
+    small.merge(big)
+    assert len(small) == len(everything)
+    assert abs(len(everything) - 20000) < 20000 * 0.03
+
+    for sketch in [HyperLogLog(), small]:
+        copy = HyperLogLog.from_bytes(sketch.to_bytes())
+        assert len(copy) == len(sketch)
+        assert len(pickle.loads(pickle.dumps(sketch))) == len(sketch)